@@ -22,18 +22,94 @@
 # Args:
 #   $1: Output path.
 #   $2: The dbNSFP input filename.
+#
+# The environment variable NUM_JOBS sets the number of chromosome files
+# processed at once (by default, the number of cores).
 
 set -o nounset
 set -o errexit
+set -o pipefail
 
 readonly DEFAULT_OUTPUT_PATH=${OUTPUT_PATH:-}
 readonly DBNSFP_BASE=${1:-$DEFAULT_OUTPUT_PATH}
 readonly DBNSFP_ZIP_FILE=${2:-dbNSFP.zip}
 
+# The empty block that ends every BGZF file.
+readonly BGZF_EOF='\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+# The number of chromosome files processed at once.
+readonly NUM_JOBS=${NUM_JOBS:-$(nproc)}
+
+# Print the position of a chromosome in karyotype order: chr1 to chr22, then
+# chrX, chrY and chrM.  Other names come last.
+#
+# Args:
+#   $1: Chromosome name, with or without "chr".
+function karyotype_rank() {
+  local -r chrom="${1#chr}"
+  case "${chrom}" in
+    X) echo 23 ;;
+    Y) echo 24 ;;
+    M|MT) echo 25 ;;
+    ''|*[!0-9]*) echo 26 ;;
+    *) echo "$(( 10#${chrom} ))" ;;
+  esac
+}
+
+# Print the files given in karyotype order of the chromosome named at the end
+# of each file name.
+#
+# Args:
+#  ...: Input files, typically one per chromosome.
+function karyotype_order() {
+  local file
+  for file in "$@"; do
+    echo "$(karyotype_rank "${file##*chr}") ${file}"
+  done | sort --key=1,1n --key=2 | cut --delimiter=' ' --fields=2-
+}
+
+# Sort and BGZF compress one chromosome file, leaving the comment lines at the
+# top, and add "chr" to the start of the chromosome names (column 1).  The
+# records are always sorted by position here, whatever their order in the
+# input.  Fail as soon as the file is found to hold more than one chromosome,
+# since its records could then not be contiguous in the combined file, and
+# write the name of its chromosome to OUTPUT.chrom for process_tables to check.
+# The end-of-file block is removed, so that the outputs can be concatenated.
+#
+# Args:
+#   $1: Input file.
+#   $2: Output file.
+function process_table() {
+  local -r file="$1"
+  local -r output="$2"
+  {
+    awk '/^#/' "${file}"
+    awk '!/^#/{print "chr"$0}' "${file}" | \
+      sort --key=2,2n --stable --buffer-size="$(( 50 / NUM_JOBS + 1 ))%" | \
+      awk -F '\t' -v file="${file}" -v chrom_file="${output}.chrom" '
+        NR == 1 { chrom = $1 }
+        $1 != chrom {
+          print file ": found " $1 " after " chrom > "/dev/stderr"
+          failed = 1
+          exit 1
+        }
+        { print }
+        END { if (!failed) printf "%s", chrom > chrom_file }'
+  } | \
+    bgzip -c > "${output}"
+
+  if [[ "$(tail -c 28 "${output}" | od -An -tx1)" != \
+        "$(printf "${BGZF_EOF}" | od -An -tx1)" ]]; then
+    echo "${output} does not end with a BGZF end-of-file block." >&2
+    return 1
+  fi
+  truncate --size=-28 "${output}"
+}
+
 # Process a list of dbNSFP database files by sorting and indexing them with
-# tabix.  We sort each chromosome separately, leaving the comment line at the
-# top.  Additionally, add "chr" to the start of the chromosome names (column 1).
-# Concatenate the resulting files and run tabix to index the final file.
+# tabix.  Each chromosome is sorted and compressed by its own process, up to
+# NUM_JOBS at a time.  BGZF files can be concatenated, so the results are then
+# joined in karyotype order, and tabix indexes the final file in one pass.
 #
 # Args:
 #   $1: The combined output file name.
@@ -41,16 +117,58 @@ readonly DBNSFP_ZIP_FILE=${2:-dbNSFP.zip}
 function process_tables() {
   local -r gzip_file="$1"
   shift 1
+  local -r parts_dir=$(mktemp -d --tmpdir=.)
+  local -a parts=()
+  local -i running=0
   local file
-  for file in $(printf '%s\n' "$@" | sort); do
-    # Write the comment lines for this file.
-    awk '/^#/' "${file}"
-    # Write the position-sorted non-comment lines for this file.
-    awk '!/^#/{print "chr"$0}' "${file}" | \
-      sort --key=2,2n --stable --parallel=8
-  done | \
-    bgzip --threads 8 -c > \
-      "${gzip_file}"
+
+  while read -r file; do
+    if (( running >= NUM_JOBS )); then
+      # Stop at the first failure rather than after every chromosome.
+      if ! wait -n; then
+        kill $(jobs -p) 2>/dev/null || true
+        return 1
+      fi
+      running=running-1
+    fi
+    local part="${parts_dir}/${#parts[@]}.gz"
+    parts+=("${part}")
+    process_table "${file}" "${part}" &
+    running=running+1
+  done < <(karyotype_order "$@")
+
+  while (( running > 0 )); do
+    if ! wait -n; then
+      kill $(jobs -p) 2>/dev/null || true
+      return 1
+    fi
+    running=running-1
+  done
+
+  # Each part holds one chromosome sorted by position, so the combined file is
+  # sorted if no chromosome is in two parts and they are in karyotype order.
+  local -A seen=()
+  local -i previous_rank=0
+  local chrom
+  local -i rank
+  for part in "${parts[@]}"; do
+    chrom="$(< "${part}.chrom")"
+    if [[ -z "${chrom}" ]]; then
+      continue
+    fi
+    rank="$(karyotype_rank "${chrom}")"
+    if [[ -n "${seen[${chrom}]:-}" ]] || (( rank < previous_rank )); then
+      echo "${chrom} is not contiguous or out of karyotype order in the" \
+        "combined file." >&2
+      return 1
+    fi
+    seen[${chrom}]=1
+    previous_rank=rank
+  done
+
+  cat "${parts[@]}" > "${gzip_file}"
+  printf "${BGZF_EOF}" >> "${gzip_file}"
+  rm -r "${parts_dir}"
   tabix -s 1 -b 2 -e 2 "${gzip_file}"
   # TODO: Determine if "chr" needs to be prepended for GRCh37.
 }
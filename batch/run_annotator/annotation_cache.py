@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Cache of VEP annotations, to avoid annotating the same variant twice.
+
+The cache is an SQLite database of VEP JSON output records keyed by a
+fingerprint of the VEP configuration (image, assembly, species, plugins and
+databases) and the variant of the input line: (chrom, pos, ref, alt), with
+the alleles upper cased and chrom without any "chr" prefix, so that "chr1" and
+"1" share records.  For VCF input, alt holds every alternate allele of
+the line; for ensembl format input, alt also records a reverse strand.
+
+The VEP worker uses it in three steps:
+
+  split   Separate an input file into the lines whose annotations are cached
+          (written as VEP JSON, with "input", "id" and "seq_region_name"
+          rewritten for the line)
+          and the lines that still need to be annotated.
+  update  Add the records of VEP's output for those lines to the cache, and
+          optionally export them so that they can be shared.
+  (load)  The cached records are appended to VEP's output before loading.
+
+Caches are shared between workers with export and import: each worker exports
+the records it added, and the exports are imported into a shared cache that
+later runs start from.  The export format is gzip compressed, tab-separated
+lines of fingerprint, chrom, pos, ref, alt and the VEP JSON record.
+
+Example usage:
+
+python annotation_cache.py split \
+    --cache cache.sqlite --fingerprint "$(cat fingerprint.txt)" \
+    --input input_file --format vcf \
+    --misses vep_input_file --hits cached_output.json
+
+python annotation_cache.py update \
+    --cache cache.sqlite --fingerprint "$(cat fingerprint.txt)" \
+    --input output.json --format vcf --export delta.tsv.gz
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import sqlite3
+import sys
+import zlib
+
+# Number of rows inserted per transaction.
+_BATCH_SIZE = 10000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+  fingerprint TEXT NOT NULL,
+  chrom TEXT NOT NULL,
+  pos INTEGER NOT NULL,
+  ref TEXT NOT NULL,
+  alt TEXT NOT NULL,
+  record BLOB NOT NULL,
+  PRIMARY KEY (fingerprint, chrom, pos, ref, alt)
+) WITHOUT ROWID
+"""
+
+_VCF_FORMAT = "vcf"
+_ENSEMBL_FORMAT = "ensembl"
+
+
+def _normalize_chrom(chrom):
+  return chrom[3:] if chrom.startswith("chr") else chrom
+
+
+def make_fingerprint(parts):
+  """Returns a fingerprint of a VEP configuration.
+
+  Args:
+    parts: List of strings that together determine VEP's output, such as the
+        VEP version, the assembly and the command line arguments.
+  """
+  digest = hashlib.sha1()
+  for part in parts:
+    digest.update(part.encode("utf-8"))
+    digest.update(b"\0")
+  return digest.hexdigest()
+
+
+def parse_line(line, input_format):
+  """Returns the cache key and input id of a VEP input line.
+
+  Args:
+    line: A non-comment input line, without its newline.
+    input_format: "vcf" or "ensembl".
+
+  Returns:
+    A tuple of ((chrom, pos, ref, alt), id).  chrom has no "chr" prefix.  id
+    is the ID column, or None if the line does not have one or it is ".".
+
+  Raises:
+    ValueError: If the line cannot be parsed.
+  """
+  if input_format == _VCF_FORMAT:
+    fields = line.split("\t", 5)
+    if len(fields) < 5:
+      raise ValueError("Too few VCF columns: %r" % line)
+    chrom, pos, variant_id, ref, alt = fields[:5]
+    return ((_normalize_chrom(chrom), int(pos), ref.upper(), alt.upper()),
+            None if variant_id == "." else variant_id)
+
+  fields = line.split()
+  if len(fields) < 4:
+    raise ValueError("Too few ensembl format columns: %r" % line)
+  chrom, start, _, alleles = fields[:4]
+  strand = fields[4] if len(fields) > 4 else "+"
+  ref, _, alt = alleles.upper().partition("/")
+  if strand in ("-", "-1"):
+    alt += "/-"
+  variant_id = fields[5] if len(fields) > 5 else "."
+  return ((_normalize_chrom(chrom), int(start), ref, alt),
+          None if variant_id == "." else variant_id)
+
+
+class AnnotationCache(object):
+  """An SQLite database of VEP output records."""
+
+  def __init__(self, path):
+    self.path = path
+    self._connection = sqlite3.connect(path)
+    self._connection.execute("PRAGMA journal_mode = WAL")
+    self._connection.execute("PRAGMA synchronous = OFF")
+    self._connection.execute(_SCHEMA)
+
+  def close(self):
+    self._connection.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_args):
+    self.close()
+
+  def get(self, fingerprint, key):
+    """Returns the cached VEP JSON record for a key, or None."""
+    row = self._connection.execute(
+        "SELECT record FROM annotations WHERE fingerprint = ? AND chrom = ? "
+        "AND pos = ? AND ref = ? AND alt = ?", (fingerprint,) + key).fetchone()
+    if row is None:
+      return None
+    return zlib.decompress(bytes(row[0])).decode("utf-8")
+
+  def put_many(self, entries):
+    """Adds or replaces records.
+
+    Args:
+      entries: Iterable of (fingerprint, (chrom, pos, ref, alt), record),
+          where record is VEP JSON text.
+
+    Returns:
+      The number of records written.
+    """
+    count = 0
+    batch = []
+    for fingerprint, key, record in entries:
+      batch.append((fingerprint,) + tuple(key) + (
+          sqlite3.Binary(zlib.compress(record.encode("utf-8"))),))
+      if len(batch) >= _BATCH_SIZE:
+        count += self._insert(batch)
+        batch = []
+    return count + self._insert(batch)
+
+  def _insert(self, batch):
+    with self._connection:
+      self._connection.executemany(
+          "INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?, ?, ?)", batch)
+    return len(batch)
+
+  def iter_entries(self, fingerprint=None):
+    """Yields (fingerprint, (chrom, pos, ref, alt), record) for all records."""
+    query = "SELECT * FROM annotations"
+    args = ()
+    if fingerprint is not None:
+      query += " WHERE fingerprint = ?"
+      args = (fingerprint,)
+    for row in self._connection.execute(query, args):
+      yield (row[0], (row[1], row[2], row[3], row[4]),
+             zlib.decompress(bytes(row[5])).decode("utf-8"))
+
+
+def write_export(entries, outfile):
+  """Writes cache entries in the bulk export format.
+
+  Args:
+    entries: Iterable of (fingerprint, (chrom, pos, ref, alt), record).
+    outfile: Binary file-like object, typically a gzip file.
+
+  Returns:
+    The number of entries written.
+  """
+  count = 0
+  for fingerprint, (chrom, pos, ref, alt), record in entries:
+    outfile.write(("%s\t%s\t%d\t%s\t%s\t%s\n" % (
+        fingerprint, chrom, pos, ref, alt, record)).encode("utf-8"))
+    count += 1
+  return count
+
+
+def iter_export(infile):
+  """Yields the entries of a bulk export file."""
+  for line in infile:
+    fingerprint, chrom, pos, ref, alt, record = line.decode(
+        "utf-8").rstrip("\n").split("\t", 5)
+    yield fingerprint, (chrom, int(pos), ref, alt), record
+
+
+def _tee_export(entries, outfile):
+  """Yields entries, writing each to an export file as it passes."""
+  for entry in entries:
+    write_export([entry], outfile)
+    yield entry
+
+
+def split_input(cache, fingerprint, infile, input_format, misses, hits):
+  """Separates input lines with cached annotations from the rest.
+
+  Args:
+    cache: An AnnotationCache.
+    fingerprint: Fingerprint of the VEP configuration.
+    infile: Binary file-like object of VEP input.
+    input_format: "vcf" or "ensembl".
+    misses: Binary file-like object to which the header lines and the lines
+        without cached annotations are written.
+    hits: Binary file-like object to which the cached VEP JSON records of the
+        other lines are written, with "input", "id" and "seq_region_name" set
+        for the line.  "id" is removed if the line has none, since the record
+        may have been cached from a line with another ID.
+
+  Returns:
+    A tuple of (number of hits, number of misses).
+  """
+  num_hits = 0
+  num_misses = 0
+  for line in infile:
+    text = line.decode("utf-8").rstrip("\r\n")
+    if not text or text.startswith("#"):
+      misses.write(line)
+      continue
+    key, variant_id = parse_line(text, input_format)
+    record = cache.get(fingerprint, key)
+    if record is None:
+      misses.write(line)
+      num_misses += 1
+      continue
+    record = json.loads(record)
+    record["input"] = text
+    if variant_id is None:
+      record.pop("id", None)
+    else:
+      record["id"] = variant_id
+    if "seq_region_name" in record:
+      # The record may have been cached from a line naming the contig
+      # differently.
+      record["seq_region_name"] = text.split(None, 1)[0]
+    hits.write(json.dumps(record, separators=(",", ":")).encode("utf-8") +
+               b"\n")
+    num_hits += 1
+  return num_hits, num_misses
+
+
+def iter_output_entries(fingerprint, infile, input_format):
+  """Yields cache entries for VEP JSON output lines.
+
+  The key of each record is parsed from its "input" field, the input line.
+  """
+  for line in infile:
+    if not line.strip():
+      continue
+    record = line.decode("utf-8").rstrip("\r\n")
+    try:
+      key, _ = parse_line(json.loads(record)["input"], input_format)
+    except (KeyError, ValueError) as e:
+      logging.warning("Not caching malformed VEP output (%s): %.200s", e,
+                      record)
+      continue
+    yield fingerprint, key, record
+
+
+def _open(path, mode):
+  if path == "-":
+    stream = sys.stdin if "r" in mode else sys.stdout
+    return getattr(stream, "buffer", stream)
+  if path.endswith(".gz"):
+    return gzip.open(path, mode)
+  return open(path, mode)
+
+
+def run(argv=None):
+  """Main entry point."""
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  subparsers = parser.add_subparsers(dest="command")
+
+  def add_parser(name, help_text):
+    subparser = subparsers.add_parser(
+        name, help=help_text,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparser.add_argument(
+        "--cache", required=True, help="Path of the SQLite cache database.")
+    return subparser
+
+  def add_fingerprint(subparser, required=True):
+    subparser.add_argument(
+        "--fingerprint",
+        required=required,
+        help="Fingerprint of the VEP configuration, see the fingerprint "
+        "command.")
+
+  fingerprint_parser = subparsers.add_parser(
+      "fingerprint", help="Print the fingerprint of a VEP configuration.")
+  fingerprint_parser.add_argument(
+      "parts", nargs="+",
+      help="Strings that determine VEP's output, such as its version, the "
+      "assembly and its command line arguments.")
+
+  split_parser = add_parser(
+      "split", "Separate input lines with cached annotations from the rest.")
+  add_fingerprint(split_parser)
+  split_parser.add_argument("--input", required=True, help="VEP input file.")
+  split_parser.add_argument(
+      "--format", choices=(_VCF_FORMAT, _ENSEMBL_FORMAT), required=True,
+      help="Format of the input.")
+  split_parser.add_argument(
+      "--misses", required=True,
+      help="Output file of the lines that must be annotated.")
+  split_parser.add_argument(
+      "--hits", required=True,
+      help="Output file of the cached VEP JSON records of the other lines.")
+
+  update_parser = add_parser("update", "Add VEP JSON output to the cache.")
+  add_fingerprint(update_parser)
+  update_parser.add_argument(
+      "--input", required=True, help="VEP JSON output file.")
+  update_parser.add_argument(
+      "--format", choices=(_VCF_FORMAT, _ENSEMBL_FORMAT), required=True,
+      help="Format of the VEP input.")
+  update_parser.add_argument(
+      "--export", help="Also write the new records to this export file.")
+
+  export_parser = add_parser("export", "Write the cache to an export file.")
+  add_fingerprint(export_parser, required=False)
+  export_parser.add_argument(
+      "--output", required=True, help="Export file, gzip compressed if *.gz.")
+
+  import_parser = add_parser("import", "Add export files to the cache.")
+  import_parser.add_argument(
+      "inputs", nargs="+", help="Export files, gzip compressed if *.gz.")
+
+  args = parser.parse_args(argv)
+
+  if args.command == "fingerprint":
+    print(make_fingerprint(args.parts))
+    return
+  if args.command is None:
+    parser.error("A command is required.")
+
+  with AnnotationCache(args.cache) as cache:
+    if args.command == "split":
+      with _open(args.input, "rb") as infile, _open(
+          args.misses, "wb") as misses, _open(args.hits, "wb") as hits:
+        num_hits, num_misses = split_input(cache, args.fingerprint, infile,
+                                           args.format, misses, hits)
+      logging.info("Found %d of %d variants in the cache.", num_hits,
+                   num_hits + num_misses)
+
+    elif args.command == "update":
+      with _open(args.input, "rb") as infile:
+        entries = iter_output_entries(args.fingerprint, infile, args.format)
+        if args.export:
+          with _open(args.export, "wb") as export:
+            count = cache.put_many(_tee_export(entries, export))
+        else:
+          count = cache.put_many(entries)
+      logging.info("Added %d records to the cache.", count)
+
+    elif args.command == "export":
+      with _open(args.output, "wb") as outfile:
+        count = write_export(cache.iter_entries(args.fingerprint), outfile)
+      logging.info("Exported %d records.", count)
+
+    elif args.command == "import":
+      count = 0
+      for path in args.inputs:
+        with _open(path, "rb") as infile:
+          count += cache.put_many(iter_export(infile))
+      logging.info("Imported %d records.", count)
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  run()
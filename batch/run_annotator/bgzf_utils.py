@@ -0,0 +1,266 @@
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Library to read and write BGZF (blocked gzip) files such as bgzip's.
+
+A BGZF file is a series of gzip members of at most 64 KiB each, with the size
+of each member recorded in a "BC" extra field of its header.  Blocks can be
+located without decompressing anything, and a position in the uncompressed
+data is addressed by a virtual offset: the file offset of the block in the
+upper 48 bits and the offset within the uncompressed block in the lower 16.
+
+See https://samtools.github.io/hts-specs/SAMv1.pdf section 4.1.
+"""
+
+import struct
+import zlib
+
+from multiprocessing.pool import ThreadPool
+
+# The fixed part of every BGZF block header: gzip magic, deflate, FEXTRA flag.
+_BLOCK_MAGIC = b"\x1f\x8b\x08\x04"
+
+# gzip header fields up to and including XLEN.
+_HEADER_SIZE = 12
+
+# The largest possible BGZF block.
+MAX_BLOCK_SIZE = 65536
+
+# The most uncompressed data written to one block, as by bgzip, leaving room
+# for incompressible data to fit in a block.
+MAX_BLOCK_DATA = 0xff00
+
+# The empty block that ends a BGZF file.
+EOF_BLOCK = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+             b"\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def make_virtual_offset(block_offset, within_block):
+  return (block_offset << 16) | within_block
+
+
+def split_virtual_offset(virtual_offset):
+  """Returns the (block_offset, within_block) parts of a virtual offset."""
+  return virtual_offset >> 16, virtual_offset & 0xFFFF
+
+
+def block_size(header):
+  """Returns the total size of a BGZF block from its header.
+
+  Args:
+    header: Bytes starting at the beginning of a block and holding at least
+        the whole gzip header, including its extra fields.
+
+  Returns:
+    The size in bytes of the compressed block, or None if header is not the
+    header of a BGZF block.
+  """
+  if len(header) < _HEADER_SIZE or header[:4] != _BLOCK_MAGIC:
+    return None
+  xlen = struct.unpack("<H", header[10:12])[0]
+  extra = header[_HEADER_SIZE:_HEADER_SIZE + xlen]
+  pos = 0
+  while pos + 4 <= len(extra):
+    subfield_length = struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+    if extra[pos:pos + 2] == b"BC" and subfield_length == 2:
+      return struct.unpack("<H", extra[pos + 4:pos + 6])[0] + 1
+    pos += 4 + subfield_length
+  return None
+
+
+def is_bgzf(path):
+  """Returns True if the file at path starts with a BGZF block."""
+  with open(path, "rb") as f:
+    return block_size(f.read(_HEADER_SIZE + 64)) is not None
+
+
+def decompress_block(block):
+  """Returns the uncompressed contents of one complete BGZF block."""
+  xlen = struct.unpack("<H", block[10:12])[0]
+  return zlib.decompress(block[_HEADER_SIZE + xlen:-8], -zlib.MAX_WBITS)
+
+
+def compress_block(data, level=6):
+  """Returns one complete BGZF block holding data.
+
+  Args:
+    data: At most MAX_BLOCK_DATA bytes.
+    level: zlib compression level.
+  """
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+  compressed = compressor.compress(data) + compressor.flush()
+  # Header with a single "BC" extra field holding the block size - 1, then
+  # the deflated data, its CRC32 and its uncompressed size.
+  size = _HEADER_SIZE + 6 + len(compressed) + 8
+  header = struct.pack("<4sIBBH2sHH", _BLOCK_MAGIC, 0, 0, 0xff, 6, b"BC", 2,
+                       size - 1)
+  trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+  return header + compressed + trailer
+
+
+class BgzfWriter(object):
+  """Writes a BGZF file, tracking the offset of each block.
+
+  Data may be written uncompressed, to be compressed into new blocks, or as
+  complete blocks copied from another BGZF file.
+  """
+
+  def __init__(self, f, level=6):
+    """Create BgzfWriter class.
+
+    Args:
+      f: File opened for binary writing.
+      level: zlib compression level of new blocks.
+    """
+    self._f = f
+    self.level = level
+    self.offset = 0
+    self.num_blocks = 0
+
+  def write_block(self, block):
+    """Writes one complete compressed block and returns its offset."""
+    offset = self.offset
+    self._f.write(block)
+    self.offset += len(block)
+    self.num_blocks += 1
+    return offset
+
+  def write(self, data):
+    """Compresses data into new blocks.
+
+    Returns:
+      A list of the (offset, uncompressed data) of the new blocks.
+    """
+    blocks = []
+    for start in range(0, len(data), MAX_BLOCK_DATA):
+      chunk = data[start:start + MAX_BLOCK_DATA]
+      blocks.append((self.write_block(compress_block(chunk, self.level)),
+                     chunk))
+    return blocks
+
+  def close(self):
+    """Writes the end-of-file block.  Does not close the file."""
+    self.write_block(EOF_BLOCK)
+
+
+def find_block_start(f, offset):
+  """Finds the start of the block that contains the byte at offset.
+
+  Rather than walking the chain of blocks from the start of the file, this
+  searches backwards from offset for a block header and checks that the
+  block it describes ends at or after offset at another block header (or the
+  end of the file).  The cost is independent of offset.
+
+  Args:
+    f: BGZF file opened for binary reading.
+    offset: File offset.
+
+  Returns:
+    The file offset of the block containing offset, or the size of the file
+    if offset is at or past its end.
+
+  Raises:
+    ValueError: If no block could be found.
+  """
+  f.seek(0, 2)
+  file_size = f.tell()
+  if offset >= file_size:
+    return file_size
+
+  window_start = max(0, offset - MAX_BLOCK_SIZE)
+  f.seek(window_start)
+  window = f.read(offset + _HEADER_SIZE + 64 - window_start)
+  # Search for headers starting at or before offset, nearest first.
+  search_end = offset - window_start + len(_BLOCK_MAGIC)
+  while True:
+    candidate = window.rfind(_BLOCK_MAGIC, 0, search_end)
+    if candidate < 0:
+      raise ValueError("No BGZF block found before offset %d" % offset)
+    search_end = candidate + len(_BLOCK_MAGIC) - 1
+    start = window_start + candidate
+    f.seek(start)
+    size = block_size(f.read(_HEADER_SIZE + 64))
+    if size is None or start + size <= offset:
+      continue
+    end = start + size
+    f.seek(end)
+    if end == file_size or block_size(f.read(_HEADER_SIZE + 64)):
+      return start
+
+
+def iter_blocks(f, start, end=None):
+  """Yields (offset, compressed_block) for consecutive blocks.
+
+  Args:
+    f: BGZF file opened for binary reading.
+    start: File offset of the first block.
+    end: Stop before the first block at or after this offset.  Read to the end
+        of the file if None.
+
+  Raises:
+    ValueError: If a block header is malformed.
+  """
+  offset = start
+  f.seek(offset)
+  pending = b""
+  while end is None or offset < end:
+    header = pending + f.read(max(0, _HEADER_SIZE + 64 - len(pending)))
+    if not header:
+      return
+    size = block_size(header)
+    if size is None:
+      raise ValueError("Invalid BGZF block at offset %d" % offset)
+    if size <= len(header):
+      block, pending = header[:size], header[size:]
+    else:
+      block, pending = header + f.read(size - len(header)), b""
+    yield offset, block
+    offset += size
+
+
+def iter_decompressed_blocks(f, start, end=None, threads=4, batch_size=64):
+  """Yields (offset, uncompressed_data) for consecutive blocks.
+
+  Blocks are decompressed in batches using a pool of threads; zlib releases
+  the interpreter lock while it inflates.
+
+  Args:
+    f: BGZF file opened for binary reading.
+    start: File offset of the first block.
+    end: Stop before the first block at or after this offset.  Read to the end
+        of the file if None.
+    threads: Number of decompression threads.
+    batch_size: Number of blocks decompressed at a time.
+  """
+  pool = ThreadPool(threads) if threads > 1 else None
+  try:
+    batch = []
+    blocks = iter_blocks(f, start, end)
+    while True:
+      del batch[:]
+      for offset_and_block in blocks:
+        batch.append(offset_and_block)
+        if len(batch) == batch_size:
+          break
+      if not batch:
+        return
+      compressed = [block for _, block in batch]
+      if pool:
+        data = pool.map(decompress_block, compressed)
+      else:
+        data = [decompress_block(block) for block in compressed]
+      for (offset, _), uncompressed in zip(batch, data):
+        yield offset, uncompressed
+  finally:
+    if pool:
+      pool.terminate()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Write the distinct sites of several VCF files as a single VEP input.
+
+Overlapping inputs (for example per-chromosome gnomAD files, or 1000 Genomes
+and ESP) share many sites, and each would otherwise be annotated by VEP once
+per file.  This streams the input files, splits multiallelic records into one
+record per alternate allele, normalizes each allele by trimming the bases it
+shares with the reference allele, and writes each distinct
+(chrom, pos, ref, alt) once, sorted, as a sites-only VCF.
+
+Memory is bounded by --max_sites_in_memory: sorted, de-duplicated runs of
+sites are written to temporary files and then merged, --merge_fan_in runs at a
+time.
+
+The fan-back mapping has one line per allele of each input record:
+
+  source, line number, allele index, chrom, pos, ref, alt
+
+where the line number is 1-based, the allele index is the 1-based index of the
+allele in the ALT column, and (chrom, pos, ref, alt) are the normalized key of
+the site, which is also the CHROM, POS, REF and ALT of the site in the VEP
+input and of the "input" of its VEP annotation.
+
+Alleles that have no annotation ("*" and ".") are dropped.  Alleles are not
+left-aligned, which needs the reference sequence, so an indel represented at
+two different positions in two files is annotated twice.
+
+Example usage:
+
+python dedup_sites.py \
+    --output sites.vcf.gz \
+    --mapping mapping.tsv.gz \
+    gnomad.chr21.vcf.gz gnomad.chr22.vcf.gz 1000genomes.vcf.gz
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import gzip
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+# Alleles with no sequence to annotate: an overlapping deletion and a missing
+# allele.
+_SKIPPED_ALLELES = (b"*", b".")
+
+_SITES_HEADER = (b"##fileformat=VCFv4.1\n"
+                 b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+
+
+def _open(path, mode):
+  if path == "-":
+    if "r" in mode:
+      return getattr(sys.stdin, "buffer", sys.stdin)
+    return getattr(sys.stdout, "buffer", sys.stdout)
+  if path.endswith(".gz"):
+    return gzip.open(path, mode)
+  return open(path, mode)
+
+
+def normalize_allele(pos, ref, alt):
+  """Returns the normalized (pos, ref, alt) of one allele of a VCF record.
+
+  Bases shared by the end and then the start of both alleles are removed,
+  leaving at least one base in each, and pos is moved past the removed leading
+  bases.  Symbolic alleles and breakends are returned unchanged.
+
+  Args:
+    pos: 1-based position of the record.
+    ref: Reference allele, as bytes.
+    alt: One alternate allele, as bytes.
+
+  Returns:
+    The normalized (pos, ref, alt), or None for an allele with no sequence to
+    annotate.
+  """
+  if alt in _SKIPPED_ALLELES:
+    return None
+  ref = ref.upper()
+  if alt.startswith(b"<") or b"[" in alt or b"]" in alt:
+    return pos, ref, alt
+  alt = alt.upper()
+  while len(ref) > 1 and len(alt) > 1 and ref[-1:] == alt[-1:]:
+    ref = ref[:-1]
+    alt = alt[:-1]
+  start = 0
+  while (start < len(ref) - 1 and start < len(alt) - 1 and
+         ref[start:start + 1] == alt[start:start + 1]):
+    start += 1
+  return pos + start, ref[start:], alt[start:]
+
+
+def iter_alleles(lines):
+  """Yields (line number, allele index, key) for the records of a VCF.
+
+  Args:
+    lines: Iterable of the lines of a VCF file, as bytes.
+
+  Yields:
+    Tuples of the 1-based line number, the 1-based index of the allele in the
+    ALT column and the normalized (chrom, pos, ref, alt) of the allele.
+
+  Raises:
+    ValueError: If a record has fewer than five columns or a bad POS.
+  """
+  for line_number, line in enumerate(lines, 1):
+    if line.startswith(b"#") or not line.strip():
+      continue
+    columns = line.rstrip(b"\r\n").split(b"\t", 5)
+    if len(columns) < 5:
+      raise ValueError("Line %d has fewer than 5 columns" % line_number)
+    chrom, pos, _, ref, alts = columns[:5]
+    try:
+      pos = int(pos)
+    except ValueError:
+      raise ValueError("Line %d has a bad POS: %r" % (line_number, pos))
+    for allele_index, alt in enumerate(alts.split(b","), 1):
+      normalized = normalize_allele(pos, ref, alt)
+      if normalized is not None:
+        yield line_number, allele_index, (chrom,) + normalized
+
+
+def _format_site(site):
+  chrom, pos, ref, alt = site
+  return b"\t".join([chrom, str(pos).encode("ascii"), ref, alt])
+
+
+def _parse_site(line):
+  chrom, pos, ref, alt = line.rstrip(b"\n").split(b"\t")
+  return chrom, int(pos), ref, alt
+
+
+class SiteSorter(object):
+  """De-duplicates and sorts sites with bounded memory.
+
+  Sites are kept in memory until there are max_sites_in_memory distinct ones,
+  and then written to a temporary file as a sorted run.  The runs are merged
+  by iter_sites.
+  """
+
+  def __init__(self, temp_dir, max_sites_in_memory=1000000, merge_fan_in=64):
+    """Create SiteSorter class.
+
+    Args:
+      temp_dir: Directory for the temporary run files.
+      max_sites_in_memory: Number of distinct sites to hold before writing a
+          run.
+      merge_fan_in: Largest number of runs merged at once.  With more runs,
+          groups of runs are first merged into longer runs.
+    """
+    self.temp_dir = temp_dir
+    self.max_sites_in_memory = max_sites_in_memory
+    self.merge_fan_in = max(2, merge_fan_in)
+    self.runs = []
+    self._sites = set()
+
+  def add(self, site):
+    self._sites.add(site)
+    if len(self._sites) >= self.max_sites_in_memory:
+      self._write_run(sorted(self._sites))
+      self._sites = set()
+
+  def _write_run(self, sites):
+    fd, path = tempfile.mkstemp(dir=self.temp_dir, suffix=".run")
+    with os.fdopen(fd, "wb") as f:
+      for site in sites:
+        f.write(_format_site(site) + b"\n")
+    self.runs.append(path)
+
+  def _merge(self, runs):
+    """Yields the distinct sites of several runs in sorted order."""
+    files = [open(path, "rb") for path in runs]
+    try:
+      merged = heapq.merge(*[(_parse_site(line) for line in f) for f in files])
+      for site, _ in itertools.groupby(merged):
+        yield site
+    finally:
+      for f in files:
+        f.close()
+      for path in runs:
+        os.remove(path)
+
+  def iter_sites(self):
+    """Yields every distinct site added, in sorted order.
+
+    Sites are sorted by chrom as bytes, then by position.
+    """
+    if not self.runs:
+      for site in sorted(self._sites):
+        yield site
+      self._sites = set()
+      return
+    if self._sites:
+      self._write_run(sorted(self._sites))
+      self._sites = set()
+    while len(self.runs) > self.merge_fan_in:
+      group = self.runs[:self.merge_fan_in]
+      self.runs = self.runs[self.merge_fan_in:]
+      self._write_run(self._merge(group))
+    runs = self.runs
+    self.runs = []
+    for site in self._merge(runs):
+      yield site
+
+
+def dedup_sites(inputs, sites_file, mapping_file, sorter):
+  """Writes the distinct sites of VCF files and the mapping back to them.
+
+  Args:
+    inputs: Paths of the (possibly gzipped) VCF files.
+    sites_file: Binary file-like object for the sites-only VCF.
+    mapping_file: Binary file-like object for the fan-back mapping.
+    sorter: A SiteSorter.
+
+  Returns:
+    A tuple of (number of input alleles, number of distinct sites).
+  """
+  alleles = 0
+  for path in inputs:
+    source = path.encode("utf-8")
+    with _open(path, "rb") as f:
+      for line_number, allele_index, site in iter_alleles(f):
+        mapping_file.write(b"\t".join([
+            source, str(line_number).encode("ascii"),
+            str(allele_index).encode("ascii"), _format_site(site)]) + b"\n")
+        sorter.add(site)
+        alleles += 1
+    logging.info("Read %s: %d alleles so far", path, alleles)
+
+  sites_file.write(_SITES_HEADER)
+  num_sites = 0
+  for site in sorter.iter_sites():
+    chrom, pos, ref, alt = site
+    sites_file.write(b"\t".join([
+        chrom, str(pos).encode("ascii"), b".", ref, alt, b".", b".", b"."
+    ]) + b"\n")
+    num_sites += 1
+  return alleles, num_sites
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      "inputs", nargs="+", help="VCF files, gzip compressed if *.gz.")
+  parser.add_argument(
+      "--output",
+      required=True,
+      help="Sites-only VCF of the distinct sites, gzip compressed if *.gz.")
+  parser.add_argument(
+      "--mapping",
+      required=True,
+      help="Fan-back mapping from input lines to sites, gzip compressed if "
+      "*.gz.")
+  parser.add_argument(
+      "--max_sites_in_memory",
+      type=int,
+      default=1000000,
+      help="Number of distinct sites held in memory before a sorted run is "
+      "written to a temporary file.")
+  parser.add_argument(
+      "--merge_fan_in",
+      type=int,
+      default=64,
+      help="Largest number of temporary runs merged at once.")
+  parser.add_argument(
+      "--temp_dir",
+      help="Directory for temporary runs.  Defaults to the system temporary "
+      "directory.")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+
+  temp_dir = tempfile.mkdtemp(dir=args.temp_dir)
+  try:
+    sorter = SiteSorter(temp_dir, args.max_sites_in_memory, args.merge_fan_in)
+    with _open(args.output, "wb") as sites_file:
+      with _open(args.mapping, "wb") as mapping_file:
+        alleles, num_sites = dedup_sites(args.inputs, sites_file,
+                                         mapping_file, sorter)
+  finally:
+    shutil.rmtree(temp_dir)
+  print("%d alleles, %d distinct sites (%d duplicates removed)" %
+        (alleles, num_sites, alleles - num_sites), file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
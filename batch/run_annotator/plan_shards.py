@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Plan VEP shards of a sorted input with balanced cost and genomic bounds.
+
+shard_input.py divides its input into shards of equal size, so a shard may
+straddle two contigs, and shards of dense coding regions take much longer to
+annotate than shards of the same size elsewhere.  This reads the input once,
+estimates the VEP cost of each record, and chooses shard boundaries so that
+each shard has about the same estimated cost, moving a boundary to the start
+of a contig when one is within --contig_slack of the ideal boundary.  For an
+input sorted by position, each shard is then one contiguous genomic window.
+
+The estimated cost of a record is the sum over its alternate alleles of 1, or
+1 + --indel_weight for an indel, multiplied by --coding_weight if the record
+overlaps a region of the --coding_bed file (such as the exons of a gene
+annotation).
+
+Boundaries are offsets in the terms of shard_input.py: byte offsets of lines
+of a plain file, and compressed block offsets of a BGZF file, so a BGZF shard
+boundary falls between blocks, and a contig boundary within a block is moved
+to the end of the block.  Plans of other gzip files are coarser still.
+
+The plan is a tab-separated file with a header line and a row per shard:
+
+  SHARD_INDEX  START  END  COST  RECORDS  FIRST  LAST
+
+where FIRST and LAST are the chrom:pos of the first and last records.  Pass it
+to shard_input.py with --plan.
+
+Example usage:
+
+python plan_shards.py \
+    --input variants.vcf.gz \
+    --coding_bed gencode_exons.bed.gz \
+    --num_shards 50 \
+    --output variants.plan.tsv
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import bisect
+import collections
+import gzip
+import logging
+import os
+import sys
+
+import shard_input
+
+# The plain-file lines of a unit, the smallest range of the plan, are grouped
+# until they hold at least this many bytes.  BGZF blocks are smaller.
+_UNIT_BYTES = 64 * 1024
+
+# A unit of the input: the offset at which its lines start, whether it is the
+# first unit of a contig, the chrom and position of its first and last
+# records, its number of records and its estimated cost.
+Unit = collections.namedtuple(
+    "Unit", ["offset", "contig_start", "first", "last", "records", "cost"])
+
+
+def _contig_key(chrom):
+  return chrom[3:] if chrom.startswith(b"chr") else chrom
+
+
+class CodingRegions(object):
+  """The regions of a BED file, for overlap queries.
+
+  Contig names are compared without any "chr" prefix, so that GRCh37 style
+  inputs can be used with UCSC style annotations and vice versa.
+  """
+
+  def __init__(self, path):
+    intervals = collections.defaultdict(list)
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+      for line in f:
+        if line.startswith((b"#", b"track", b"browser")) or not line.strip():
+          continue
+        chrom, start, end = line.split(b"\t", 3)[:3]
+        intervals[_contig_key(chrom)].append((int(start), int(end)))
+
+    # Merged, sorted, 0-based half-open intervals per contig.
+    self._starts = {}
+    self._ends = {}
+    for chrom, chrom_intervals in intervals.items():
+      starts = []
+      ends = []
+      for start, end in sorted(chrom_intervals):
+        if ends and start <= ends[-1]:
+          ends[-1] = max(ends[-1], end)
+        else:
+          starts.append(start)
+          ends.append(end)
+      self._starts[chrom] = starts
+      self._ends[chrom] = ends
+
+  def overlaps(self, chrom, start, end):
+    """Returns whether the 1-based, inclusive [start, end] overlaps a region."""
+    starts = self._starts.get(_contig_key(chrom))
+    if not starts:
+      return False
+    # The last region starting at or before end (0-based end - 1).
+    i = bisect.bisect_right(starts, end - 1) - 1
+    return i >= 0 and self._ends[_contig_key(chrom)][i] > start - 1
+
+
+def parse_record(line, is_vcf):
+  """Returns (chrom, start, end, ref, alts) of a VCF or ensembl format line.
+
+  start and end are 1-based and inclusive.  As in VEP, the columns of an
+  ensembl format line may be separated by any whitespace.
+  """
+  if is_vcf:
+    chrom, pos, _, ref, alts = line.split(b"\t", 5)[:5]
+    start = int(pos)
+    return chrom, start, start + len(ref) - 1, ref, alts.strip().split(b",")
+  chrom, start, end, alleles = line.split(None, 4)[:4]
+  alleles = alleles.split(b"/")
+  return chrom, int(start), int(end), alleles[0], alleles[1:]
+
+
+def record_cost(ref, alts, coding, indel_weight, coding_weight):
+  """Returns the estimated VEP cost of a record."""
+  cost = 0.0
+  for alt in alts:
+    cost += 1.0
+    if len(alt) != len(ref) or alt == b"-" or ref == b"-":
+      cost += indel_weight
+  if coding:
+    cost *= coding_weight
+  return cost
+
+
+def _iter_offset_lines(pieces, exact):
+  """Yields (offset, line) for the lines of the input.
+
+  The offset is the one by which shard_input.iter_owned_lines assigns the line
+  to a shard: the offset of the piece in which the line begins, or if exact,
+  the offset of the line itself, which is equivalent for plain files.
+  """
+  carry = b""
+  carry_offset = None
+  for offset, data in pieces:
+    pos = 0
+    if carry:
+      newline = data.find(b"\n")
+      if newline < 0:
+        carry += data
+        continue
+      yield carry_offset, carry + data[:newline + 1]
+      carry = b""
+      pos = newline + 1
+    while True:
+      newline = data.find(b"\n", pos)
+      if newline < 0:
+        break
+      yield offset + pos if exact else offset, data[pos:newline + 1]
+      pos = newline + 1
+    if pos < len(data):
+      carry = data[pos:]
+      carry_offset = offset + pos if exact else offset
+  if carry:
+    yield carry_offset, carry
+
+
+def iter_units(path, is_vcf, coding_regions=None, indel_weight=1.0,
+               coding_weight=3.0, threads=4):
+  """Yields the Units of an input file.
+
+  A new unit starts at each contig, and after a unit holds _UNIT_BYTES, but
+  only at an offset at which shard_input.py can start a shard.
+
+  Raises:
+    ValueError: If a record cannot be parsed.
+  """
+  compression = shard_input.detect_compression(path)
+  with open(path, "rb") as f:
+    pieces = shard_input.iter_pieces(f, compression, threads=threads)
+    lines = _iter_offset_lines(pieces, exact=compression == "plain")
+
+    unit = None
+    unit_bytes = 0
+    previous_offset = None
+    previous_chrom = None
+    pending_contig_start = False
+    seen_chroms = set()
+    warned = False
+    for offset, line in lines:
+      if line.startswith(b"#") or not line.strip():
+        continue
+      try:
+        chrom, start, end, ref, alts = parse_record(line, is_vcf)
+      except ValueError:
+        raise ValueError("Cannot parse %s line at offset %d: %r" %
+                         (path, offset, line[:200]))
+      new_contig = chrom != previous_chrom
+      if not warned and (chrom in seen_chroms if new_contig else
+                         start < unit.last[1]):
+        logging.warning("%s is not sorted at %s:%d, so shards will not be "
+                        "contiguous genomic windows", path, chrom, start)
+        warned = True
+      seen_chroms.add(chrom)
+      pending_contig_start = pending_contig_start or new_contig
+      if unit is not None and offset != previous_offset and (
+          pending_contig_start or unit_bytes >= _UNIT_BYTES):
+        yield unit
+        unit = None
+      if unit is None:
+        unit = Unit(offset, pending_contig_start and previous_chrom is not None,
+                    (chrom, start), (chrom, start), 0, 0.0)
+        unit_bytes = 0
+        pending_contig_start = False
+      elif new_contig:
+        pending_contig_start = True
+
+      coding = (coding_regions is not None and
+                coding_regions.overlaps(chrom, start, end))
+      unit = unit._replace(
+          last=(chrom, start), records=unit.records + 1,
+          cost=unit.cost + record_cost(ref, alts, coding, indel_weight,
+                                       coding_weight))
+      unit_bytes += len(line)
+      previous_offset = offset
+      previous_chrom = chrom
+    if unit is not None:
+      yield unit
+
+
+def choose_boundaries(units, num_shards, contig_slack=0.25):
+  """Returns the indexes of the units at which shards 2..n start.
+
+  The ideal start of shard k + 1 is the unit at which the cumulative cost
+  passes k / num_shards of the total.  The start of a contig is used instead
+  if one is within contig_slack times the cost of a shard of the ideal.
+
+  Args:
+    units: List of Unit.
+    num_shards: Number of shards wanted.  Fewer shards are planned if there
+        are fewer units.
+    contig_slack: Fraction of the cost of a shard by which a boundary may move
+        to reach the start of a contig.
+
+  Returns:
+    A sorted list of distinct unit indexes, each greater than 0.
+  """
+  cumulative = []
+  total = 0.0
+  for unit in units:
+    cumulative.append(total)
+    total += unit.cost
+  contig_starts = [i for i, unit in enumerate(units) if unit.contig_start]
+  target = total / num_shards if num_shards else 0.0
+
+  boundaries = []
+  for k in range(1, num_shards):
+    ideal = k * target
+    i = bisect.bisect_left(cumulative, ideal)
+    candidates = [j for j in (i - 1, i) if 0 < j < len(units)]
+    if not candidates:
+      continue
+    best = min(candidates, key=lambda j: abs(cumulative[j] - ideal))
+    c = bisect.bisect_left(contig_starts, best)
+    nearby = [contig_starts[j] for j in (c - 1, c)
+              if 0 <= j < len(contig_starts) and
+              abs(cumulative[contig_starts[j]] - ideal) <= contig_slack * target]
+    if nearby:
+      best = min(nearby, key=lambda j: abs(cumulative[j] - ideal))
+    if (not boundaries or best > boundaries[-1]) and best > 0:
+      boundaries.append(best)
+  return boundaries
+
+
+def _format_position(position):
+  chrom, pos = position
+  return "%s:%d" % (chrom.decode("utf-8"), pos)
+
+
+def write_plan(outfile, units, boundaries, end):
+  """Writes the plan of the shards starting at the boundaries.
+
+  Args:
+    outfile: Text file-like object.
+    units: List of Unit.
+    boundaries: Indexes of the units at which shards 2..n start.
+    end: Offset past the end of the input.
+
+  Returns:
+    The list of the costs of the shards.
+  """
+  outfile.write("SHARD_INDEX\tSTART\tEND\tCOST\tRECORDS\tFIRST\tLAST\n")
+  starts = [0] + boundaries
+  stops = boundaries + [len(units)]
+  costs = []
+  for shard_index, (first, stop) in enumerate(zip(starts, stops), 1):
+    shard = units[first:stop]
+    start_offset = 0 if shard_index == 1 else shard[0].offset
+    end_offset = units[stop].offset if stop < len(units) else end
+    cost = sum(unit.cost for unit in shard)
+    costs.append(cost)
+    outfile.write("%d\t%d\t%d\t%.0f\t%d\t%s\t%s\n" % (
+        shard_index, start_offset, end_offset, cost,
+        sum(unit.records for unit in shard), _format_position(shard[0].first),
+        _format_position(shard[-1].last)))
+  return costs
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      "--input",
+      required=True,
+      help="Plain, gzip or BGZF compressed VCF or ensembl format file, "
+      "sorted by position.")
+  parser.add_argument(
+      "--output", required=True, help="Path to which to write the plan.")
+  parser.add_argument(
+      "--num_shards", type=int, required=True, help="The number of shards.")
+  parser.add_argument(
+      "--format",
+      choices=("vcf", "ensembl"),
+      help="Format of the input.  If omitted, files named *.vcf or *.vcf.gz "
+      "are VCF and all others are ensembl format.")
+  parser.add_argument(
+      "--coding_bed",
+      help="Optional BED file (gzip compressed if *.gz) of coding regions, "
+      "whose records cost more to annotate.")
+  parser.add_argument(
+      "--indel_weight",
+      type=float,
+      default=1.0,
+      help="Extra cost of an indel allele relative to a substitution.")
+  parser.add_argument(
+      "--coding_weight",
+      type=float,
+      default=3.0,
+      help="Factor by which the cost of a record in a coding region grows.")
+  parser.add_argument(
+      "--contig_slack",
+      type=float,
+      default=0.25,
+      help="Fraction of the cost of a shard by which a boundary may move to "
+      "fall at the start of a contig.")
+  parser.add_argument(
+      "--threads",
+      type=int,
+      default=4,
+      help="Number of threads decompressing BGZF input.")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+
+  if args.num_shards < 1:
+    parser.error("--num_shards must be at least 1.")
+
+  is_vcf = args.format == "vcf" or (
+      args.format is None and args.input.endswith((".vcf", ".vcf.gz")))
+  coding_regions = CodingRegions(args.coding_bed) if args.coding_bed else None
+  units = list(iter_units(args.input, is_vcf, coding_regions,
+                          args.indel_weight, args.coding_weight, args.threads))
+  if not units:
+    raise SystemExit("%s has no records." % args.input)
+  logging.info("Read %d units of %s", len(units), args.input)
+
+  boundaries = choose_boundaries(units, args.num_shards, args.contig_slack)
+  with open(args.output, "w") as outfile:
+    costs = write_plan(outfile, units, boundaries,
+                       os.path.getsize(args.input))
+  mean = sum(costs) / len(costs)
+  print("%d shards, estimated cost per shard %.0f (min %.0f, max %.0f)" %
+        (len(costs), mean, min(costs), max(costs)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
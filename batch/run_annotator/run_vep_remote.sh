@@ -68,6 +68,62 @@ DEFINE_integer min_gb_ram 8 \
 DEFINE_string docker_script "./vep_into_bigquery_for_docker.sh" \
    "Script that will be run by dsub."
 
+DEFINE_string python_scripts_dir "." \
+   "Directory holding the Python helpers used by docker_script."
+
+DEFINE_string output_format "ndjson" \
+   "Format of the annotations staged for loading into BigQuery: ndjson or parquet (several times smaller)."
+
+DEFINE_boolean plan_shards false \
+   "Plan the shards of each file with plan_shards.py, balancing their estimated VEP cost and placing their boundaries at the starts of contigs. Each file is copied here to be planned. Input files must be sorted by position."
+
+DEFINE_string coding_bed "" \
+   "Optional local BED file of coding regions, used by --plan_shards to estimate the cost of records."
+
+DEFINE_string annotation_cache "" \
+   "Optional GCS directory of a cache of VEP annotations shared between runs. Cached variants are not annotated again."
+
+# Plans the shards of an input file with plan_shards.py.  Writes the plan to
+# plan.tsv in the given local directory and copies it to the given GCS path.
+function plan_input_shards() {
+  local -r file="$1"
+  local -r plan_dir="$2"
+  local -r shard_plan="$3"
+  local -r local_file="${plan_dir}/$(basename "${file}")"
+
+  gsutil -q cp "${file}" "${local_file}"
+  python "${FLAGS_python_scripts_dir}/plan_shards.py" \
+    --input "${local_file}" \
+    --num_shards "${FLAGS_shards_per_file}" \
+    ${FLAGS_coding_bed:+--coding_bed "${FLAGS_coding_bed}"} \
+    --output "${plan_dir}/plan.tsv"
+  rm "${local_file}"
+  gsutil -q cp "${plan_dir}/plan.tsv" "${shard_plan}"
+}
+
+# Merges the annotations written by the tasks of a run into the shared cache.
+# Runs are expected not to overlap; the cache is replaced as a whole.
+function merge_annotation_cache() {
+  local -r cache_dir=$(mktemp -d)
+
+  if gsutil -q stat "${FLAGS_annotation_cache}/cache.sqlite"; then
+    gsutil -q cp "${FLAGS_annotation_cache}/cache.sqlite" "${cache_dir}/"
+  fi
+  mkdir "${cache_dir}/deltas"
+  if ! gsutil -q -m cp "${FLAGS_annotation_cache}/deltas/*.tsv.gz" \
+      "${cache_dir}/deltas/"; then
+    echo "No new annotations to add to the cache."
+    return
+  fi
+
+  python "${FLAGS_python_scripts_dir}/annotation_cache.py" import \
+    --cache "${cache_dir}/cache.sqlite" \
+    "${cache_dir}"/deltas/*.tsv.gz
+  gsutil -q cp "${cache_dir}/cache.sqlite" \
+    "${FLAGS_annotation_cache}/cache.sqlite"
+  gsutil -q -m rm "${FLAGS_annotation_cache}/deltas/*.tsv.gz"
+}
+
 function main() {
   if [[ -z "${FLAGS_project_id}" ]] ; then
     echo "--project_id is required."
@@ -91,6 +147,11 @@ function main() {
     "${FLAGS_vep_schema_file}" \
     "${FLAGS_bucket}/schema.json"
 
+  gsutil \
+    cp \
+    "${FLAGS_python_scripts_dir}"/*.py \
+    "${FLAGS_bucket}/scripts/"
+
   bq \
     --project_id "${FLAGS_project_id}" \
     mk -f "${FLAGS_dataset}"
@@ -124,18 +185,37 @@ function main() {
          --input=INPUT_FILE \
          NUM_SHARDS \
          SHARD_INDEX \
+         --input-recursive=SCRIPTS_DIR \
+         OUTPUT_FORMAT \
+         ANNOTATION_CACHE \
+         SHARD_PLAN \
       | tr '= ' ' \t'
 
     local file
+    local -i file_index=0
     for file in "$@"; do
+      file_index+=1
+      # A plan may have fewer shards than asked for, if the file is small.
+      local shard_plan=""
+      local -i num_shards="${FLAGS_shards_per_file}"
+      if [[ "${FLAGS_plan_shards}" -eq "${FLAGS_TRUE}" ]]; then
+        shard_plan="${FLAGS_bucket}/plans/${file_index}.tsv"
+        plan_input_shards "${file}" "${temp_dir}" "${shard_plan}"
+        num_shards=$(( $(wc -l < "${temp_dir}/plan.tsv") - 1 ))
+      fi
+
       local -i shard_index
-      for shard_index in $(seq "${FLAGS_shards_per_file}"); do
+      for shard_index in $(seq "${num_shards}"); do
         echo "${FLAGS_bucket}/schema.json" \
              "${FLAGS_dataset}" \
              "${FLAGS_table_name}" \
              "${file}" \
-             "${FLAGS_shards_per_file}" \
-             "${shard_index}"
+             "${num_shards}" \
+             "${shard_index}" \
+             "${FLAGS_bucket}/scripts/" \
+             "${FLAGS_output_format}" \
+             "${FLAGS_annotation_cache}" \
+             "${shard_plan}"
       done
     done | tr ' ' '\t'
   ) > "${temp_dir}/table.tsv"
@@ -151,6 +231,10 @@ function main() {
     --boot-disk-size "${FLAGS_boot_disk_size}" \
     --tasks "${temp_dir}/table.tsv" \
     --script "${FLAGS_docker_script}"
+
+  if [[ -n "${FLAGS_annotation_cache}" ]]; then
+    merge_annotation_cache
+  fi
 }
 
 
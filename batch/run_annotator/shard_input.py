@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Extract one shard of a VEP input file in a single pass.
+
+The input (a VCF or an ensembl format file, plain, gzip or BGZF compressed) is
+divided into num_shards ranges of roughly equal size by byte offset, and each
+line belongs to the shard whose range holds the line's first byte:
+
+* For plain files the ranges are byte ranges of the file.
+* For BGZF files the ranges are ranges of compressed block offsets.  The
+  blocks of a shard are found by seeking, and decompressed in parallel.
+* Other gzip files cannot be read from the middle, so the file is decompressed
+  from its start, but reading stops at the end of the shard.
+
+The output holds the header (the leading comment lines of the input) followed
+by the non-comment lines of the shard.  For VCF input, the genotype columns
+(everything after INFO) are removed.  Together the shards hold every line of
+the input exactly once, and the work to extract a shard is proportional to its
+size rather than the size of the input (except for non-BGZF gzip input).
+
+Instead of num_shards equal ranges, the shards may be the ranges of a plan
+written by plan_shards.py, which balances the estimated VEP cost of the shards
+and places their boundaries between contigs where it can.
+
+Example usage:
+
+python shard_input.py \
+    --input variants.vcf.gz \
+    --output /mnt/data/input_file \
+    --num_shards 10 \
+    --shard_index 3
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import os
+import zlib
+
+import bgzf_utils
+
+_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Number of compressed bytes of non-BGZF gzip input decompressed at a time.
+# This is the granularity of shard boundaries for such input.
+_GZIP_FEED_SIZE = 256 * 1024
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+# Number of tab-separated VCF columns to keep: CHROM through INFO.
+_VCF_COLUMNS = 8
+
+
+def _iter_plain_pieces(f, start, end):
+  """Yields (offset, data) pieces of a plain file from start to its end.
+
+  Pieces never straddle end, so every line starting before end belongs to a
+  piece whose offset is before end.
+  """
+  if start > 0:
+    # Pass the preceding byte to show whether a line begins at start.
+    f.seek(start - 1)
+    yield start - 1, f.read(1)
+  else:
+    f.seek(0)
+  offset = start
+  while True:
+    size = _CHUNK_SIZE if offset >= end else min(_CHUNK_SIZE, end - offset)
+    data = f.read(size)
+    if not data:
+      return
+    yield offset, data
+    offset += len(data)
+
+
+def _iter_bgzf_pieces(f, start, threads):
+  """Yields (block_offset, data) pieces of a BGZF file.
+
+  The first piece is the block before the one containing start, which shows
+  whether a line begins in the first block at or after start.
+  """
+  first = bgzf_utils.find_block_start(f, start)
+  if first > 0:
+    first = bgzf_utils.find_block_start(f, first - 1)
+  for piece in bgzf_utils.iter_decompressed_blocks(f, first, threads=threads):
+    yield piece
+
+
+def _iter_gzip_pieces(f):
+  """Yields (compressed_offset, data) pieces of a gzip file from its start.
+
+  The pieces are the output of decompressing fixed-size chunks of the file, so
+  every shard assigns lines to the same offsets.
+  """
+  f.seek(0)
+  decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  offset = 0
+  while True:
+    chunk = f.read(_GZIP_FEED_SIZE)
+    if not chunk:
+      return
+    data = []
+    while chunk:
+      data.append(decompressor.decompress(chunk))
+      chunk = decompressor.unused_data
+      if chunk or decompressor.eof:
+        # Start of the next gzip member, if any.
+        data.append(decompressor.flush())
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    yield offset, b"".join(data)
+    offset += _GZIP_FEED_SIZE
+
+
+def iter_owned_lines(pieces, start, end):
+  """Yields the complete lines whose first byte is in a piece in [start, end).
+
+  Args:
+    pieces: Iterable of (offset, data) in file order.  The first piece must
+        either begin a line or have an offset before start.
+    start: First offset of the shard.
+    end: Offset past the end of the shard.
+
+  Yields:
+    Blocks of one or more complete lines, each ending with a newline.
+  """
+  carry = b""
+  carry_offset = None
+  for offset, data in pieces:
+    if carry:
+      newline = data.find(b"\n")
+      if newline < 0:
+        carry += data
+        continue
+      if start <= carry_offset < end:
+        yield carry + data[:newline + 1]
+      carry = b""
+      data = data[newline + 1:]
+    if offset >= end:
+      return
+    cut = data.rfind(b"\n") + 1
+    if cut and offset >= start:
+      yield data[:cut]
+    if cut < len(data):
+      carry = data[cut:]
+      carry_offset = offset
+  if carry and start <= carry_offset < end:
+    yield carry + b"\n"
+
+
+def read_header(f, compression):
+  """Returns the leading comment lines of the input."""
+  f.seek(0)
+  if compression == "plain":
+    pieces = ((0, data) for data in iter(lambda: f.read(_CHUNK_SIZE), b""))
+  elif compression == "bgzf":
+    pieces = bgzf_utils.iter_decompressed_blocks(f, 0, threads=1)
+  else:
+    pieces = _iter_gzip_pieces(f)
+
+  header = []
+  for lines in iter_owned_lines(pieces, 0, float("inf")):
+    pos = 0
+    while pos < len(lines) and lines[pos:pos + 1] == b"#":
+      pos = lines.index(b"\n", pos) + 1
+    header.append(lines[:pos])
+    if pos < len(lines):
+      break
+  return b"".join(header)
+
+
+def cut_vcf_columns(lines):
+  """Removes the columns after INFO from a block of VCF lines."""
+  out = []
+  for line in lines.split(b"\n")[:-1]:
+    pos = -1
+    for _ in range(_VCF_COLUMNS):
+      pos = line.find(b"\t", pos + 1)
+      if pos < 0:
+        break
+    out.append(line if pos < 0 else line[:pos])
+  out.append(b"")
+  return b"\n".join(out)
+
+
+def _drop_comments(lines):
+  if not lines.startswith(b"#") and b"\n#" not in lines:
+    return lines
+  return b"".join(
+      line for line in lines.splitlines(True) if not line.startswith(b"#"))
+
+
+def detect_compression(path):
+  """Returns "bgzf", "gzip" or "plain" for the file at path."""
+  if bgzf_utils.is_bgzf(path):
+    return "bgzf"
+  with open(path, "rb") as f:
+    if f.read(2) == _GZIP_MAGIC:
+      return "gzip"
+  return "plain"
+
+
+def iter_pieces(f, compression, start=0, end=float("inf"), threads=4):
+  """Yields the (offset, data) pieces of the input from around start.
+
+  Args:
+    f: The input file, opened in binary mode.
+    compression: "plain", "bgzf" or "gzip", see detect_compression.
+    start: First offset of the lines wanted.
+    end: Offset past the end of the lines wanted.  Pieces may go on past it.
+    threads: Number of threads decompressing BGZF blocks.
+
+  Returns:
+    An iterator of pieces to pass to iter_owned_lines with start and end.
+  """
+  if compression == "plain":
+    return _iter_plain_pieces(f, start, end)
+  elif compression == "bgzf":
+    return _iter_bgzf_pieces(f, start, threads)
+  return _iter_gzip_pieces(f)
+
+
+def write_range(path, outfile, start, end, is_vcf, threads=4):
+  """Writes the header and the lines owned by the offsets [start, end).
+
+  Offsets are byte offsets of a plain file, compressed block offsets of a BGZF
+  file, and multiples of the feed size of other gzip files, as described
+  above.  plan_shards.py chooses ranges in the same terms.
+
+  Args:
+    path: Path to the plain, gzip or BGZF compressed input file.
+    outfile: Binary file-like object to which the lines are written.
+    start: First offset of the range.
+    end: Offset past the end of the range.
+    is_vcf: Whether to remove the VCF columns after INFO.
+    threads: Number of threads decompressing BGZF blocks.
+
+  Returns:
+    The number of bytes written.
+  """
+  compression = detect_compression(path)
+  written = 0
+  with open(path, "rb") as f:
+    header = read_header(f, compression)
+    if is_vcf:
+      header = cut_vcf_columns(header)
+    outfile.write(header)
+    written += len(header)
+
+    pieces = iter_pieces(f, compression, start, end, threads)
+    for lines in iter_owned_lines(pieces, start, end):
+      lines = _drop_comments(lines)
+      if is_vcf:
+        lines = cut_vcf_columns(lines)
+      outfile.write(lines)
+      written += len(lines)
+  return written
+
+
+def write_shard(path, outfile, num_shards, shard_index, is_vcf, threads=4):
+  """Writes the header and the lines of one shard of the input.
+
+  Args:
+    path: Path to the plain, gzip or BGZF compressed input file.
+    outfile: Binary file-like object to which the shard is written.
+    num_shards: Total number of shards.
+    shard_index: 1-based index of the shard to write.
+    is_vcf: Whether to remove the VCF columns after INFO.
+    threads: Number of threads decompressing BGZF blocks.
+
+  Returns:
+    The number of bytes written.
+  """
+  file_size = os.path.getsize(path)
+  start = file_size * (shard_index - 1) // num_shards
+  end = file_size * shard_index // num_shards
+  return write_range(path, outfile, start, end, is_vcf, threads=threads)
+
+
+def read_plan_range(plan_path, shard_index):
+  """Returns the (start, end) offsets of a shard of a plan_shards.py plan."""
+  with open(plan_path, "r") as f:
+    header = f.readline().rstrip("\n").split("\t")
+    for line in f:
+      row = dict(zip(header, line.rstrip("\n").split("\t")))
+      if int(row["SHARD_INDEX"]) == shard_index:
+        return int(row["START"]), int(row["END"])
+  raise ValueError("Shard %d is not in plan %s" % (shard_index, plan_path))
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      "--input",
+      required=True,
+      help="Plain, gzip or BGZF compressed VCF or ensembl format file.")
+  parser.add_argument(
+      "--output",
+      required=True,
+      help="Path to which to write the uncompressed shard.")
+  parser.add_argument(
+      "--num_shards",
+      type=int,
+      default=1,
+      help="The number of shards.")
+  parser.add_argument(
+      "--shard_index",
+      type=int,
+      default=1,
+      help="The shard to extract, from 1 to num_shards (inclusive).")
+  parser.add_argument(
+      "--format",
+      choices=("vcf", "ensembl"),
+      help="Format of the input.  If omitted, files named *.vcf or *.vcf.gz "
+      "are VCF and all others are ensembl format.")
+  parser.add_argument(
+      "--threads",
+      type=int,
+      default=4,
+      help="Number of threads decompressing BGZF input.")
+  parser.add_argument(
+      "--plan",
+      help="Shard plan written by plan_shards.py for this input.  If given, "
+      "the shard is the range of the plan with index --shard_index, and "
+      "--num_shards is ignored.")
+  args = parser.parse_args()
+
+  if args.plan is None and not 1 <= args.shard_index <= args.num_shards:
+    parser.error("--shard_index must be between 1 and --num_shards.")
+
+  is_vcf = args.format == "vcf" or (
+      args.format is None and args.input.endswith((".vcf", ".vcf.gz")))
+  with open(args.output, "wb") as outfile:
+    if args.plan:
+      start, end = read_plan_range(args.plan, args.shard_index)
+      write_range(args.input, outfile, start, end, is_vcf,
+                  threads=args.threads)
+    else:
+      write_shard(args.input, outfile, args.num_shards, args.shard_index,
+                  is_vcf, threads=args.threads)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Extract the regions of a tabix-indexed file as a smaller indexed file.
+
+The VEP workers would otherwise each copy all of dbNSFP (tens of GB) although
+a shard usually covers a small part of the genome.  This reads the tabix index
+of the file, finds the chunks of the file holding the records of the regions
+wanted, and reads just those byte ranges, from a local file or directly from
+Cloud Storage with "gsutil cat -r".  The output is a self-contained BGZF file
+holding the header lines and the records of the chunks (which may include a
+few records outside the regions), and its tabix index.
+
+Whole compressed blocks are copied from the input; only the blocks at either
+end of a chunk, which hold data outside it, are decompressed and compressed
+again.
+
+The regions may be given directly, or be the regions covered by the records of
+a VCF or ensembl format VEP input, such as a shard written by shard_input.py.
+
+Example usage:
+
+python slice_tabix.py \
+    --input gs://bucket/dbNSFP/dbNSFP.gz \
+    --regions_from /mnt/data/input_file \
+    --output /mnt/data/tmp/dbNSFP.gz
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import collections
+import io
+import logging
+import re
+import subprocess
+import sys
+
+import bgzf_utils
+import plan_shards
+import tabix_utils
+
+# Regions closer than this are read as one region.
+_MERGE_DISTANCE = 100000
+
+Region = collections.namedtuple("Region", ["name", "begin", "end"])
+
+
+class LocalReader(object):
+  """Reads byte ranges of a local file."""
+
+  def __init__(self, path):
+    self._f = open(path, "rb")
+
+  def read(self, offset, size):
+    self._f.seek(offset)
+    return self._f.read(size)
+
+
+class GcsReader(object):
+  """Reads byte ranges of a Cloud Storage object with gsutil."""
+
+  def __init__(self, path):
+    self.path = path
+
+  def read(self, offset, size):
+    return subprocess.check_output(
+        ["gsutil", "-q", "cat", "-r", "%d-%d" % (offset, offset + size - 1),
+         self.path])
+
+
+def open_reader(path):
+  return GcsReader(path) if path.startswith("gs://") else LocalReader(path)
+
+
+def read_blocks(reader, first, last):
+  """Returns the (offset, block) of the blocks from first to last inclusive.
+
+  Args:
+    reader: A LocalReader or GcsReader.
+    first: File offset of the first block.
+    last: File offset of the last block.
+  """
+  data = reader.read(first, last - first + bgzf_utils.MAX_BLOCK_SIZE)
+  blocks = []
+  pos = 0
+  while pos <= last - first:
+    size = bgzf_utils.block_size(data[pos:pos + bgzf_utils.MAX_BLOCK_SIZE])
+    if size is None or pos + size > len(data):
+      raise ValueError("Invalid BGZF block at offset %d" % (first + pos))
+    blocks.append((first + pos, data[pos:pos + size]))
+    pos += size
+  return blocks
+
+
+def read_header(reader, index):
+  """Returns the leading header lines of the file, as uncompressed bytes."""
+  header = []
+  lines_seen = 0
+  offset = 0
+  partial = b""
+  while True:
+    (_, block), = read_blocks(reader, offset, offset)
+    offset += len(block)
+    data = bgzf_utils.decompress_block(block)
+    if not data:
+      return b"".join(header)
+    lines = (partial + data).split(b"\n")
+    partial = lines.pop()
+    for line in lines:
+      lines_seen += 1
+      if lines_seen > index.skip and not line.startswith(index.meta):
+        return b"".join(header)
+      header.append(line + b"\n")
+
+
+def copy_chunk(reader, chunk, writer, builder):
+  """Copies the data of a chunk to the output.
+
+  Args:
+    reader: Reader of the input.
+    chunk: The tabix_utils.Chunk to copy.
+    writer: bgzf_utils.BgzfWriter of the output.
+    builder: tabix_utils.IndexBuilder to which the blocks written are added.
+
+  Returns:
+    The number of blocks copied without compressing them again.
+  """
+  first, first_within = bgzf_utils.split_virtual_offset(chunk.begin)
+  last, last_within = bgzf_utils.split_virtual_offset(chunk.end)
+  copied = 0
+  for offset, block in read_blocks(reader, first, last):
+    data = bgzf_utils.decompress_block(block)
+    start = first_within if offset == first else 0
+    end = last_within if offset == last else len(data)
+    if start == 0 and end == len(data):
+      builder.add_block(writer.write_block(block), data)
+      copied += 1
+    elif start < end:
+      for new_offset, new_data in writer.write(data[start:end]):
+        builder.add_block(new_offset, new_data)
+  return copied
+
+
+def merge_regions(regions, index):
+  """Returns the chunks of the file holding the records of the regions."""
+  chunks = []
+  for region in regions:
+    ref_index = index.find_name(region.name)
+    if ref_index is None:
+      logging.warning("%s is not in the index", region.name.decode("utf-8"))
+      continue
+    chunks.extend(index.query(ref_index, region.begin, region.end))
+  return tabix_utils.merge_chunks(chunks)
+
+
+def parse_region(text):
+  """Returns the Region of chrom:begin-end (1-based, inclusive) or chrom."""
+  match = re.match(r"^([^:]+)(?::([\d,]+)-([\d,]+))?$", text)
+  if not match:
+    raise ValueError("Invalid region %r" % text)
+  name, begin, end = match.groups()
+  if begin is None:
+    return Region(name.encode("utf-8"), 0, 1 << 29)
+  return Region(name.encode("utf-8"), int(begin.replace(",", "")) - 1,
+                int(end.replace(",", "")))
+
+
+def _add_region(regions, region):
+  """Adds a region to a list of regions of a contig, merging if it is near."""
+  if regions and (regions[-1].begin - _MERGE_DISTANCE <= region.begin <=
+                  regions[-1].end + _MERGE_DISTANCE):
+    regions[-1] = Region(region.name, min(regions[-1].begin, region.begin),
+                         max(regions[-1].end, region.end))
+  else:
+    regions.append(region)
+
+
+def regions_of_input(path, is_vcf, padding):
+  """Returns the regions covered by the records of a VEP input.
+
+  Records are grouped by contig, and records of a contig less than
+  _MERGE_DISTANCE bases apart form one region, padded by padding bases.  The
+  columns of ensembl format records may be separated by tabs or spaces.
+
+  Raises:
+    ValueError: If a record cannot be parsed.
+  """
+  regions = collections.defaultdict(list)
+  with open(path, "rb") as f:
+    for line_number, line in enumerate(f, 1):
+      if line.startswith(b"#") or not line.strip():
+        continue
+      try:
+        chrom, start, end = plan_shards.parse_record(line, is_vcf)[:3]
+      except ValueError:
+        raise ValueError("Cannot parse %s line %d: %r" %
+                         (path, line_number, line[:200]))
+      _add_region(regions[chrom],
+                  Region(chrom, max(0, start - 1 - padding),
+                         max(start, end) + padding))
+
+  # Merge again in case the input was not sorted.
+  merged = []
+  for chrom in sorted(regions):
+    chrom_regions = []
+    for region in sorted(regions[chrom]):
+      _add_region(chrom_regions, region)
+    merged.extend(chrom_regions)
+  return merged
+
+
+def slice_file(reader, index, regions, outfile, index_file):
+  """Writes the header and the chunks of the regions, and their index.
+
+  Args:
+    reader: Reader of the input.
+    index: The TabixIndex of the input.
+    regions: List of Region.
+    outfile: Binary file object for the BGZF output.
+    index_file: Binary file object for the tabix index of the output.
+
+  Returns:
+    A tuple of (number of blocks written, number of blocks copied).
+  """
+  writer = bgzf_utils.BgzfWriter(outfile)
+  builder = tabix_utils.IndexBuilder(index)
+  for offset, data in writer.write(read_header(reader, index)):
+    builder.add_block(offset, data)
+  copied = 0
+  for chunk in merge_regions(regions, index):
+    copied += copy_chunk(reader, chunk, writer, builder)
+  blocks = writer.num_blocks
+  writer.close()
+  builder.finish().write(index_file)
+  return blocks, copied
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      "--input",
+      required=True,
+      help="BGZF compressed, tabix-indexed file, local or on Cloud Storage.")
+  parser.add_argument(
+      "--index", help="The tabix index of the input.  Defaults to INPUT.tbi.")
+  parser.add_argument(
+      "--output",
+      required=True,
+      help="Path to which to write the slice.  Its index is written to "
+      "OUTPUT.tbi.")
+  parser.add_argument(
+      "--region",
+      action="append",
+      default=[],
+      help="A region to extract, as chrom or chrom:begin-end (1-based, "
+      "inclusive).  May be repeated.")
+  parser.add_argument(
+      "--regions_from",
+      help="VCF or ensembl format VEP input whose regions to extract.")
+  parser.add_argument(
+      "--format",
+      choices=("vcf", "ensembl"),
+      help="Format of --regions_from.  If omitted, files named *.vcf are VCF "
+      "and all others are ensembl format.")
+  parser.add_argument(
+      "--padding",
+      type=int,
+      default=1000,
+      help="Bases added to either side of the regions of --regions_from.")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+
+  index_path = args.index or args.input + ".tbi"
+  if index_path.startswith("gs://"):
+    index_data = subprocess.check_output(["gsutil", "-q", "cat", index_path])
+  else:
+    with open(index_path, "rb") as f:
+      index_data = f.read()
+  index = tabix_utils.TabixIndex.read(io.BytesIO(index_data))
+
+  regions = [parse_region(region) for region in args.region]
+  if args.regions_from:
+    is_vcf = args.format == "vcf" or (
+        args.format is None and args.regions_from.endswith(".vcf"))
+    regions.extend(regions_of_input(args.regions_from, is_vcf, args.padding))
+  if not regions:
+    parser.error("--region or --regions_from is required.")
+
+  with open(args.output, "wb") as outfile:
+    with open(args.output + ".tbi", "wb") as index_file:
+      blocks, copied = slice_file(open_reader(args.input), index, regions,
+                                  outfile, index_file)
+  print("Wrote %d regions in %d blocks, %d of them copied without "
+        "compressing them again" % (len(regions), blocks, copied),
+        file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Record where the time of VEP tasks goes, and summarize it for a run.
+
+The docker script runs each stage of a task (sharding the input, localizing
+dbNSFP, VEP, loading into BigQuery, ...) with the "run" command, which
+appends a JSON record of the stage to a local metrics file: its wall-clock
+and CPU seconds, its peak resident memory (the sum over all of its processes,
+such as VEP's forked workers, sampled while it runs, and the peak of its
+largest process), the bytes of its input and output files, the number of
+records it processed and the disk space in use when it finished.  The report
+of a task also holds the peak memory use of its container, from its cgroup.  A stage may be run more than once (for
+example once per file loaded); its records are added together.
+
+At the end of the task, the "report" command prints one line to stdout:
+
+  VEP_TASK_METRICS {"table": ..., "shard_index": ..., "stages": {...}, ...}
+
+so the records of every task of a run end up in the dsub logging directory.
+The "aggregate" command reads those logs and reports, for the whole run, the
+percentiles of each stage's time and memory, the largest disk use, and the
+straggler tasks that took much longer than the median, which is what is
+needed to choose --shards_per_file, --min_gb_ram and --disk_size.
+
+Example usage:
+
+python stage_metrics.py run --metrics metrics.json --stage vep \
+    --input input_file --output output.json --records input_file -- \
+    vep --cache ...
+
+python stage_metrics.py report --metrics metrics.json \
+    --field table=annotations --field shard_index=3 \
+    --warnings output.json_warnings.txt
+
+python stage_metrics.py aggregate gs://bucket/temp/logging/
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+# The prefix of the line holding the metrics of a task in its stdout log.
+MARKER = "VEP_TASK_METRICS "
+
+# The directory whose disk use is recorded.
+_DATA_DIR = "/mnt/data"
+
+_PERCENTILES = (50, 90, 99)
+
+# Seconds between samples of the memory of a stage's processes.
+_SAMPLE_SECONDS = 0.5
+
+# Files holding the peak memory use of the container, for cgroup v2 and v1.
+_CGROUP_PEAK_PATHS = ("/sys/fs/cgroup/memory.peak",
+                      "/sys/fs/cgroup/memory/memory.max_usage_in_bytes")
+
+
+def _path_bytes(path):
+  """Returns the size of a file, or of the files under a directory."""
+  if os.path.isdir(path):
+    return sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(path) for name in names)
+  if os.path.exists(path):
+    return os.path.getsize(path)
+  return 0
+
+
+def _count_records(path):
+  """Returns the number of lines of a file that are not comments."""
+  if not os.path.exists(path):
+    return 0
+  with open(path, "rb") as f:
+    return sum(1 for line in f if not line.startswith(b"#"))
+
+
+def _disk_used_bytes(path):
+  if not os.path.isdir(path):
+    return None
+  stat = os.statvfs(path)
+  return (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+
+def _process_tree_rss_bytes(pid):
+  """Returns the summed resident memory of a process and its descendants.
+
+  Returns None if /proc cannot be read.
+  """
+  children = collections.defaultdict(list)
+  rss_pages = {}
+  try:
+    names = os.listdir("/proc")
+  except OSError:
+    return None
+  for name in names:
+    if not name.isdigit():
+      continue
+    try:
+      with open("/proc/%s/stat" % name, "rb") as f:
+        stat = f.read()
+    except (IOError, OSError):
+      # The process exited.
+      continue
+    # The command name may hold spaces, so parse the fields after it.
+    fields = stat[stat.rfind(b")") + 2:].split()
+    children[int(fields[1])].append(int(name))
+    rss_pages[int(name)] = int(fields[21])
+  if pid not in rss_pages:
+    return 0
+  total = 0
+  pending = [pid]
+  while pending:
+    process = pending.pop()
+    total += rss_pages.get(process, 0)
+    pending.extend(children.get(process, ()))
+  return total * os.sysconf("SC_PAGE_SIZE")
+
+
+class _TreeMemorySampler(object):
+  """Samples the summed resident memory of a process tree in a thread."""
+
+  def __init__(self, pid, interval=_SAMPLE_SECONDS):
+    self.pid = pid
+    self.interval = interval
+    self.peak_bytes = None
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+
+  def _run(self):
+    while True:
+      rss_bytes = _process_tree_rss_bytes(self.pid)
+      if rss_bytes is not None:
+        self.peak_bytes = max(self.peak_bytes or 0, rss_bytes)
+      if self._stop.wait(self.interval):
+        return
+
+  def start(self):
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    self._thread.join()
+
+
+def container_peak_bytes():
+  """Returns the peak memory use of this container, or None if unknown."""
+  for path in _CGROUP_PEAK_PATHS:
+    try:
+      with open(path, "r") as f:
+        return int(f.read())
+    except (IOError, OSError, ValueError):
+      continue
+  return None
+
+
+def run_stage(command, stage, inputs=(), outputs=(), records=None,
+              data_dir=_DATA_DIR):
+  """Runs a command and returns (exit code, record of the stage).
+
+  The CPU time is that of the command and every process it waited for, such
+  as VEP's forked workers.  peak_rss_bytes is the largest sampled sum of the
+  resident memory of all of those processes, or the peak of the largest of
+  them, max_process_rss_bytes, if that is larger (or /proc is unavailable).
+  """
+  input_bytes = sum(_path_bytes(path) for path in inputs)
+  before = resource.getrusage(resource.RUSAGE_CHILDREN)
+  start = time.time()
+  process = subprocess.Popen(command)
+  sampler = _TreeMemorySampler(process.pid)
+  sampler.start()
+  try:
+    exit_code = process.wait()
+  finally:
+    sampler.stop()
+  wall_seconds = time.time() - start
+  after = resource.getrusage(resource.RUSAGE_CHILDREN)
+  # Kilobytes on Linux.
+  max_process_rss_bytes = after.ru_maxrss * 1024
+
+  return exit_code, {
+      "stage": stage,
+      "exit_code": exit_code,
+      "wall_seconds": wall_seconds,
+      "cpu_seconds": (after.ru_utime - before.ru_utime +
+                      after.ru_stime - before.ru_stime),
+      "peak_rss_bytes": max(sampler.peak_bytes or 0, max_process_rss_bytes),
+      "max_process_rss_bytes": max_process_rss_bytes,
+      "input_bytes": input_bytes,
+      "output_bytes": sum(_path_bytes(path) for path in outputs),
+      "records": _count_records(records) if records else None,
+      "disk_used_bytes": _disk_used_bytes(data_dir),
+  }
+
+
+def merge_stages(records):
+  """Adds up the records of each stage, in the order the stages first ran.
+
+  Returns:
+    An OrderedDict from stage name to its totals, with the largest peak RSS
+    and disk use, and records per second if records were counted.
+  """
+  stages = collections.OrderedDict()
+  for record in records:
+    total = stages.setdefault(record["stage"], {
+        "runs": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+        "peak_rss_bytes": 0, "max_process_rss_bytes": 0, "input_bytes": 0,
+        "output_bytes": 0,
+        "records": None, "disk_used_bytes": None, "failed": 0})
+    total["runs"] += 1
+    total["failed"] += 1 if record["exit_code"] else 0
+    for field in ("wall_seconds", "cpu_seconds", "input_bytes",
+                  "output_bytes"):
+      total[field] += record[field]
+    for field in ("peak_rss_bytes", "max_process_rss_bytes",
+                  "disk_used_bytes"):
+      if record.get(field) is not None:
+        total[field] = max(total[field] or 0, record[field])
+    if record.get("records") is not None:
+      total["records"] = (total["records"] or 0) + record["records"]
+  for total in stages.values():
+    if total["records"] is not None and total["wall_seconds"] > 0:
+      total["records_per_second"] = total["records"] / total["wall_seconds"]
+  return stages
+
+
+def task_report(records, fields, warnings_path=None):
+  """Returns the metrics of a task: its fields, stages and totals."""
+  report = collections.OrderedDict(fields)
+  stages = merge_stages(records)
+  report["stages"] = stages
+  report["wall_seconds"] = sum(s["wall_seconds"] for s in stages.values())
+  report["cpu_seconds"] = sum(s["cpu_seconds"] for s in stages.values())
+  report["peak_rss_bytes"] = max(
+      [s["peak_rss_bytes"] for s in stages.values()] or [0])
+  report["container_peak_bytes"] = container_peak_bytes()
+  report["disk_used_bytes"] = max(
+      [s["disk_used_bytes"] or 0 for s in stages.values()] or [0])
+  report["num_cores"] = os.sysconf("SC_NPROCESSORS_ONLN")
+  report["memory_bytes"] = (os.sysconf("SC_PAGE_SIZE") *
+                            os.sysconf("SC_PHYS_PAGES"))
+  if warnings_path:
+    report["vep_warnings"] = _count_records(warnings_path)
+  return report
+
+
+def percentile(values, p):
+  """Returns the p-th percentile of values, interpolating between ranks."""
+  values = sorted(values)
+  if not values:
+    return None
+  rank = (len(values) - 1) * p / 100
+  low = int(rank)
+  high = min(low + 1, len(values) - 1)
+  return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def _iter_log_lines(paths):
+  """Yields the lines of local files, directories or gs:// paths."""
+  for path in paths:
+    if path.startswith("gs://"):
+      listing = [path]
+      if not path.endswith(".log"):
+        listing = subprocess.check_output(
+            ["gsutil", "ls", path.rstrip("/") + "/**"]).decode("utf-8").split()
+      for name in listing:
+        if name.endswith(".log"):
+          for line in subprocess.check_output(
+              ["gsutil", "cat", name]).decode("utf-8").splitlines():
+            yield line
+    elif os.path.isdir(path):
+      for directory, _, names in os.walk(path):
+        for name in sorted(names):
+          for line in _iter_log_lines([os.path.join(directory, name)]):
+            yield line
+    else:
+      with open(path, "r") as f:
+        for line in f:
+          yield line
+
+
+def read_task_reports(paths):
+  """Returns the task reports found in dsub logs."""
+  # dsub writes stdout to two logs of each task.
+  seen = set()
+  reports = []
+  for line in _iter_log_lines(paths):
+    position = line.find(MARKER)
+    if position >= 0:
+      text = line[position + len(MARKER):].strip()
+      if text not in seen:
+        seen.add(text)
+        reports.append(json.loads(text))
+  return reports
+
+
+def _distribution(values):
+  distribution = collections.OrderedDict()
+  for p in _PERCENTILES:
+    distribution["p%d" % p] = percentile(values, p)
+  distribution["max"] = max(values) if values else None
+  return distribution
+
+
+def aggregate(reports, straggler_factor=2.0):
+  """Returns the summary of the task reports of a run.
+
+  Args:
+    reports: List of task reports.
+    straggler_factor: Tasks taking more than this times the median wall-clock
+        time are reported as stragglers.
+
+  Returns:
+    A dict with the number of tasks, the distribution of the wall-clock time,
+    peak RSS, container peak memory and disk use of the tasks, the distributions of each stage, and
+    the stragglers, slowest first.
+  """
+  summary = collections.OrderedDict()
+  summary["tasks"] = len(reports)
+  summary["failed_tasks"] = sum(
+      1 for report in reports
+      if any(stage["failed"] for stage in report["stages"].values()))
+  for field in ("wall_seconds", "cpu_seconds", "peak_rss_bytes",
+                "container_peak_bytes", "disk_used_bytes"):
+    # Reports of older tasks may lack a field.
+    summary[field] = _distribution([report[field] for report in reports
+                                    if report.get(field) is not None])
+
+  stage_names = []
+  for report in reports:
+    for name in report["stages"]:
+      if name not in stage_names:
+        stage_names.append(name)
+  stages = collections.OrderedDict()
+  for name in stage_names:
+    stage_reports = [report["stages"][name] for report in reports
+                     if name in report["stages"]]
+    stage = collections.OrderedDict()
+    for field in ("wall_seconds", "cpu_seconds", "peak_rss_bytes"):
+      stage[field] = _distribution([s[field] for s in stage_reports])
+    rates = [s["records_per_second"] for s in stage_reports
+             if "records_per_second" in s]
+    if rates:
+      stage["records_per_second"] = _distribution(rates)
+    stages[name] = stage
+  summary["stages"] = stages
+
+  median = percentile([report["wall_seconds"] for report in reports], 50)
+  stragglers = [report for report in reports
+                if median and report["wall_seconds"] > straggler_factor * median]
+  stragglers.sort(key=lambda report: -report["wall_seconds"])
+  summary["stragglers"] = [
+      collections.OrderedDict(
+          [(key, report.get(key)) for key in
+           ("table", "input_file", "shard_index", "wall_seconds")] +
+          [("slowest_stage", max(report["stages"].items(),
+                                 key=lambda item: item[1]["wall_seconds"])[0])])
+      for report in stragglers]
+  return summary
+
+
+def format_summary(summary):
+  """Returns a human-readable form of an aggregate summary."""
+
+  def row(label, distribution, scale=1.0, unit=""):
+    return "  %-24s" % label + "".join(
+        "%10s" % ("-" if value is None else "%.1f%s" % (value / scale, unit))
+        for value in distribution.values())
+
+  gib = float(1 << 30)
+  header = "  %-24s" % "" + "".join(
+      "%10s" % name for name in [("p%d" % p) for p in _PERCENTILES] + ["max"])
+  lines = ["%d tasks (%d failed)" % (summary["tasks"],
+                                     summary["failed_tasks"]), header,
+           row("task wall seconds", summary["wall_seconds"]),
+           row("task cpu seconds", summary["cpu_seconds"]),
+           row("task peak RSS GiB", summary["peak_rss_bytes"], gib),
+           row("container peak GiB", summary["container_peak_bytes"], gib),
+           row("task disk used GiB", summary["disk_used_bytes"], gib)]
+  for name, stage in summary["stages"].items():
+    lines.append(row("%s wall seconds" % name, stage["wall_seconds"]))
+    lines.append(row("%s peak RSS GiB" % name, stage["peak_rss_bytes"], gib))
+    if "records_per_second" in stage:
+      lines.append(row("%s records/second" % name,
+                       stage["records_per_second"]))
+  if summary["stragglers"]:
+    lines.append("Stragglers:")
+    for straggler in summary["stragglers"]:
+      lines.append("  %s shard %s of %s: %.0f seconds, mostly in %s" % (
+          straggler["table"], straggler["shard_index"],
+          straggler["input_file"], straggler["wall_seconds"],
+          straggler["slowest_stage"]))
+  return "\n".join(lines)
+
+
+def _read_records(path):
+  if not os.path.exists(path):
+    return []
+  with open(path, "r") as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest="command")
+
+  run_parser = subparsers.add_parser(
+      "run", help="Run a command as a stage and record its metrics.")
+  run_parser.add_argument(
+      "--metrics", required=True, help="Local file of stage records.")
+  run_parser.add_argument("--stage", required=True, help="Name of the stage.")
+  run_parser.add_argument(
+      "--input", action="append", default=[],
+      help="File or directory read by the stage.  May be repeated.")
+  run_parser.add_argument(
+      "--output", action="append", default=[],
+      help="File or directory written by the stage.  May be repeated.")
+  run_parser.add_argument(
+      "--records",
+      help="File whose non-comment lines are the records of the stage.")
+  run_parser.add_argument(
+      "command_line", nargs=argparse.REMAINDER,
+      help="The command to run, after --.")
+
+  report_parser = subparsers.add_parser(
+      "report", help="Print the metrics of a task to stdout.")
+  report_parser.add_argument(
+      "--metrics", required=True, help="Local file of stage records.")
+  report_parser.add_argument(
+      "--field", action="append", default=[],
+      help="NAME=VALUE to include in the report.  May be repeated.")
+  report_parser.add_argument(
+      "--warnings", help="File of VEP warnings, whose lines are counted.")
+
+  aggregate_parser = subparsers.add_parser(
+      "aggregate", help="Summarize the task metrics in dsub logs.")
+  aggregate_parser.add_argument(
+      "logs", nargs="+",
+      help="dsub log files or directories, local or on Cloud Storage.")
+  aggregate_parser.add_argument(
+      "--straggler_factor", type=float, default=2.0,
+      help="Report tasks taking more than this times the median time.")
+  aggregate_parser.add_argument(
+      "--json", action="store_true", help="Print the summary as JSON.")
+
+  args = parser.parse_args(argv)
+
+  if args.command == "run":
+    command = args.command_line
+    if command and command[0] == "--":
+      command = command[1:]
+    if not command:
+      parser.error("A command to run is required.")
+    exit_code, record = run_stage(command, args.stage, args.input,
+                                  args.output, args.records)
+    with open(args.metrics, "a") as f:
+      f.write(json.dumps(record) + "\n")
+    sys.exit(exit_code)
+  elif args.command == "report":
+    fields = [field.split("=", 1) for field in args.field]
+    report = task_report(_read_records(args.metrics), fields, args.warnings)
+    print(MARKER + json.dumps(report))
+  elif args.command == "aggregate":
+    reports = read_task_reports(args.logs)
+    if not reports:
+      sys.exit("No task metrics found in %s" % " ".join(args.logs))
+    summary = aggregate(reports, args.straggler_factor)
+    if args.json:
+      print(json.dumps(summary, indent=2))
+    else:
+      print(format_summary(summary))
+  else:
+    parser.error("A command is required.")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,301 @@
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Library to read, query and write tabix (.tbi) indexes.
+
+A tabix index divides each contig into a hierarchy of bins (the UCSC binning
+scheme) and records, for each bin, the chunks of the BGZF file, as ranges of
+virtual offsets, holding the records that fall in the bin.  A linear index
+records, for each 16 KiB window of a contig, the virtual offset of the first
+record overlapping it, which rules out most chunks of the large bins.
+
+See https://samtools.github.io/hts-specs/tabix.pdf.
+"""
+
+import collections
+import struct
+
+import bgzf_utils
+
+_MAGIC = b"TBI\x01"
+
+# The lower 16 bits of the format field.
+FORMAT_GENERIC = 0
+FORMAT_SAM = 1
+FORMAT_VCF = 2
+
+# Flag of the format field for 0-based, half-open coordinates (as in BED).
+_FORMAT_ZERO_BASED = 0x10000
+
+# Size of the windows of the linear index.
+_LINEAR_SHIFT = 14
+
+# The pseudo-bin some writers use for contig metadata.
+_META_BIN = 37450
+
+Chunk = collections.namedtuple("Chunk", ["begin", "end"])
+
+
+def reg2bins(begin, end):
+  """Returns the bins that may hold records overlapping [begin, end).
+
+  Coordinates are 0-based and end is exclusive.
+  """
+  end -= 1
+  bins = [0]
+  for shift, first_bin in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+    bins.extend(range(first_bin + (begin >> shift),
+                      first_bin + (end >> shift) + 1))
+  return bins
+
+
+def reg2bin(begin, end):
+  """Returns the smallest bin holding all of [begin, end)."""
+  end -= 1
+  for shift, first_bin in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+    if begin >> shift == end >> shift:
+      return first_bin + (begin >> shift)
+  return 0
+
+
+def merge_chunks(chunks):
+  """Returns sorted chunks with overlapping and adjacent ones merged."""
+  merged = []
+  for chunk in sorted(chunks):
+    if merged and chunk.begin <= merged[-1].end:
+      if chunk.end > merged[-1].end:
+        merged[-1] = Chunk(merged[-1].begin, chunk.end)
+    else:
+      merged.append(chunk)
+  return merged
+
+
+class TabixIndex(object):
+  """The contents of a tabix index.
+
+  Attributes:
+    format: The format field: FORMAT_GENERIC, FORMAT_SAM or FORMAT_VCF, with
+        the 0x10000 flag for 0-based coordinates.
+    col_seq: 1-based column of the contig name.
+    col_begin: 1-based column of the start position.
+    col_end: 1-based column of the end position, or 0 if there is none.
+    meta: The character that starts header lines, as bytes.
+    skip: The number of leading lines that are not records.
+    names: The contig names, as bytes, in file order.
+    bins: One dict per contig from bin to a list of Chunks.
+    linear: One list per contig of the virtual offset of the first record
+        overlapping each 16 KiB window.
+  """
+
+  def __init__(self, fmt, col_seq, col_begin, col_end, meta, skip,
+               names=None, bins=None, linear=None):
+    self.format = fmt
+    self.col_seq = col_seq
+    self.col_begin = col_begin
+    self.col_end = col_end
+    self.meta = meta
+    self.skip = skip
+    self.names = names or []
+    self.bins = bins or []
+    self.linear = linear or []
+
+  @classmethod
+  def read(cls, f):
+    """Reads the BGZF compressed index from a binary file object."""
+    data = b"".join(bgzf_utils.decompress_block(block)
+                    for _, block in bgzf_utils.iter_blocks(f, 0))
+    if data[:4] != _MAGIC:
+      raise ValueError("Not a tabix index")
+    (num_refs, fmt, col_seq, col_begin, col_end, meta, skip,
+     names_length) = struct.unpack("<8i", data[4:36])
+    pos = 36
+    names = data[pos:pos + names_length].split(b"\0")[:num_refs]
+    pos += names_length
+
+    bins = []
+    linear = []
+    for _ in range(num_refs):
+      num_bins = struct.unpack("<i", data[pos:pos + 4])[0]
+      pos += 4
+      ref_bins = {}
+      for _ in range(num_bins):
+        bin_number, num_chunks = struct.unpack("<Ii", data[pos:pos + 8])
+        pos += 8
+        offsets = struct.unpack("<%dQ" % (2 * num_chunks),
+                                data[pos:pos + 16 * num_chunks])
+        pos += 16 * num_chunks
+        if bin_number != _META_BIN:
+          ref_bins[bin_number] = [Chunk(offsets[i], offsets[i + 1])
+                                  for i in range(0, len(offsets), 2)]
+      num_windows = struct.unpack("<i", data[pos:pos + 4])[0]
+      pos += 4
+      linear.append(list(struct.unpack("<%dQ" % num_windows,
+                                       data[pos:pos + 8 * num_windows])))
+      pos += 8 * num_windows
+      bins.append(ref_bins)
+    return cls(fmt, col_seq, col_begin, col_end, struct.pack("<B", meta & 0xff),
+               skip, names, bins, linear)
+
+  def write(self, f):
+    """Writes the index, BGZF compressed, to a binary file object."""
+    parts = [_MAGIC, struct.pack(
+        "<8i", len(self.names), self.format, self.col_seq, self.col_begin,
+        self.col_end, ord(self.meta), self.skip,
+        sum(len(name) + 1 for name in self.names))]
+    parts.extend(name + b"\0" for name in self.names)
+    for ref_bins, ref_linear in zip(self.bins, self.linear):
+      parts.append(struct.pack("<i", len(ref_bins)))
+      for bin_number in sorted(ref_bins):
+        chunks = ref_bins[bin_number]
+        parts.append(struct.pack("<Ii", bin_number, len(chunks)))
+        for chunk in chunks:
+          parts.append(struct.pack("<QQ", chunk.begin, chunk.end))
+      parts.append(struct.pack("<i", len(ref_linear)))
+      parts.append(struct.pack("<%dQ" % len(ref_linear), *ref_linear))
+    writer = bgzf_utils.BgzfWriter(f)
+    writer.write(b"".join(parts))
+    writer.close()
+
+  def find_name(self, name):
+    """Returns the index of a contig, allowing for a missing "chr" prefix.
+
+    Returns:
+      The index in names, or None if the index has no such contig.
+    """
+    for candidate in (name, b"chr" + name, name[3:]
+                      if name.startswith(b"chr") else None):
+      if candidate in self.names:
+        return self.names.index(candidate)
+    return None
+
+  def query(self, ref_index, begin, end):
+    """Returns the merged chunks that may hold records overlapping a region.
+
+    Args:
+      ref_index: Index of the contig in names.
+      begin: 0-based start of the region.
+      end: 0-based, exclusive end of the region.
+    """
+    ref_linear = self.linear[ref_index]
+    min_offset = 0
+    if ref_linear:
+      min_offset = ref_linear[min(begin >> _LINEAR_SHIFT, len(ref_linear) - 1)]
+    ref_bins = self.bins[ref_index]
+    chunks = []
+    for bin_number in reg2bins(begin, end):
+      for chunk in ref_bins.get(bin_number, ()):
+        if chunk.end > min_offset:
+          chunks.append(Chunk(max(chunk.begin, min_offset), chunk.end))
+    return merge_chunks(chunks)
+
+  def record_interval(self, columns):
+    """Returns the 0-based, half-open (begin, end) of a record's columns."""
+    begin = int(columns[self.col_begin - 1])
+    if not self.format & _FORMAT_ZERO_BASED:
+      begin -= 1
+    fmt = self.format & 0xffff
+    if fmt == FORMAT_VCF:
+      return begin, begin + len(columns[3])
+    if fmt != FORMAT_GENERIC:
+      raise ValueError("Unsupported tabix format %d" % fmt)
+    if self.col_end and self.col_end != self.col_begin:
+      return begin, int(columns[self.col_end - 1])
+    return begin, begin + 1
+
+
+class IndexBuilder(object):
+  """Builds a tabix index from the records of a BGZF file in file order.
+
+  Call add_block with each block of the file and its uncompressed data, in
+  order, and then finish.
+  """
+
+  def __init__(self, template):
+    """Create IndexBuilder class.
+
+    Args:
+      template: A TabixIndex whose format, columns, meta and skip to use.
+    """
+    self.index = TabixIndex(template.format, template.col_seq,
+                            template.col_begin, template.col_end,
+                            template.meta, template.skip)
+    self._lines_seen = 0
+    self._partial = b""
+    self._partial_start = None
+
+  def add_block(self, block_offset, data):
+    """Adds the records that end in a block."""
+    pos = 0
+    while pos < len(data):
+      newline = data.find(b"\n", pos)
+      if newline < 0:
+        if not self._partial:
+          self._partial_start = bgzf_utils.make_virtual_offset(block_offset,
+                                                               pos)
+        self._partial += data[pos:]
+        return
+      if self._partial:
+        line = self._partial + data[pos:newline]
+        start = self._partial_start
+        self._partial = b""
+      else:
+        line = data[pos:newline]
+        start = bgzf_utils.make_virtual_offset(block_offset, pos)
+      pos = newline + 1
+      self._add_record(line, start,
+                       bgzf_utils.make_virtual_offset(block_offset, pos))
+
+  def _add_record(self, line, start, end):
+    self._lines_seen += 1
+    if self._lines_seen <= self.index.skip or line.startswith(self.index.meta):
+      return
+    columns = line.rstrip(b"\r").split(b"\t")
+    name = columns[self.index.col_seq - 1]
+    index = self.index
+    if not index.names or index.names[-1] != name:
+      if name in index.names:
+        raise ValueError("Records of %r are not contiguous" % name)
+      index.names.append(name)
+      index.bins.append({})
+      index.linear.append([])
+    begin, end_position = index.record_interval(columns)
+    end_position = max(end_position, begin + 1)
+
+    chunks = index.bins[-1].setdefault(reg2bin(begin, end_position), [])
+    if chunks and chunks[-1].end == start:
+      chunks[-1] = Chunk(chunks[-1].begin, end)
+    else:
+      chunks.append(Chunk(start, end))
+
+    linear = index.linear[-1]
+    last_window = (end_position - 1) >> _LINEAR_SHIFT
+    if len(linear) <= last_window:
+      linear.extend([None] * (last_window + 1 - len(linear)))
+    for window in range(begin >> _LINEAR_SHIFT, last_window + 1):
+      if linear[window] is None:
+        linear[window] = start
+
+  def finish(self):
+    """Returns the TabixIndex of the records added."""
+    if self._partial:
+      raise ValueError("The last record does not end with a newline")
+    for linear in self.index.linear:
+      # Windows with no records take the offset of the window before them,
+      # as they do in indexes written by htslib.
+      previous = 0
+      for window, offset in enumerate(linear):
+        if offset is None:
+          linear[window] = previous
+        else:
+          previous = offset
+    return self.index
@@ -0,0 +1,550 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Prepare VEP JSON output for loading into BigQuery.
+
+VEP writes one JSON object per line, but its output does not always match
+vep_schema.json: plugins add keys the schema does not list, numbers are
+sometimes written as strings (or as "." when a database has no value), and an
+occasional record is malformed.  Any of these fails the load of the whole
+shard.
+
+This streams the VEP output line by line through a projector compiled from the
+BigQuery schema, which:
+
+* drops keys that are not in the schema (counting them per field path),
+* coerces values to the schema's types, treating "." and "" in numeric fields
+  as null, and wrapping single values of repeated fields in lists,
+* rejects records that are not valid JSON objects, lack a required field or
+  hold a value that cannot be coerced.
+
+Valid rows are written to gzip compressed newline-delimited JSON chunks of at
+most --max_chunk_bytes (uncompressed) each, PREFIX-00000.json.gz, etc.  With
+--format parquet they are instead written to Parquet files,
+PREFIX-00000.parquet, etc. of at most about --max_chunk_bytes (compressed)
+each, with a schema derived from the BigQuery schema: records become structs
+and repeated fields become lists.  Every column is dictionary encoded and zstd
+compressed, which suits the highly repetitive consequence terms, gene ids and
+predictions, and the files are several times smaller than the compressed JSON.
+Parquet output requires pyarrow, and is loaded with bq load --source_format
+PARQUET --parquet_enable_list_inference.
+
+Rejected lines are written to PREFIX-rejects.json.gz along with the reason.
+Memory use does not depend on the size of the input.
+
+Example usage:
+
+python transform_vep_output.py \
+    --input /mnt/data/output.json \
+    --schema vep_schema.json \
+    --output_prefix /mnt/data/load/output
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import collections
+import gzip
+import json
+import logging
+import math
+import numbers
+import os
+import sys
+
+# If pyarrow is installed, Parquet output is supported.
+try:
+  import pyarrow
+  from pyarrow import parquet
+except ImportError:
+  pyarrow = None
+
+_DEFAULT_MAX_CHUNK_BYTES = 1024 * 1024 * 1024
+
+# Number of rows buffered per Parquet row group.
+_DEFAULT_ROWS_PER_GROUP = 10000
+
+# Values that VEP plugins (notably dbNSFP) write for a missing number.
+_MISSING_NUMBERS = frozenset([".", ""])
+
+# The range of BigQuery INTEGER values.
+_MIN_INT64 = -2**63
+_MAX_INT64 = 2**63 - 1
+
+# json returns unicode strings under Python 2.
+_STRING_TYPES = (str, type(u""))
+
+
+class TransformStats(object):
+  """Counts of what happened to the input.
+
+  Attributes:
+    rows_in: Number of non-empty input lines.
+    rows_out: Number of rows written.
+    rejected: Number of input lines rejected.
+    dropped_keys: Counter of keys not in the schema, by field path.
+  """
+
+  def __init__(self):
+    self.rows_in = 0
+    self.rows_out = 0
+    self.rejected = 0
+    self.dropped_keys = collections.Counter()
+
+
+def _check_int64(value):
+  if not _MIN_INT64 <= value <= _MAX_INT64:
+    raise ValueError("integer out of the INT64 range")
+  return value
+
+
+def _to_integer(value):
+  if isinstance(value, bool):
+    raise ValueError("expected an integer, got %r" % value)
+  if isinstance(value, numbers.Integral):
+    return _check_int64(value)
+  if isinstance(value, float):
+    if value.is_integer():
+      return _check_int64(int(value))
+    raise ValueError("expected an integer, got %r" % value)
+  if isinstance(value, _STRING_TYPES):
+    if value in _MISSING_NUMBERS:
+      return None
+    try:
+      return _check_int64(int(value))
+    except ValueError:
+      return _to_integer(float(value))
+  raise ValueError("expected an integer, got %r" % (value,))
+
+
+def _to_float(value):
+  if isinstance(value, bool):
+    raise ValueError("expected a float, got %r" % value)
+  if isinstance(value, _STRING_TYPES):
+    if value in _MISSING_NUMBERS:
+      return None
+    value = float(value)
+  elif isinstance(value, numbers.Real):
+    try:
+      value = float(value)
+    except OverflowError:
+      raise ValueError("number out of the FLOAT64 range")
+  else:
+    raise ValueError("expected a float, got %r" % (value,))
+  # JSON has no representation of infinity or NaN.
+  if math.isinf(value) or math.isnan(value):
+    raise ValueError("expected a finite float, got %r" % value)
+  return value
+
+
+def _to_string(value):
+  if isinstance(value, _STRING_TYPES):
+    return value
+  if isinstance(value, bool):
+    return "true" if value else "false"
+  if isinstance(value, numbers.Real):
+    return repr(value)
+  raise ValueError("expected a string, got %r" % (value,))
+
+
+def _to_boolean(value):
+  if isinstance(value, bool):
+    return value
+  if value in (0, 1):
+    return bool(value)
+  if isinstance(value, _STRING_TYPES):
+    lower = value.lower()
+    if lower in ("true", "1"):
+      return True
+    if lower in ("false", "0"):
+      return False
+    if value in _MISSING_NUMBERS:
+      return None
+  raise ValueError("expected a boolean, got %r" % (value,))
+
+
+_SCALAR_CONVERTERS = {
+    "integer": _to_integer,
+    "int64": _to_integer,
+    "float": _to_float,
+    "float64": _to_float,
+    "string": _to_string,
+    "boolean": _to_boolean,
+    "bool": _to_boolean,
+}
+
+
+def _compile_record(fields, path, stats):
+  """Returns a function projecting a JSON object onto a record schema.
+
+  Args:
+    fields: List of BigQuery schema fields of the record.
+    path: Dotted path of the record, for messages, e.g. "" or
+        "transcript_consequences.".
+    stats: TransformStats in which to count dropped keys.
+
+  Returns:
+    A function from a dict to a new dict holding only the fields of the
+    schema, with coerced values.  It raises ValueError if the object does not
+    fit the schema.
+  """
+  compiled = []
+  for field in fields:
+    name = field["name"]
+    field_type = field["type"].lower()
+    if field_type in ("record", "struct"):
+      convert = _compile_record(field["fields"], path + name + ".", stats)
+    elif field_type in _SCALAR_CONVERTERS:
+      convert = _SCALAR_CONVERTERS[field_type]
+    else:
+      raise ValueError("Unsupported type %s of field %s" %
+                       (field["type"], path + name))
+    compiled.append((name, convert, field.get("mode", "nullable").lower(),
+                     path + name))
+  names = frozenset(name for name, _, _, _ in compiled)
+
+  def project(value):
+    if not isinstance(value, dict):
+      raise ValueError("%s: expected an object" % (path.rstrip(".") or "row"))
+    if not names.issuperset(value):
+      for key in value:
+        if key not in names:
+          stats.dropped_keys[path + key] += 1
+
+    row = {}
+    for name, convert, mode, field_path in compiled:
+      item = value.get(name)
+      try:
+        if mode == "repeated":
+          if item is None:
+            continue
+          if not isinstance(item, list):
+            item = [item]
+          items = []
+          for element in item:
+            # BigQuery does not allow nulls in arrays.
+            if element is not None:
+              element = convert(element)
+              if element is not None:
+                items.append(element)
+          if items:
+            row[name] = items
+          continue
+        if item is not None:
+          item = convert(item)
+      except ValueError as e:
+        if str(e).startswith(field_path):
+          raise
+        raise ValueError("%s: %s" % (field_path, e))
+      if item is not None:
+        row[name] = item
+      elif mode == "required":
+        raise ValueError("%s: required field is missing" % field_path)
+    return row
+
+  return project
+
+
+def compile_schema(schema, stats):
+  """Returns a function projecting a VEP JSON object onto a BigQuery schema.
+
+  Args:
+    schema: The BigQuery schema, as a list of fields parsed from JSON.
+    stats: TransformStats in which to count dropped keys.
+  """
+  return _compile_record(schema, "", stats)
+
+
+def _arrow_type(field):
+  field_type = field["type"].lower()
+  if field_type in ("record", "struct"):
+    return pyarrow.struct([_arrow_field(f) for f in field["fields"]])
+  return {
+      "integer": pyarrow.int64(),
+      "int64": pyarrow.int64(),
+      "float": pyarrow.float64(),
+      "float64": pyarrow.float64(),
+      "string": pyarrow.string(),
+      "boolean": pyarrow.bool_(),
+      "bool": pyarrow.bool_(),
+  }[field_type]
+
+
+def _arrow_field(field):
+  mode = field.get("mode", "nullable").lower()
+  arrow_type = _arrow_type(field)
+  if mode == "repeated":
+    # BigQuery does not allow nulls in arrays, nor does the projector emit
+    # them.
+    arrow_type = pyarrow.list_(pyarrow.field("element", arrow_type,
+                                             nullable=False))
+  return pyarrow.field(field["name"], arrow_type,
+                       nullable=mode != "required")
+
+
+def arrow_schema(schema):
+  """Returns the pyarrow schema equivalent to a BigQuery schema.
+
+  Args:
+    schema: The BigQuery schema, as a list of fields parsed from JSON.
+  """
+  return pyarrow.schema([_arrow_field(field) for field in schema])
+
+
+class NdjsonChunkWriter(object):
+  """Writes rows to a series of size-bounded, compressed NDJSON chunks."""
+
+  def __init__(self, output_prefix, max_chunk_bytes=_DEFAULT_MAX_CHUNK_BYTES,
+               compress_level=1):
+    self.output_prefix = output_prefix
+    self.max_chunk_bytes = max_chunk_bytes
+    self.compress_level = compress_level
+    self.paths = []
+    self._outfile = None
+    self._chunk_bytes = 0
+
+  def write(self, row):
+    """Writes one row, a dict."""
+    line = json.dumps(row, separators=(",", ":")).encode("utf-8") + b"\n"
+    if (self._outfile is None or
+        self._chunk_bytes + len(line) > self.max_chunk_bytes and
+        self._chunk_bytes):
+      self.close()
+      path = "%s-%05d.json.gz" % (self.output_prefix, len(self.paths))
+      self.paths.append(path)
+      self._outfile = gzip.open(path, "wb", compresslevel=self.compress_level)
+      self._chunk_bytes = 0
+    self._outfile.write(line)
+    self._chunk_bytes += len(line)
+
+  def close(self):
+    """Closes the current chunk, if any."""
+    if self._outfile is not None:
+      self._outfile.close()
+      self._outfile = None
+
+
+class ParquetChunkWriter(object):
+  """Writes rows to a series of size-bounded Parquet files."""
+
+  def __init__(self, output_prefix, schema,
+               max_chunk_bytes=_DEFAULT_MAX_CHUNK_BYTES, compress_level=1,
+               rows_per_group=_DEFAULT_ROWS_PER_GROUP):
+    """Create ParquetChunkWriter class.
+
+    Args:
+      output_prefix: Path prefix of the output chunks.
+      schema: The BigQuery schema, as a list of fields parsed from JSON.
+      max_chunk_bytes: A new file is started once a file reaches this size.
+      compress_level: zstd compression level.
+      rows_per_group: Number of rows buffered and written per row group.
+    """
+    self.output_prefix = output_prefix
+    self.schema = arrow_schema(schema)
+    self.max_chunk_bytes = max_chunk_bytes
+    self.compress_level = compress_level
+    self.rows_per_group = rows_per_group
+    self.paths = []
+    self._writer = None
+    self._rows = []
+
+  def write(self, row):
+    """Writes one row, a dict."""
+    self._rows.append(row)
+    if len(self._rows) >= self.rows_per_group:
+      self._flush()
+
+  def _flush(self):
+    if not self._rows:
+      return
+    if self._writer is None:
+      path = "%s-%05d.parquet" % (self.output_prefix, len(self.paths))
+      self.paths.append(path)
+      self._writer = parquet.ParquetWriter(
+          path, self.schema, compression="zstd",
+          compression_level=self.compress_level, use_dictionary=True)
+    columns = [pyarrow.array([row.get(field.name) for row in self._rows],
+                             type=field.type)
+               for field in self.schema]
+    self._writer.write_table(
+        pyarrow.Table.from_arrays(columns, schema=self.schema))
+    self._rows = []
+    if os.path.getsize(self.paths[-1]) >= self.max_chunk_bytes:
+      self._close_file()
+
+  def _close_file(self):
+    if self._writer is not None:
+      self._writer.close()
+      self._writer = None
+
+  def close(self):
+    """Writes any buffered rows and closes the current file."""
+    try:
+      self._flush()
+    finally:
+      self._close_file()
+
+
+def iter_rows(lines, project, stats, rejects=None):
+  """Yields the projected rows of VEP JSON lines.
+
+  Args:
+    lines: Iterable of VEP JSON output lines, as bytes.
+    project: Function returned by compile_schema.
+    stats: TransformStats to update.
+    rejects: Optional function called with (line, reason) for each line that
+        is rejected.
+
+  Yields:
+    Each valid row as a dict.
+  """
+  for line in lines:
+    if not line.strip():
+      continue
+    stats.rows_in += 1
+    try:
+      row = project(json.loads(line.decode("utf-8")))
+    except (OverflowError, ValueError) as e:
+      stats.rejected += 1
+      if rejects:
+        rejects(line, str(e))
+      continue
+    stats.rows_out += 1
+    yield row
+
+
+def transform(lines, schema, output_prefix,
+              max_chunk_bytes=_DEFAULT_MAX_CHUNK_BYTES, compress_level=1,
+              rejects_path=None, file_format="ndjson"):
+  """Converts VEP JSON output to BigQuery-ready chunks.
+
+  Args:
+    lines: Iterable of VEP JSON output lines, as bytes.
+    schema: The BigQuery schema, as a list of fields parsed from JSON.
+    output_prefix: Path prefix of the output chunks.
+    max_chunk_bytes: Maximum uncompressed size of each NDJSON chunk, or the
+        approximate compressed size of each Parquet chunk.
+    compress_level: gzip (NDJSON) or zstd (Parquet) compression level.
+    rejects_path: Path of the gzip compressed rejects file.  Defaults to
+        PREFIX-rejects.json.gz.  It is only created if a line is rejected.
+    file_format: "ndjson" or "parquet".
+
+  Returns:
+    A tuple of (TransformStats, list of chunk paths, rejects path or None).
+  """
+  stats = TransformStats()
+  project = compile_schema(schema, stats)
+  rejects_path = rejects_path or output_prefix + "-rejects.json.gz"
+  if file_format == "parquet":
+    writer = ParquetChunkWriter(output_prefix, schema, max_chunk_bytes,
+                                compress_level)
+  else:
+    writer = NdjsonChunkWriter(output_prefix, max_chunk_bytes,
+                               compress_level)
+  rejects_file = []
+
+  def reject(line, reason):
+    if not rejects_file:
+      rejects_file.append(gzip.open(rejects_path, "wb"))
+    rejects_file[0].write(json.dumps(
+        {"error": reason,
+         "line": line.decode("utf-8", "replace").rstrip("\r\n")}).encode(
+             "utf-8") + b"\n")
+
+  try:
+    for row in iter_rows(lines, project, stats, reject):
+      writer.write(row)
+  finally:
+    writer.close()
+    if rejects_file:
+      rejects_file[0].close()
+  return stats, writer.paths, rejects_path if rejects_file else None
+
+
+def run(argv=None):
+  """Main entry point."""
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      "--input",
+      default="-",
+      help="VEP JSON output file, or - for stdin.")
+  parser.add_argument(
+      "--schema",
+      default="vep_schema.json",
+      help="BigQuery schema of the destination table.")
+  parser.add_argument(
+      "--output_prefix",
+      required=True,
+      help="Path prefix of the output chunks, which are numbered "
+      "PREFIX-00000.json.gz, PREFIX-00001.json.gz, etc. (or .parquet).")
+  parser.add_argument(
+      "--format",
+      dest="file_format",
+      choices=("ndjson", "parquet"),
+      default="ndjson",
+      help="Output file format.  Parquet requires pyarrow.")
+  parser.add_argument(
+      "--rejects",
+      help="Path of the compressed file of rejected lines.  Defaults to "
+      "PREFIX-rejects.json.gz.")
+  parser.add_argument(
+      "--max_chunk_bytes",
+      type=int,
+      default=_DEFAULT_MAX_CHUNK_BYTES,
+      help="Maximum uncompressed size of each NDJSON chunk, or the "
+      "approximate compressed size of each Parquet chunk.")
+  parser.add_argument(
+      "--compress_level",
+      type=int,
+      default=1,
+      help="Compression level for gzip (NDJSON) or zstd (Parquet).")
+  args = parser.parse_args(argv)
+
+  if args.file_format == "parquet" and pyarrow is None:
+    parser.error("--format parquet requires pyarrow to be installed.")
+
+  with open(args.schema, "r") as f:
+    schema = json.load(f)
+
+  output_dir = os.path.dirname(args.output_prefix)
+  if output_dir and not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+
+  if args.input == "-":
+    infile = getattr(sys.stdin, "buffer", sys.stdin)
+  else:
+    infile = open(args.input, "rb")
+  try:
+    stats, paths, rejects_path = transform(
+        infile, schema, args.output_prefix,
+        max_chunk_bytes=args.max_chunk_bytes,
+        compress_level=args.compress_level, rejects_path=args.rejects,
+        file_format=args.file_format)
+  finally:
+    if infile is not getattr(sys.stdin, "buffer", sys.stdin):
+      infile.close()
+
+  logging.info("Wrote %d rows to %d chunks; rejected %d of %d lines.",
+               stats.rows_out, len(paths), stats.rejected, stats.rows_in)
+  for key, count in stats.dropped_keys.most_common():
+    logging.info("Dropped key %s from %d rows.", key, count)
+  if rejects_path:
+    logging.warning("Rejected lines written to %s", rejects_path)
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  run()
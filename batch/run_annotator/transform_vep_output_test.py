@@ -0,0 +1,101 @@
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for transform_vep_output.py.
+
+Run with:
+
+python -m unittest discover -s batch/run_annotator -p "*_test.py"
+"""
+
+from __future__ import absolute_import
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import transform_vep_output
+
+_SCHEMA = [
+    {"name": "input", "type": "STRING", "mode": "REQUIRED"},
+    {"name": "start", "type": "INTEGER", "mode": "REQUIRED"},
+    {"name": "transcript_consequences", "type": "RECORD", "mode": "REPEATED",
+     "fields": [
+         {"name": "transcript_id", "type": "STRING", "mode": "REQUIRED"},
+         {"name": "sift_score", "type": "FLOAT", "mode": "NULLABLE"},
+     ]},
+]
+
+
+def _line(start, sift_score=None):
+  record = {"input": "1 %s" % start, "start": start}
+  if sift_score is not None:
+    record["transcript_consequences"] = [
+        {"transcript_id": "ENST1", "sift_score": sift_score}]
+  return json.dumps(record).encode("utf-8")
+
+
+class TransformTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _transform(self, lines, file_format):
+    return transform_vep_output.transform(
+        lines, _SCHEMA, os.path.join(self.directory, "output"),
+        file_format=file_format)
+
+  def _rejects(self, path):
+    with gzip.open(path, "rb") as f:
+      return [json.loads(line.decode("utf-8"))["error"] for line in f]
+
+  def _check_out_of_range(self, file_format):
+    lines = [_line(10**400), _line(2**63), _line(-2**63 - 1),
+             _line("1e400"), _line(5, sift_score=10**400),
+             _line(2**63 - 1), _line(-2**63, sift_score=0.5)]
+    stats, paths, rejects_path = self._transform(lines, file_format)
+    self.assertEqual((stats.rows_in, stats.rows_out, stats.rejected),
+                     (7, 2, 5))
+    self.assertEqual(len(paths), 1)
+    errors = self._rejects(rejects_path)
+    self.assertEqual(len(errors), 5)
+    self.assertIn("transcript_consequences.sift_score", errors[4])
+
+  def test_out_of_range_numbers_are_rejected_ndjson(self):
+    self._check_out_of_range("ndjson")
+    stats, paths, _ = self._transform([_line(2**63 - 1)], "ndjson")
+    with gzip.open(paths[0], "rb") as f:
+      self.assertEqual(json.loads(f.read().decode("utf-8"))["start"],
+                       2**63 - 1)
+
+  @unittest.skipIf(transform_vep_output.pyarrow is None,
+                   "pyarrow is not installed")
+  def test_out_of_range_numbers_are_rejected_parquet(self):
+    self._check_out_of_range("parquet")
+
+  def test_all_lines_rejected_writes_no_chunks(self):
+    stats, paths, rejects_path = self._transform(
+        [_line(2**63), b"not json"], "ndjson")
+    self.assertEqual(stats.rejected, 2)
+    self.assertEqual(paths, [])
+    self.assertEqual(len(self._rejects(rejects_path)), 2)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -23,145 +23,244 @@
 #
 # Takes flags as the environment variables:
 # SCHEMA_FILE BQ_DATASET_NAME BQ_TABLE_NAME INPUT_FILE NUM_SHARDS SHARD_INDEX
+# SCRIPTS_DIR OUTPUT_FORMAT ANNOTATION_CACHE SHARD_PLAN
+#
+# SCRIPTS_DIR holds the Python helpers from this directory, such as
+# shard_input.py.  OUTPUT_FORMAT is "ndjson" (the default) or "parquet", the
+# format in which the annotations are staged for loading into BigQuery.
+# ANNOTATION_CACHE is optional: a GCS directory holding a cache.sqlite of
+# annotations from earlier runs (see annotation_cache.py).  Cached variants are
+# not sent to VEP, and the newly annotated variants are written to
+# ${ANNOTATION_CACHE}/deltas/ to be merged into the cache after the run.
+# SHARD_PLAN is optional: the GCS path of a plan_shards.py plan of the input,
+# giving the range of the input in each shard.
+#
+# The time and resources used by each stage of the task are printed to stdout
+# as a single VEP_TASK_METRICS line when it ends; see stage_metrics.py.
 #
 # The following environment variables should be specified in the Docker image,
 # since they are properties of the downloaded databases which are specific to
 # the image (there is a one-to-one relationship):
 # GENOME_ASSEMBLY VEP_SPECIES DBNSFP_BASE
-#
-# We also allow for including as a module so that the functions (in
-# particular apply_shard_file) can be tested.
-
-# Applies shard to $1 in-place.
-#
-# Args:
-#   file: file to be sharded (in-place)
-#   shard_count: the number of shards
-#   cur_shard: integer from 1...num_shards (inclusive)
-#
-# Comment lines (starting with #) are always included. Of the remaining lines,
-# the index chunk of ceil(num_non_comment_lines / num_shards) lines
-# is kept, with the final shard (cur_shard=shard_count) potentially having
-# fewer lines.
-#
-# We use shard_count and cur_shard here because using num_shards and shard_index
-# confuses the linter because they are too close to NUM_SHARDS and SHARD_INDEX,
-# which aren't actually defined here.
-function apply_shard_file() {
-  local -r file=$1
-  local -ri shard_count=$2
-  local -ri cur_shard=$3
-
-  if [[ "${shard_count}" -eq 1 ]]; then
-    return
-  fi
 
-  local -r temp_sharded_file="${file}.sharded"
+set -o xtrace
+set -o nounset
+set -o errexit
 
-  # Pass through the file twice; once to get the number of non-comment lines
-  # and then to use that to output the specific shard.
-  gawk -vnum_shards="${shard_count}" -vshard_index="${cur_shard}" '
-    # Note: line_count and non_comment_line_index refer only to non-comment
-    # lines.
+readonly METRICS_FILE=/mnt/data/stage_metrics.json
 
-    ARGIND==1 {
-      if (!/^#/)
-        line_count++
-      next
-    }
-
-    ARGIND==2 && FNR==1 {
-      lines_per_shard = int((line_count + num_shards - 1) / num_shards)
-
-      # If num_shards > line_count, then this could be greater than the number
-      # of lines, which will lead to empty output files.
-      first_line = (shard_index - 1) * lines_per_shard + 1
+# Runs a command as a named stage of this task, recording its resource use.
+#
+# Args:
+#   $1: Name of the stage.
+#  ...: Flags of "stage_metrics.py run", then -- and the command.
+function stage() {
+  local -r name="$1"
+  shift 1
+  python "${SCRIPTS_DIR}/stage_metrics.py" run \
+    --metrics "${METRICS_FILE}" \
+    --stage "${name}" \
+    "$@"
+}
 
-      # Note: this could be greater than line_count when num_shards > line_count
-      # or for num_shards == shard_index. The later will lead to a file with
-      # fewer than lines_per_shard non-comment lines.
-      last_line = first_line + lines_per_shard - 1
-    }
+function report_metrics() {
+  python "${SCRIPTS_DIR}/stage_metrics.py" report \
+    --metrics "${METRICS_FILE}" \
+    --field "dataset=${BQ_DATASET_NAME}" \
+    --field "table=${BQ_TABLE_NAME}" \
+    --field "input_file=$(basename "${INPUT_FILE}")" \
+    --field "shard_index=${SHARD_INDEX}" \
+    --field "num_shards=${NUM_SHARDS}" \
+    --warnings /mnt/data/output.json_warnings.txt \
+    || true
+}
+trap report_metrics EXIT
 
-    !/^#/{line_index++}
+if [[ $INPUT_FILE == *.vcf.gz || $INPUT_FILE == *.vcf ]]; then
+  readonly FORMAT="vcf"
+else
+  readonly FORMAT="ensembl"
+fi
 
-    /^#/ || (line_index >= first_line && line_index <= last_line) {
-      print
-    }' "${file}"{,} > "${temp_sharded_file}"
+# Extract this task's shard of the (possibly compressed) input in one pass.
+# For VCF files this also removes any genotype information (which, in the
+# case of 1k genomes, takes up ~75% of the output JSON file).
+if [[ -n "${SHARD_PLAN:-}" ]]; then
+  gsutil -q cp "${SHARD_PLAN}" /mnt/data/shard_plan.tsv
+fi
+stage shard \
+  --input "${INPUT_FILE}" \
+  --output /mnt/data/input_file \
+  --records /mnt/data/input_file \
+  -- \
+  python "${SCRIPTS_DIR}/shard_input.py" \
+  --input "${INPUT_FILE}" \
+  --output /mnt/data/input_file \
+  --format "${FORMAT}" \
+  --num_shards "${NUM_SHARDS}" \
+  --shard_index "${SHARD_INDEX}" \
+  ${SHARD_PLAN:+--plan /mnt/data/shard_plan.tsv}
 
-  mv "${temp_sharded_file}" "${file}"
-}
+rm "${INPUT_FILE}"
 
-if [[ -z "${INPUT_FILE}" ]]; then
-  echo 'Running script in bash library mode.'
-else
-  set -o xtrace
-  set -o nounset
-  set -o errexit
-
-  # Localize dbNSFP database files.  We can't use dsub to do this for us because
-  # the current version (specified by filename or bucket) is only known inside
-  # the container.
-  gsutil -q cp "${DBNSFP_BASE}.gz" "${TMPDIR}/dbNSFP.gz"
-  gsutil -q cp "${DBNSFP_BASE}.gz.tbi" "${TMPDIR}/dbNSFP.gz.tbi"
-
-  if [[ $INPUT_FILE == *.vcf.gz || $INPUT_FILE == *.vcf ]]; then
-    # The cut operaton removes any genotype information from the input VCF files
-    # (which, in the case of 1k genomes, takes up ~75% of the output JSON file).
-    gunzip -cf "${INPUT_FILE}" | cut -f1-8 > /mnt/data/input_file
-    readonly FORMAT="vcf"
-  else
-    gunzip -cf "${INPUT_FILE}" > /mnt/data/input_file
-    readonly FORMAT="ensembl"
-  fi
+readonly NUM_CORES=$(grep --count --word-regexp "^processor" /proc/cpuinfo)
 
-  rm "${INPUT_FILE}"
+cd "${VEP_BASE}"
 
-  apply_shard_file /mnt/data/input_file "${NUM_SHARDS}" "${SHARD_INDEX}"
+# The options that determine the annotations, as opposed to how VEP is run.
+# Depending on the version of dbNSFP used, not all the columns
+# listed below may be available. VEP will issue a warning about
+# those missing columns and run successfully.
+readonly -a ANNOTATION_OPTIONS=(
+  --allele_number
+  --species "${VEP_SPECIES}"
+  --assembly "${GENOME_ASSEMBLY}"
+  --sift b
+  --polyphen b
+  --hgvs
+  --plugin Condel,Condel/config,b
+  --plugin "dbNSFP,${TMPDIR}/dbNSFP.gz,ExAC_Adj_AC,ExAC_Adj_AF,ExAC_nonTCGA_Adj_AC,ExAC_nonTCGA_Adj_AF,ExAC_nonpsych_Adj_AC,ExAC_nonpsych_Adj_AF,GenoCanyon_score,phyloP100way_vertebrate,phyloP20way_mammalian,phastCons100way_vertebrate,phastCons20way_mammalian,SiPhy_29way_logOdds,TWINSUK_AC,TWINSUK_AF,clinvar_rs,Ensembl_geneid,Ensembl_transcriptid,Ensembl_proteinid,LRT_score,ALSPAC_AC,ALSPAC_AF,ESP6500_AA_AC,ESP6500_AA_AF,ESP6500_EA_AC,ESP6500_EA_AF,clinvar_trait,GTEx_V6_gene,GTEx_V6_tissue"
+)
 
-  readonly NUM_CORES=$(grep --count --word-regexp "^processor" /proc/cpuinfo)
+readonly ANNOTATION_CACHE="${ANNOTATION_CACHE:-}"
+VEP_INPUT=/mnt/data/input_file
+if [[ -n "${ANNOTATION_CACHE}" ]]; then
+  # Annotations are cached by variant and by everything that affects them: the
+  # VEP release, the databases of this image and the annotation options.
+  readonly FINGERPRINT=$(python "${SCRIPTS_DIR}/annotation_cache.py" \
+    fingerprint \
+    "$(git -C "${VEP_BASE}" rev-parse HEAD)" \
+    "${GENOME_ASSEMBLY}" \
+    "${VEP_SPECIES}" \
+    "${DBNSFP_BASE}" \
+    -- "${ANNOTATION_OPTIONS[@]}")
+  # The cache does not exist before the first run.
+  gsutil -q cp "${ANNOTATION_CACHE}/cache.sqlite" /mnt/data/cache.sqlite \
+    || true
+  stage cache_split \
+    --input /mnt/data/input_file \
+    --records /mnt/data/input_file \
+    -- \
+    python "${SCRIPTS_DIR}/annotation_cache.py" split \
+    --cache /mnt/data/cache.sqlite \
+    --fingerprint "${FINGERPRINT}" \
+    --input /mnt/data/input_file \
+    --format "${FORMAT}" \
+    --misses /mnt/data/vep_input_file \
+    --hits /mnt/data/cached_output.json
+  rm /mnt/data/input_file
+  VEP_INPUT=/mnt/data/vep_input_file
+fi
 
-  cd "${VEP_BASE}"
+if grep --quiet --invert-match "^#" "${VEP_INPUT}"; then
+  # Localize the part of the dbNSFP database that covers this shard.  We can't
+  # use dsub to do this for us because the current version (specified by
+  # filename or bucket) is only known inside the container.
+  stage dbnsfp \
+    --output "${TMPDIR}/dbNSFP.gz" \
+    -- \
+    python "${SCRIPTS_DIR}/slice_tabix.py" \
+    --input "${DBNSFP_BASE}.gz" \
+    --regions_from "${VEP_INPUT}" \
+    --format "${FORMAT}" \
+    --output "${TMPDIR}/dbNSFP.gz"
 
-  # Depending on the version of dbNSFP used, not all the columns
-  # listed below may be available. VEP will issue a warning about
-  # those missing columns and run successfully.
-  "${VEP_BASE}/vep" \
+  stage vep \
+    --input "${VEP_INPUT}" \
+    --output /mnt/data/output.json \
+    --records "${VEP_INPUT}" \
+    -- \
+    "${VEP_BASE}/vep" \
     --cache \
     --offline \
     --no_stats \
-    --allele_number \
     --force_overwrite \
     --fork "${NUM_CORES}" \
     --json \
-    --species "${VEP_SPECIES}" \
-    --assembly "${GENOME_ASSEMBLY}" \
-    --sift b \
-    --polyphen b \
-    --hgvs \
-    --plugin Condel,Condel/config,b \
-    --plugin "dbNSFP,${TMPDIR}/dbNSFP.gz,ExAC_Adj_AC,ExAC_Adj_AF,ExAC_nonTCGA_Adj_AC,ExAC_nonTCGA_Adj_AF,ExAC_nonpsych_Adj_AC,ExAC_nonpsych_Adj_AF,GenoCanyon_score,phyloP100way_vertebrate,phyloP20way_mammalian,phastCons100way_vertebrate,phastCons20way_mammalian,SiPhy_29way_logOdds,TWINSUK_AC,TWINSUK_AF,clinvar_rs,Ensembl_geneid,Ensembl_transcriptid,Ensembl_proteinid,LRT_score,ALSPAC_AC,ALSPAC_AF,ESP6500_AA_AC,ESP6500_AA_AF,ESP6500_EA_AC,ESP6500_EA_AF,clinvar_trait,GTEx_V6_gene,GTEx_V6_tissue" \
+    "${ANNOTATION_OPTIONS[@]}" \
     --format "${FORMAT}" \
-    -i /mnt/data/input_file \
+    -i "${VEP_INPUT}" \
     -o /mnt/data/output.json
+else
+  echo "All variants of this shard are cached; not running VEP."
+  : > /mnt/data/output.json
+fi
 
-  if [[ -s /mnt/data/output.json ]]; then
-    bq \
-      --quiet \
-      load \
-      --source_format NEWLINE_DELIMITED_JSON \
-      "${BQ_DATASET_NAME}.${BQ_TABLE_NAME}" \
-      /mnt/data/output.json \
-      "${SCHEMA_FILE}"
+if [[ -n "${ANNOTATION_CACHE}" ]]; then
+  stage cache_update \
+    --input /mnt/data/output.json \
+    -- \
+    python "${SCRIPTS_DIR}/annotation_cache.py" update \
+    --cache /mnt/data/cache.sqlite \
+    --fingerprint "${FINGERPRINT}" \
+    --input /mnt/data/output.json \
+    --format "${FORMAT}" \
+    --export /mnt/data/cache_delta.tsv.gz
+  # Shards of different input files share a shard index, so the name of the
+  # delta also includes a random suffix.
+  gsutil -q cp /mnt/data/cache_delta.tsv.gz \
+    "${ANNOTATION_CACHE}/deltas/${BQ_TABLE_NAME}-${SHARD_INDEX}-${RANDOM}${RANDOM}.tsv.gz"
+  cat /mnt/data/cached_output.json >> /mnt/data/output.json
+fi
+
+if [[ -s /mnt/data/output.json ]]; then
+  # Fit the output to the schema so that unexpected keys or a malformed record
+  # do not fail the load of the whole shard.  Rejected records are reported
+  # below.
+  stage transform \
+    --input /mnt/data/output.json \
+    --output /mnt/data/load \
+    --records /mnt/data/output.json \
+    -- \
+    python "${SCRIPTS_DIR}/transform_vep_output.py" \
+    --input /mnt/data/output.json \
+    --schema "${SCHEMA_FILE}" \
+    --output_prefix /mnt/data/load/output \
+    --format "${OUTPUT_FORMAT:-ndjson}"
+  rm /mnt/data/output.json
+
+  # If every record was rejected there are no chunks to load, but the rejects
+  # are still reported below.
+  shopt -s nullglob
+  if [[ "${OUTPUT_FORMAT:-ndjson}" == "parquet" ]]; then
+    for chunk in /mnt/data/load/output-[0-9]*.parquet; do
+      stage load \
+        --input "${chunk}" \
+        -- \
+        bq \
+        --quiet \
+        load \
+        --source_format PARQUET \
+        --parquet_enable_list_inference \
+        "${BQ_DATASET_NAME}.${BQ_TABLE_NAME}" \
+        "${chunk}"
+    done
   else
-    echo "VEP output file empty." >&2
-  fi
-  if [[ -s /mnt/data/output.json_warnings.txt ]]; then
-    # Record any VEP export errors in stdout.  These are typically complaints
-    # about unmatched "random" or alternate haplotype contigs in the database.
-    echo "JSON warnings reported:"
-    cat /mnt/data/output.json_warnings.txt
+    for chunk in /mnt/data/load/output-[0-9]*.json.gz; do
+      stage load \
+        --input "${chunk}" \
+        -- \
+        bq \
+        --quiet \
+        load \
+        --source_format NEWLINE_DELIMITED_JSON \
+        "${BQ_DATASET_NAME}.${BQ_TABLE_NAME}" \
+        "${chunk}" \
+        "${SCHEMA_FILE}"
+    done
   fi
+  shopt -u nullglob
 
+  if [[ -e /mnt/data/load/output-rejects.json.gz ]]; then
+    echo "Records rejected from the BigQuery load:"
+    gunzip -c /mnt/data/load/output-rejects.json.gz
+  fi
+else
+  echo "VEP output file empty." >&2
+fi
+if [[ -s /mnt/data/output.json_warnings.txt ]]; then
+  # Record any VEP export errors in stdout.  These are typically complaints
+  # about unmatched "random" or alternate haplotype contigs in the database.
+  echo "JSON warnings reported:"
+  cat /mnt/data/output.json_warnings.txt
 fi
-
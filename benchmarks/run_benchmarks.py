@@ -0,0 +1,556 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Measure the throughput and peak memory of the hot paths.
+
+Each benchmark runs a stage of the pipelines on synthetic data from
+synthetic_data.py:
+
+  fasta_to_kv          fasta_to_kv.convert of a plain FASTA
+  fasta_to_kv_gzip     fasta_to_kv.convert of a gzip compressed FASTA
+  fasta_to_twobit      fasta_to_kv.convert_to_twobit of a plain FASTA
+  fasta_to_kv_parallel fasta_to_kv.convert_parallel of a plain FASTA with 2
+                       processes, after checking that its output is the
+                       same as that of fasta_to_kv.convert
+  shard_input_plain    shard_input.write_range of a whole plain VCF with
+                       genotypes, which removes the genotype columns
+  shard_input_bgzf     the same for a BGZF compressed VCF
+  add_from_vcf         Descriptions.add_from_vcf of a VCF with a large header,
+                       without the header cache
+  render_templated_sql render_templated_sql.run for build 37 and 38
+  transform_vep_output transform_vep_output.transform of VEP JSON output
+
+The data is generated once into --data_dir and reused, so only the first run
+pays for it.  Each benchmark runs --repeat times, each time in a fresh Python
+process so that its peak resident set size is its own.  Results are the
+median wall and CPU time and the largest peak memory of the runs, and are
+written as JSON to --output.
+
+Given a --baseline (the --output of an earlier run at the same --scale), each
+benchmark is compared with it, and the script exits with status 1 if any
+throughput dropped, or peak memory grew, by more than --tolerance.
+Benchmarks that need a package that is not installed are skipped, and
+reported with the reason.
+
+Example usage:
+
+python run_benchmarks.py --output baseline.json
+# ... change the code ...
+python run_benchmarks.py --output new.json --baseline baseline.json
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SQL_DIR = os.path.join(_ROOT, "curation", "allPossibleSNPs")
+for directory in (os.path.join(_ROOT, "batch", "run_annotator"), _SQL_DIR,
+                  os.path.join(_ROOT, "curation", "tables"),
+                  os.path.dirname(os.path.abspath(__file__))):
+  sys.path.insert(0, directory)
+
+import synthetic_data  # pylint: disable=g-import-not-at-top
+
+_DEFAULT_DATA_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "variant_annotation", "benchmarks")
+
+_clock = getattr(time, "perf_counter", time.time)
+
+# Base sizes of the synthetic data, multiplied by --scale.
+_FASTA_CONTIG_LENGTHS = [12000000, 6000000, 2000000]
+_FASTA_LINE_WIDTHS = [60, 70, 80]
+_VCF_CONTIG_LENGTHS = [50000000, 30000000]
+_GENOTYPE_RECORDS = 10000
+_GENOTYPE_SAMPLES = 100
+_HEADER_INFO_FIELDS = 400
+_VEP_RECORDS = 10000
+
+# Number of calls per run of the benchmarks of small, fast operations.
+_HEADER_PARSES = 50
+_RENDERS = 100
+
+Benchmark = collections.namedtuple("Benchmark",
+                                   ["name", "datasets", "unit", "setup"])
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def _scaled(value, scale):
+  return max(1, int(value * scale))
+
+
+def _dataset_specs(scale):
+  """Returns a dict from dataset name to (file name, generator function)."""
+  fasta_lengths = [_scaled(length, scale) for length in _FASTA_CONTIG_LENGTHS]
+
+  def fasta(path):
+    synthetic_data.write_fasta(path, fasta_lengths, _FASTA_LINE_WIDTHS)
+
+  def genotypes(compression):
+    return lambda path: synthetic_data.write_vcf(
+        path, _scaled(_GENOTYPE_RECORDS, scale), _VCF_CONTIG_LENGTHS,
+        _GENOTYPE_SAMPLES, compression)
+
+  def header(path):
+    synthetic_data.write_vcf(path, 1000, _VCF_CONTIG_LENGTHS, 0, "bgzf",
+                             num_info=_HEADER_INFO_FIELDS, num_format=50)
+
+  def vep_json(path):
+    synthetic_data.write_vep_json(path, _scaled(_VEP_RECORDS, scale))
+
+  return {
+      "fasta": ("synthetic.fa", fasta),
+      "fasta_gzip": ("synthetic.fa.gz", fasta),
+      "genotypes_plain": ("genotypes.vcf", genotypes("")),
+      "genotypes_bgzf": ("genotypes.vcf.gz", genotypes("bgzf")),
+      "large_header": ("large_header.vcf.gz", header),
+      "vep_json": ("vep_output.json", vep_json),
+  }
+
+
+def prepare_data(data_dir, scale, names):
+  """Generates the datasets that are missing and returns their paths.
+
+  Args:
+    data_dir: Directory of the generated data.  Data for each scale is kept
+        in its own subdirectory.
+    scale: Size of the data relative to the defaults.
+    names: Names of the datasets needed.
+
+  Returns:
+    A dict from dataset name to path.
+  """
+  directory = os.path.join(data_dir, "scale-%g" % scale)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  specs = _dataset_specs(scale)
+  paths = {}
+  for name in names:
+    filename, generate = specs[name]
+    path = os.path.join(directory, filename)
+    if not os.path.exists(path):
+      logging.info("Generating %s", path)
+      # Write to a temporary name so an interrupted run leaves no partial file.
+      temp_path = os.path.join(directory, "tmp-" + filename)
+      generate(temp_path)
+      os.rename(temp_path, path)
+    paths[name] = path
+  return paths
+
+
+def benchmark(name, datasets, unit):
+  """Registers a benchmark.
+
+  The decorated function takes the dict of dataset paths and the scale and
+  returns a function that runs the benchmark once and returns a tuple of
+  (number of units processed, number of input bytes processed).  Imports and
+  other setup belong in the outer function, which is not timed.  It raises
+  ImportError if a package it needs is not installed.
+  """
+  def register(setup):
+    BENCHMARKS[name] = Benchmark(name, datasets, unit, setup)
+    return setup
+  return register
+
+
+@benchmark("fasta_to_kv", ["fasta"], "bases")
+def _fasta_to_kv(paths, scale):
+  import fasta_to_kv  # pylint: disable=g-import-not-at-top
+  return _fasta_to_kv_run(fasta_to_kv, paths["fasta"], scale)
+
+
+@benchmark("fasta_to_kv_gzip", ["fasta_gzip"], "bases")
+def _fasta_to_kv_gzip(paths, scale):
+  import fasta_to_kv  # pylint: disable=g-import-not-at-top
+  return _fasta_to_kv_run(fasta_to_kv, paths["fasta_gzip"], scale)
+
+
+@benchmark("fasta_to_twobit", ["fasta"], "bases")
+def _fasta_to_twobit(paths, scale):
+  import fasta_to_kv  # pylint: disable=g-import-not-at-top
+  path = paths["fasta"]
+  bases = sum(_scaled(length, scale) for length in _FASTA_CONTIG_LENGTHS)
+
+  def run():
+    stream = fasta_to_kv.open_fasta(path)
+    try:
+      with open(os.devnull, "wb") as outfile:
+        fasta_to_kv.convert_to_twobit(stream, outfile)
+    finally:
+      stream.close()
+    return bases, os.path.getsize(path)
+  return run
+
+
+class _DigestFile(object):
+  """Write-only file object that keeps the SHA-1 of what is written to it."""
+
+  def __init__(self):
+    self.digest = hashlib.sha1()
+
+  def write(self, data):
+    self.digest.update(data)
+
+
+@benchmark("fasta_to_kv_parallel", ["fasta"], "bases")
+def _fasta_to_kv_parallel(paths, scale):
+  import fasta_to_kv  # pylint: disable=g-import-not-at-top
+  path = paths["fasta"]
+  bases = sum(_scaled(length, scale) for length in _FASTA_CONTIG_LENGTHS)
+  with fasta_to_kv.FastaIndex(path) as index:
+    regions = [(name, 0, None) for name in index.entries]
+
+  # The headers of the synthetic contigs have descriptions, which the
+  # parallel output must keep as the serial output does.
+  serial = _DigestFile()
+  stream = fasta_to_kv.open_fasta(path)
+  try:
+    fasta_to_kv.convert(stream, serial)
+  finally:
+    stream.close()
+  parallel = _DigestFile()
+  fasta_to_kv.convert_parallel(path, regions, 2, outfile=parallel)
+  if parallel.digest.digest() != serial.digest.digest():
+    raise ValueError("convert_parallel and convert differ on %s" % path)
+
+  def run():
+    with open(os.devnull, "wb") as outfile:
+      fasta_to_kv.convert_parallel(path, regions, 2, outfile=outfile)
+    return bases, os.path.getsize(path)
+  return run
+
+
+def _fasta_to_kv_run(fasta_to_kv, path, scale):
+  bases = sum(_scaled(length, scale) for length in _FASTA_CONTIG_LENGTHS)
+
+  def run():
+    stream = fasta_to_kv.open_fasta(path)
+    try:
+      with open(os.devnull, "wb") as outfile:
+        fasta_to_kv.convert(stream, outfile)
+    finally:
+      stream.close()
+    return bases, os.path.getsize(path)
+  return run
+
+
+@benchmark("shard_input_plain", ["genotypes_plain"], "records")
+def _shard_input_plain(paths, scale):
+  return _shard_input_run(paths["genotypes_plain"], scale)
+
+
+@benchmark("shard_input_bgzf", ["genotypes_bgzf"], "records")
+def _shard_input_bgzf(paths, scale):
+  return _shard_input_run(paths["genotypes_bgzf"], scale)
+
+
+def _shard_input_run(path, scale):
+  import shard_input  # pylint: disable=g-import-not-at-top
+  records = _scaled(_GENOTYPE_RECORDS, scale)
+
+  def run():
+    with open(os.devnull, "wb") as outfile:
+      shard_input.write_range(path, outfile, 0, os.path.getsize(path), True,
+                              threads=multiprocessing.cpu_count())
+    return records, os.path.getsize(path)
+  return run
+
+
+@benchmark("add_from_vcf", ["large_header"], "headers")
+def _add_from_vcf(paths, scale):
+  import schema_update_utils  # pylint: disable=g-import-not-at-top
+  path = paths["large_header"]
+  header_size = len(synthetic_data.vcf_header(_HEADER_INFO_FIELDS, 50))
+  count = _scaled(_HEADER_PARSES, scale)
+
+  def run():
+    for _ in range(count):
+      schema_update_utils.Descriptions().add_from_vcf(path, cache_dir=None)
+    return count, count * header_size
+  return run
+
+
+@benchmark("render_templated_sql", [], "queries")
+def _render_templated_sql(unused_paths, scale):
+  import render_templated_sql  # pylint: disable=g-import-not-at-top
+  count = _scaled(_RENDERS, scale)
+
+  def run():
+    temp_dir = tempfile.mkdtemp()
+    output = os.path.join(temp_dir, "rendered.sql")
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    rendered_bytes = 0
+    # The script reads its templates from the working directory and prints
+    # the check query.
+    os.chdir(_SQL_DIR)
+    sys.stdout = open(os.devnull, "w")
+    try:
+      for i in range(count):
+        render_templated_sql.run([
+            "--sequence_table", "project.dataset.sequences",
+            "--b37" if i % 2 else "--b38", "--output", output])
+        rendered_bytes += os.path.getsize(output)
+    finally:
+      sys.stdout.close()
+      sys.stdout = stdout
+      os.chdir(cwd)
+      shutil.rmtree(temp_dir)
+    return count, rendered_bytes
+  return run
+
+
+@benchmark("transform_vep_output", ["vep_json"], "records")
+def _transform_vep_output(paths, scale):
+  import transform_vep_output  # pylint: disable=g-import-not-at-top
+  path = paths["vep_json"]
+  with open(synthetic_data.VEP_SCHEMA_PATH, "r") as f:
+    schema = json.load(f)
+  records = _scaled(_VEP_RECORDS, scale)
+
+  def run():
+    temp_dir = tempfile.mkdtemp()
+    try:
+      with open(path, "rb") as lines:
+        transform_vep_output.transform(
+            lines, schema, os.path.join(temp_dir, "output"))
+    finally:
+      shutil.rmtree(temp_dir)
+    return records, os.path.getsize(path)
+  return run
+
+
+def run_worker(name, paths, scale):
+  """Runs a benchmark once in this process and returns its measurements."""
+  try:
+    run = BENCHMARKS[name].setup(paths, scale)
+  except ImportError as e:
+    return {"skipped": "%s" % e}
+  before = resource.getrusage(resource.RUSAGE_SELF)
+  start = _clock()
+  items, num_bytes = run()
+  seconds = _clock() - start
+  after = resource.getrusage(resource.RUSAGE_SELF)
+  return {
+      "seconds": seconds,
+      "cpu_seconds": (after.ru_utime + after.ru_stime -
+                      before.ru_utime - before.ru_stime),
+      # Kilobytes on Linux.
+      "peak_rss_kb": after.ru_maxrss,
+      "items": items,
+      "bytes": num_bytes,
+  }
+
+
+def _median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_benchmark(name, paths, scale, repeat):
+  """Runs a benchmark repeat times, each in a new process.
+
+  Returns:
+    A dict of the results, or of the reason the benchmark was skipped.
+  """
+  runs = []
+  for _ in range(repeat):
+    fd, result_path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+      subprocess.check_call([
+          sys.executable, os.path.abspath(__file__), "--worker", name,
+          "--worker_paths", json.dumps(paths), "--worker_output", result_path,
+          "--scale", repr(scale)])
+      with open(result_path, "r") as f:
+        result = json.load(f)
+    finally:
+      os.remove(result_path)
+    if "skipped" in result:
+      return result
+    runs.append(result)
+
+  seconds = _median([r["seconds"] for r in runs])
+  return {
+      "unit": BENCHMARKS[name].unit,
+      "items": runs[0]["items"],
+      "bytes": runs[0]["bytes"],
+      "seconds": seconds,
+      "cpu_seconds": _median([r["cpu_seconds"] for r in runs]),
+      "peak_rss_kb": max(r["peak_rss_kb"] for r in runs),
+      "items_per_second": runs[0]["items"] / seconds,
+      "mb_per_second": runs[0]["bytes"] / seconds / 1e6,
+      "runs": runs,
+  }
+
+
+def compare(results, baseline, tolerance):
+  """Compares results with a baseline.
+
+  Args:
+    results: The "benchmarks" of a results file.
+    baseline: The "benchmarks" of the baseline results file.
+    tolerance: Largest allowed relative drop in throughput or growth in peak
+        memory.
+
+  Returns:
+    A tuple of (report lines, names of the benchmarks that regressed).
+  """
+  lines = ["%-22s %14s %14s %9s %11s %11s %9s" % (
+      "benchmark", "baseline/s", "current/s", "change", "base MB", "peak MB",
+      "change")]
+  regressions = []
+  for name, result in results.items():
+    base = baseline.get(name)
+    if "skipped" in result or not base or "skipped" in base:
+      lines.append("%-22s %s" % (
+          name, "skipped: " + result["skipped"] if "skipped" in result else
+          "not in the baseline"))
+      continue
+    speed = result["items_per_second"] / base["items_per_second"] - 1
+    memory = float(result["peak_rss_kb"]) / base["peak_rss_kb"] - 1
+    regressed = speed < -tolerance or memory > tolerance
+    if regressed:
+      regressions.append(name)
+    lines.append("%-22s %14.1f %14.1f %+8.1f%% %11.1f %11.1f %+8.1f%%%s" % (
+        name, base["items_per_second"], result["items_per_second"],
+        100 * speed, base["peak_rss_kb"] / 1024.0,
+        result["peak_rss_kb"] / 1024.0, 100 * memory,
+        "  REGRESSION" if regressed else ""))
+  return lines, regressions
+
+
+def format_results(results):
+  """Returns report lines of results without a baseline."""
+  lines = ["%-22s %16s %10s %10s %9s" % ("benchmark", "throughput", "MB/s",
+                                         "seconds", "peak MB")]
+  for name, result in results.items():
+    if "skipped" in result:
+      lines.append("%-22s skipped: %s" % (name, result["skipped"]))
+      continue
+    lines.append("%-22s %16s %10.1f %10.3f %9.1f" % (
+        name, "%.1f %s/s" % (result["items_per_second"], result["unit"]),
+        result["mb_per_second"], result["seconds"],
+        result["peak_rss_kb"] / 1024.0))
+  return lines
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      "--benchmark",
+      action="append",
+      choices=list(BENCHMARKS),
+      help="Benchmark to run.  May be repeated.  Defaults to all of them.")
+  parser.add_argument(
+      "--scale",
+      type=float,
+      default=1.0,
+      help="Size of the synthetic data relative to the defaults.")
+  parser.add_argument(
+      "--repeat",
+      type=int,
+      default=3,
+      help="Number of runs of each benchmark.")
+  parser.add_argument(
+      "--data_dir",
+      default=_DEFAULT_DATA_DIR,
+      help="Directory in which the synthetic data is generated and kept.")
+  parser.add_argument("--output", help="Path to which to write the results.")
+  parser.add_argument(
+      "--baseline", help="Results of an earlier run to compare with.")
+  parser.add_argument(
+      "--tolerance",
+      type=float,
+      default=0.15,
+      help="Relative drop in throughput or growth in peak memory reported as "
+      "a regression.")
+  parser.add_argument("--worker", help=argparse.SUPPRESS)
+  parser.add_argument("--worker_paths", help=argparse.SUPPRESS)
+  parser.add_argument("--worker_output", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+
+  if args.worker:
+    result = run_worker(args.worker, json.loads(args.worker_paths), args.scale)
+    with open(args.worker_output, "w") as f:
+      json.dump(result, f)
+    return
+
+  baseline = None
+  if args.baseline:
+    with open(args.baseline, "r") as f:
+      baseline = json.load(f)
+    if baseline["scale"] != args.scale:
+      parser.error("The baseline was run with --scale %g." %
+                   baseline["scale"])
+
+  names = args.benchmark or list(BENCHMARKS)
+  paths = prepare_data(args.data_dir, args.scale, sorted(set(
+      dataset for name in names for dataset in BENCHMARKS[name].datasets)))
+
+  results = collections.OrderedDict()
+  for name in names:
+    logging.info("Running %s", name)
+    results[name] = run_benchmark(name, paths, args.scale, args.repeat)
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump({
+          "created": datetime.datetime.utcnow().isoformat() + "Z",
+          "python": platform.python_version(),
+          "platform": platform.platform(),
+          "cpus": multiprocessing.cpu_count(),
+          "scale": args.scale,
+          "repeat": args.repeat,
+          "benchmarks": results,
+      }, f, indent=2, sort_keys=True)
+      f.write("\n")
+
+  if baseline is None:
+    print("\n".join(format_results(results)))
+    return
+  lines, regressions = compare(results, baseline["benchmarks"],
+                               args.tolerance)
+  print("\n".join(lines))
+  if regressions:
+    print("%d benchmarks regressed by more than %d%%: %s" % (
+        len(regressions), 100 * args.tolerance, ", ".join(regressions)),
+          file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
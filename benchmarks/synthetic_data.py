@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Generate deterministic synthetic inputs for the benchmarks.
+
+Every generator takes a seed, and the same arguments and seed always produce
+the same file with a given Python version, so timings of two revisions are
+measured on identical inputs.  The data is random but shaped like the real
+inputs:
+
+* FASTA: contigs of configurable lengths and line widths, with runs of N at
+  the ends of each contig and in gaps, and soft-masked (lowercase) repeats.
+* VCF: sites-only files with INFO annotations, or genotype-heavy files with
+  GT:AD:DP:GQ:PL for many samples, with SNVs, indels and multiallelic
+  records, either plain or BGZF compressed.  The header describes a
+  configurable number of INFO and FORMAT fields.
+* VEP JSON: one JSON object per line with the fields of vep_schema.json,
+  values of the schema's types and repeated consequence records.
+
+Example usage:
+
+python synthetic_data.py fasta --output ref.fa --contig_lengths 1000000,500000
+python synthetic_data.py vcf --output calls.vcf.gz --records 100000 \
+    --samples 100
+python synthetic_data.py vep_json --output output.json --records 10000
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_ROOT, "batch", "run_annotator"))
+
+import bgzf_utils  # pylint: disable=g-import-not-at-top
+
+VEP_SCHEMA_PATH = os.path.join(_ROOT, "batch", "run_annotator",
+                               "vep_schema.json")
+
+_BASES = b"ACGT"
+
+# Bases are sliced from a pool of random sequence, which is much faster than
+# choosing each base.
+_POOL_SIZE = 1 << 20
+
+_CONSEQUENCES = [
+    "missense_variant", "synonymous_variant", "intron_variant",
+    "upstream_gene_variant", "downstream_gene_variant", "stop_gained",
+    "splice_region_variant", "3_prime_UTR_variant", "5_prime_UTR_variant",
+    "non_coding_transcript_exon_variant", "frameshift_variant",
+    "intergenic_variant"
+]
+
+_PREDICTIONS = ["benign", "possibly_damaging", "probably_damaging",
+                "tolerated", "deleterious"]
+
+
+def _base_pool(rng):
+  bases = bytearray(_BASES)
+  return bytearray(bases[rng.randrange(4)] for _ in range(_POOL_SIZE))
+
+
+def _random_bases(rng, pool, length):
+  """Returns length random bases as bytes."""
+  parts = []
+  while length > 0:
+    size = min(length, _POOL_SIZE // 2)
+    start = rng.randrange(_POOL_SIZE - size + 1)
+    parts.append(bytes(pool[start:start + size]))
+    length -= size
+  return b"".join(parts)
+
+
+def _open_output(path):
+  return gzip.open(path, "wb") if path.endswith(".gz") else open(path, "wb")
+
+
+def contig_sequence(rng, pool, length, n_fraction=0.02, lowercase_fraction=0.1,
+                    run_length=2000):
+  """Returns the sequence of a synthetic contig.
+
+  Args:
+    rng: random.Random to draw from.
+    pool: Random bases from _base_pool.
+    length: Number of bases.
+    n_fraction: Approximate fraction of bases in runs of N, half of them at
+        the ends of the contig (as at telomeres) and half in gaps.
+    lowercase_fraction: Approximate fraction of bases in soft-masked runs.
+    run_length: Mean length of the N gaps and lowercase runs.
+
+  Returns:
+    The sequence, as a bytearray.
+  """
+  sequence = bytearray(_random_bases(rng, pool, length))
+  telomere = int(length * n_fraction / 4)
+  sequence[:telomere] = b"N" * telomere
+  sequence[length - telomere:] = b"N" * telomere
+
+  def runs(fraction):
+    for _ in range(int(length * fraction / run_length)):
+      size = max(1, int(rng.expovariate(1.0 / run_length)))
+      start = rng.randrange(max(1, length - size))
+      yield start, min(length, start + size)
+
+  for start, end in runs(lowercase_fraction):
+    sequence[start:end] = sequence[start:end].lower()
+  for start, end in runs(n_fraction / 2):
+    sequence[start:end] = b"N" * (end - start)
+  return sequence
+
+
+def write_fasta(path, contig_lengths, line_width=60, seed=0, **kwargs):
+  """Writes a synthetic FASTA file, gzip compressed if path ends in .gz.
+
+  Args:
+    path: Output path.
+    contig_lengths: List of contig lengths.  The contigs are named chr1, chr2,
+        etc.
+    line_width: Number of bases per line, or a list with one width per contig.
+    seed: Random seed.
+    **kwargs: Passed to contig_sequence.
+
+  Returns:
+    The total number of bases.
+  """
+  rng = random.Random(seed)
+  pool = _base_pool(rng)
+  if isinstance(line_width, int):
+    line_width = [line_width] * len(contig_lengths)
+  with _open_output(path) as f:
+    for number, (length, width) in enumerate(zip(contig_lengths, line_width),
+                                             1):
+      f.write(b">chr%d synthetic contig %d\n" % (number, number))
+      sequence = contig_sequence(rng, pool, length, **kwargs)
+      f.write(b"".join(bytes(sequence[i:i + width]) + b"\n"
+                       for i in range(0, length, width)))
+  return sum(contig_lengths)
+
+
+def vcf_header(num_info=20, num_format=5, num_filters=5, samples=()):
+  """Returns the lines of a VCF header, as bytes.
+
+  The fields used by the records (AC, AF, AN, DP and GT, AD, DP, GQ, PL) are
+  always described; num_info and num_format set the total number of fields
+  described, the others being placeholders with long descriptions.
+  """
+  lines = [
+      "##fileformat=VCFv4.2",
+      '##FILTER=<ID=PASS,Description="All filters passed">',
+  ]
+  for i in range(1, num_filters):
+    lines.append('##FILTER=<ID=Filter%d,Description="Site fails synthetic '
+                 'filter number %d, which has a long description">' % (i, i))
+  info = [("AC", "A", "Integer", "Allele count in genotypes"),
+          ("AF", "A", "Float", "Allele frequency"),
+          ("AN", "1", "Integer", "Total number of alleles in genotypes"),
+          ("DP", "1", "Integer", "Combined depth across samples")]
+  for i in range(len(info), num_info):
+    info.append(("INFO%d" % i, ".", "String",
+                 "Synthetic annotation number %d, which in real files might "
+                 "describe an annotation source and its version" % i))
+  for fields in info:
+    lines.append('##INFO=<ID=%s,Number=%s,Type=%s,Description="%s">' % fields)
+  formats = [("GT", "1", "String", "Genotype"),
+             ("AD", "R", "Integer", "Allelic depths"),
+             ("DP", "1", "Integer", "Read depth"),
+             ("GQ", "1", "Integer", "Genotype quality"),
+             ("PL", "G", "Integer", "Phred-scaled genotype likelihoods")]
+  for i in range(len(formats), num_format):
+    formats.append(("FMT%d" % i, "1", "String",
+                    "Synthetic per-sample field number %d" % i))
+  for fields in formats:
+    lines.append('##FORMAT=<ID=%s,Number=%s,Type=%s,Description="%s">' %
+                 fields)
+  columns = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO"]
+  if samples:
+    columns.append("FORMAT")
+    columns.extend(samples)
+  lines.append("\t".join(columns))
+  return ("\n".join(lines) + "\n").encode("ascii")
+
+
+def _genotypes(rng, num_alts, num_samples):
+  """Returns the FORMAT and sample columns of a record."""
+  columns = ["GT:AD:DP:GQ:PL"]
+  num_genotypes = (num_alts + 1) * (num_alts + 2) // 2
+  for _ in range(num_samples):
+    a = rng.randint(0, num_alts) if rng.random() < 0.3 else 0
+    b = rng.randint(0, num_alts) if rng.random() < 0.3 else 0
+    depths = [rng.randint(0, 40) for _ in range(num_alts + 1)]
+    likelihoods = [rng.randint(0, 999) for _ in range(num_genotypes)]
+    columns.append("%d/%d:%s:%d:%d:%s" % (
+        min(a, b), max(a, b), ",".join(map(str, depths)), sum(depths),
+        rng.randint(0, 99), ",".join(map(str, likelihoods))))
+  return columns
+
+
+def iter_vcf_records(rng, pool, num_records, contig_lengths, num_samples=0,
+                     indel_fraction=0.15, multiallelic_fraction=0.05):
+  """Yields the records of a synthetic VCF, as bytes, sorted by position.
+
+  Records are spread over the contigs in proportion to their lengths.
+  """
+  total_length = sum(contig_lengths)
+  for number, length in enumerate(contig_lengths, 1):
+    count = num_records * length // total_length
+    positions = sorted(rng.randrange(1, length) for _ in range(count))
+    for pos in positions:
+      ref = _random_bases(rng, pool, 1).decode("ascii")
+      if rng.random() < indel_fraction / 2:
+        ref += _random_bases(rng, pool, rng.randint(1, 10)).decode("ascii")
+      num_alts = rng.randint(2, 3) if rng.random() < multiallelic_fraction else 1
+      alts = []
+      while len(alts) < num_alts:
+        if len(ref) > 1 and rng.random() < 0.5:
+          alt = ref[0]
+        elif rng.random() < indel_fraction / 2:
+          alt = (ref[0] +
+                 _random_bases(rng, pool, rng.randint(1, 10)).decode("ascii") +
+                 ref[1:])
+        else:
+          alt = rng.choice([b for b in "ACGT" if b != ref[0]]) + ref[1:]
+        if alt not in alts:
+          alts.append(alt)
+      allele_counts = [rng.randint(1, 2 * max(1, num_samples))
+                       for _ in alts]
+      an = 2 * max(1, num_samples) * 2
+      info = "AC=%s;AF=%s;AN=%d;DP=%d" % (
+          ",".join(map(str, allele_counts)),
+          ",".join("%.4g" % (float(c) / an) for c in allele_counts), an,
+          rng.randint(10, 10000))
+      columns = ["chr%d" % number, str(pos), "rs%d" % rng.randrange(10 ** 8)
+                 if rng.random() < 0.5 else ".", ref, ",".join(alts),
+                 "%.1f" % (rng.random() * 1000),
+                 "PASS" if rng.random() < 0.9 else "Filter1", info]
+      if num_samples:
+        columns.extend(_genotypes(rng, len(alts), num_samples))
+      yield ("\t".join(columns) + "\n").encode("ascii")
+
+
+def write_vcf(path, num_records, contig_lengths=(10000000,), num_samples=0,
+              compression=None, seed=0, num_info=20, num_format=5, **kwargs):
+  """Writes a synthetic VCF.
+
+  Args:
+    path: Output path.
+    num_records: Approximate number of records.
+    contig_lengths: Lengths of the contigs chr1, chr2, etc.
+    num_samples: Number of sample columns.  0 writes a sites-only VCF.
+    compression: "bgzf", "gzip" or None for a plain file.  Defaults to "bgzf"
+        if path ends in .gz.
+    seed: Random seed.
+    num_info: Number of INFO fields described by the header.
+    num_format: Number of FORMAT fields described by the header.
+    **kwargs: Passed to iter_vcf_records.
+
+  Returns:
+    The number of records written.
+  """
+  rng = random.Random(seed)
+  pool = _base_pool(rng)
+  if compression is None and path.endswith(".gz"):
+    compression = "bgzf"
+  samples = ["SAMPLE%05d" % i for i in range(num_samples)]
+  written = 0
+  with open(path, "wb") as f:
+    if compression == "bgzf":
+      out = bgzf_utils.BgzfWriter(f)
+    elif compression == "gzip":
+      out = gzip.GzipFile(fileobj=f, mode="wb")
+    else:
+      out = f
+    out.write(vcf_header(num_info, num_format, samples=samples))
+    batch = []
+    for record in iter_vcf_records(rng, pool, num_records, contig_lengths,
+                                   num_samples, **kwargs):
+      batch.append(record)
+      written += 1
+      if len(batch) >= 1000:
+        out.write(b"".join(batch))
+        batch = []
+    out.write(b"".join(batch))
+    if out is not f:
+      out.close()
+  return written
+
+
+def _random_value(rng, field, context):
+  """Returns a random value for a scalar field of the VEP schema."""
+  name = field["name"]
+  if name in context:
+    return context[name]
+  if field["type"] == "integer":
+    return rng.randint(1, 100000)
+  if field["type"] == "float":
+    return round(rng.random(), 4)
+  if name in ("consequence_terms", "most_severe_consequence"):
+    return rng.choice(_CONSEQUENCES)
+  if name.endswith("_prediction"):
+    return rng.choice(_PREDICTIONS)
+  if name == "impact":
+    return rng.choice(["HIGH", "MODERATE", "LOW", "MODIFIER"])
+  if name.endswith("_id"):
+    return "ENS%s%011d" % (name[0].upper(), rng.randrange(10 ** 6))
+  return "%s_%d" % (name, rng.randrange(100))
+
+
+def _random_record(rng, fields, context, nullable_fraction):
+  """Returns a random JSON object for the fields of a record."""
+  record = {}
+  for field in fields:
+    mode = field.get("mode", "nullable")
+    if mode == "nullable" and rng.random() > nullable_fraction:
+      continue
+    if field["type"] == "record":
+      count = rng.randint(1, 4) if mode == "repeated" else 1
+      values = [_random_record(rng, field["fields"], context,
+                               nullable_fraction) for _ in range(count)]
+      record[field["name"]] = values if mode == "repeated" else values[0]
+    elif mode == "repeated":
+      record[field["name"]] = [_random_value(rng, field, context)
+                               for _ in range(rng.randint(1, 3))]
+    else:
+      record[field["name"]] = _random_value(rng, field, context)
+  return record
+
+
+def iter_vep_json(rng, pool, schema, num_records, nullable_fraction=0.5):
+  """Yields synthetic VEP JSON output lines matching a schema, as bytes."""
+  pos = 0
+  for number in range(num_records):
+    pos += rng.randint(1, 200)
+    ref = _random_bases(rng, pool, 1).decode("ascii")
+    alt = rng.choice([b for b in "ACGT" if b != ref])
+    context = {
+        "input": "chr1\t%d\t.\t%s\t%s\t.\t.\t." % (pos, ref, alt),
+        "id": "variant%d" % number,
+        "seq_region_name": "chr1",
+        "start": pos,
+        "end": pos,
+        "strand": 1,
+        "assembly_name": "GRCh38",
+        "allele_string": "%s/%s" % (ref, alt),
+        "variant_allele": alt,
+        "allele_num": 1,
+        "variant_class": "SNV",
+    }
+    record = _random_record(rng, schema, context, nullable_fraction)
+    yield (json.dumps(record, sort_keys=True) + "\n").encode("utf-8")
+
+
+def write_vep_json(path, num_records, schema_path=VEP_SCHEMA_PATH, seed=0,
+                   **kwargs):
+  """Writes synthetic VEP JSON output, gzip compressed if path ends in .gz.
+
+  Returns:
+    The number of records written.
+  """
+  rng = random.Random(seed)
+  pool = _base_pool(rng)
+  with open(schema_path, "r") as f:
+    schema = json.load(f)
+  with _open_output(path) as f:
+    for line in iter_vep_json(rng, pool, schema, num_records, **kwargs):
+      f.write(line)
+  return num_records
+
+
+def _int_list(text):
+  return [int(value) for value in text.split(",")]
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  subparsers = parser.add_subparsers(dest="command")
+
+  fasta = subparsers.add_parser(
+      "fasta", formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+      help="Write a synthetic FASTA file.")
+  fasta.add_argument(
+      "--contig_lengths",
+      type=_int_list,
+      default=[1000000],
+      help="Comma-separated contig lengths.")
+  fasta.add_argument(
+      "--line_width",
+      type=_int_list,
+      default=[60],
+      help="Bases per line, or comma-separated bases per line of each "
+      "contig.")
+
+  vcf = subparsers.add_parser(
+      "vcf", formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+      help="Write a synthetic VCF file.")
+  vcf.add_argument(
+      "--records", type=int, default=100000, help="Number of records.")
+  vcf.add_argument(
+      "--contig_lengths",
+      type=_int_list,
+      default=[10000000],
+      help="Comma-separated contig lengths.")
+  vcf.add_argument(
+      "--samples",
+      type=int,
+      default=0,
+      help="Number of samples.  0 writes a sites-only VCF.")
+  vcf.add_argument(
+      "--compression",
+      choices=("bgzf", "gzip", "plain"),
+      help="Compression of the output.  Defaults to bgzf for *.gz and plain "
+      "otherwise.")
+
+  vep_json = subparsers.add_parser(
+      "vep_json", formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+      help="Write synthetic VEP JSON output.")
+  vep_json.add_argument(
+      "--records", type=int, default=10000, help="Number of records.")
+  vep_json.add_argument(
+      "--schema", default=VEP_SCHEMA_PATH, help="BigQuery schema to follow.")
+
+  for subparser in (fasta, vcf, vep_json):
+    subparser.add_argument("--output", required=True, help="Output path.")
+    subparser.add_argument("--seed", type=int, default=0, help="Random seed.")
+  args = parser.parse_args()
+
+  if args.command == "fasta":
+    widths = args.line_width
+    if len(widths) == 1:
+      widths = widths * len(args.contig_lengths)
+    elif len(widths) != len(args.contig_lengths):
+      parser.error("--line_width needs one width or one per contig.")
+    count = write_fasta(args.output, args.contig_lengths, widths, args.seed)
+    print("Wrote %d bases" % count, file=sys.stderr)
+  elif args.command == "vcf":
+    compression = args.compression
+    if compression == "plain":
+      compression = ""
+    count = write_vcf(args.output, args.records, args.contig_lengths,
+                      args.samples, compression, args.seed)
+    print("Wrote %d records" % count, file=sys.stderr)
+  elif args.command == "vep_json":
+    count = write_vep_json(args.output, args.records, args.schema, args.seed)
+    print("Wrote %d records" % count, file=sys.stderr)
+  else:
+    parser.error("A command is required.")
+
+
+if __name__ == "__main__":
+  main()
@@ -8,9 +8,27 @@
     `end`,
     reference_bases,
     alternate_bases,
+    {%- if 'ESP_AA_AF' in columns.ESP_AA %}
     AF AS ESP_AA_AF,
+    {%- endif %}
+    {%- if 'ESP_AA_rsid' in columns.ESP_AA %}
     -- Used to check for correctness of the JOIN.
     names[OFFSET(0)] AS ESP_AA_rsid
+    {%- endif %}
   FROM
+    {%- if SOURCE_FILTER %}
+    (
+    SELECT
+      *
+    FROM
+      `{{ ESP_AA_TABLE }}`
+    WHERE
+      {{ SOURCE_FILTER }}) v,
+    {%- else %}
     `{{ ESP_AA_TABLE }}` v,
-    v.alternate_bases alternate_bases )
+    {%- endif %}
+    v.alternate_bases alternate_bases
+  {%- if ALLELE_FILTER %}
+  WHERE
+    {{ ALLELE_FILTER }}
+  {%- endif %} )
@@ -8,9 +8,27 @@
     `end`,
     reference_bases,
     alternate_bases,
+    {%- if 'ESP_EA_AF' in columns.ESP_EA %}
     AF AS ESP_EA_AF,
+    {%- endif %}
+    {%- if 'ESP_EA_rsid' in columns.ESP_EA %}
     -- Used to check for correctness of the JOIN.
     names[OFFSET(0)] AS ESP_EA_rsid
+    {%- endif %}
   FROM
+    {%- if SOURCE_FILTER %}
+    (
+    SELECT
+      *
+    FROM
+      `{{ ESP_EA_TABLE }}`
+    WHERE
+      {{ SOURCE_FILTER }}) v,
+    {%- else %}
     `{{ ESP_EA_TABLE }}` v,
-    v.alternate_bases alternate_bases )
+    {%- endif %}
+    v.alternate_bases alternate_bases
+  {%- if ALLELE_FILTER %}
+  WHERE
+    {{ ALLELE_FILTER }}
+  {%- endif %} )
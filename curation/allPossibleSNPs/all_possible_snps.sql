@@ -30,7 +30,12 @@
     base_pairs.bps base_pair
   WITH
   OFFSET
-    base_pair_offset),
+    base_pair_offset
+  {%- if BASE_FILTER %}
+  # Keep only the bases of the window of a partitioned query.
+  WHERE
+    {{ BASE_FILTER }}
+  {%- endif %}),
   --
   -- Create a table holding the four possible values for
   -- alternate_bases.
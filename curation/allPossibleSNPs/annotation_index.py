@@ -0,0 +1,802 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Export annotated SNPs to a memory-mapped index for fast local lookups.
+
+The input is the table produced by join_annotations.sql, as the
+newline-delimited JSON files written by join_annotations.py or exported from
+BigQuery, along with its BigQuery schema.  The index is a directory holding,
+for each contig:
+
+  contig-00000.keys.npy: Sorted uint64 keys, one per row, packing the start
+      of the row and its reference and alternate bases as
+      start << 6 | reference << 3 | alternate, where each base is the index of
+      its letter in "ACGTN".
+  contig-00000.rows.npy: A NumPy structured array of the annotation columns
+      of each row, in the order of the keys.  Text and repeated values are
+      (offset, length) pairs into the heap; a length of -1 is NULL.
+  contig-00000.heap: The UTF-8 text of the strings, and the JSON text of
+      repeated values.
+
+and annotation_index.json, which lists the contigs and columns.  All of the
+files are memory mapped when the index is opened, so only the pages that a
+lookup touches are read, and a lookup of a batch of variants is a vectorized
+binary search of the keys of each contig.
+
+By default only rows with at least one annotation are indexed; a variant that
+is not found has no annotations.
+
+Example usage:
+
+python annotation_index.py build \
+    --input 'joined/GRCh38_Verily_v1-0*.json.gz' \
+    --schema joined/GRCh38_Verily_v1-schema.json \
+    --output_dir GRCh38_Verily_v1_index
+
+python annotation_index.py query \
+    --index GRCh38_Verily_v1_index \
+    --variant 17:41197708:G:A \
+    --region chr17:41196312-41277499
+
+and from Python:
+
+  index = annotation_index.AnnotationIndex("GRCh38_Verily_v1_index")
+  index.lookup("17", 41197707, "G", "A")
+  index.lookup_batch(names, starts, reference_bases, alternate_bases)
+  index.range("17", 41196311, 41277499, columns=["CLNSIG"])
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import collections
+import glob
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+import fasta_to_kv
+
+MANIFEST = "annotation_index.json"
+
+FORMAT_VERSION = 1
+
+# The columns of all possible SNPs, as in all_possible_snps.sql.  All other
+# columns of the schema are annotations.
+SNP_COLUMNS = ("reference_name", "original_reference_name", "start", "end",
+               "reference_bases", "original_reference_bases",
+               "alternate_bases")
+
+# The columns of the rows returned by lookups, before the annotations.
+KEY_COLUMNS = ("reference_name", "start", "end", "reference_bases",
+               "alternate_bases")
+
+BASES = "ACGTN"
+_BASE_BITS = 3
+_POSITION_SHIFT = 2 * _BASE_BITS
+_BASE_MASK = (1 << _BASE_BITS) - 1
+
+# Maps each byte to the code of the base, or _NO_BASE.
+_NO_BASE = 0xFF
+_BASE_CODES = np.full(256, _NO_BASE, dtype=np.uint8)
+for _code, _base in enumerate(BASES):
+  _BASE_CODES[ord(_base)] = _code
+  _BASE_CODES[ord(_base.lower())] = _code
+
+# The same, for single bases in rows that are added one at a time.
+_BASE_INDEX = dict((base, code) for code, base in enumerate(BASES))
+_BASE_INDEX.update((base.lower(), code) for code, base in enumerate(BASES))
+
+_INT_NULL = np.iinfo(np.int64).min
+
+_DEFAULT_ROWS_PER_CHUNK = 1 << 20
+
+# Rows copied at a time when a contig is written in sorted order.
+_COPY_BLOCK_ROWS = 1 << 20
+
+_TEXT_DTYPE = np.dtype([("offset", "<u8"), ("length", "<i4")])
+
+_STORAGE_DTYPES = {
+    "int": np.dtype("<i8"),
+    "float": np.dtype("<f8"),
+    "bool": np.dtype("i1"),
+    "string": _TEXT_DTYPE,
+    "json": _TEXT_DTYPE,
+}
+
+# An annotation column and how its values are stored: "int", "float" or
+# "bool" for scalars in the rows, "string" or "json" for text in the heap.
+Column = collections.namedtuple("Column", ["name", "kind"])
+
+
+def column_kind(field):
+  """Returns how a column of a BigQuery schema is stored in the index."""
+  if field.get("mode") == "REPEATED" or field["type"] in ("RECORD", "STRUCT"):
+    return "json"
+  if field["type"] in ("INTEGER", "INT64"):
+    return "int"
+  if field["type"] in ("FLOAT", "FLOAT64"):
+    return "float"
+  if field["type"] in ("BOOLEAN", "BOOL"):
+    return "bool"
+  return "string"
+
+
+def annotation_columns(schema, names=None):
+  """Returns the Columns of the annotations in a BigQuery schema.
+
+  Args:
+    schema: List of BigQuery schema fields of the joined table.
+    names: The names of the columns to keep, or None for all annotations.
+
+  Raises:
+    ValueError: If a name is not an annotation column of the schema.
+  """
+  columns = [Column(field["name"], column_kind(field)) for field in schema
+             if field["name"] not in SNP_COLUMNS]
+  if names is None:
+    return columns
+  known = set(column.name for column in columns)
+  unknown = [name for name in names if name not in known]
+  if unknown:
+    raise ValueError("Not annotation columns of the schema: %s" %
+                     ", ".join(unknown))
+  return [column for column in columns if column.name in names]
+
+
+def row_dtype(columns):
+  """Returns the dtype of the rows of an index with the given Columns."""
+  return np.dtype([(str(column.name), _STORAGE_DTYPES[column.kind])
+                   for column in columns])
+
+
+def pack_keys(starts, reference_codes, alternate_codes):
+  """Returns the uint64 keys of rows from their starts and base codes."""
+  return ((np.asarray(starts, dtype=np.uint64) << np.uint64(_POSITION_SHIFT)) |
+          (np.asarray(reference_codes, dtype=np.uint64) <<
+           np.uint64(_BASE_BITS)) |
+          np.asarray(alternate_codes, dtype=np.uint64))
+
+
+def encode_bases(values):
+  """Returns the codes of single bases, or _NO_BASE for anything else.
+
+  Args:
+    values: A sequence or array of str or bytes.
+  """
+  if isinstance(values, (list, tuple)) and values:
+    # Most lookups are of single bases, which are encoded without building
+    # an array of strings.  If no value is empty and the lengths add up to
+    # the number of values, then each value is a single character.
+    empty = values[0][:0]
+    try:
+      joined = empty.join(values)
+      if len(joined) == len(values) and empty not in values:
+        if not isinstance(joined, bytes):
+          joined = joined.encode("latin-1")
+        return _BASE_CODES[np.frombuffer(joined, dtype=np.uint8)]
+    except (TypeError, UnicodeError):
+      pass
+  values = np.asarray(values)
+  if values.dtype.kind == "U":
+    single = np.char.str_len(values) == 1
+    chars = values.astype("U1").view(np.uint32)
+    codes = _BASE_CODES[np.minimum(chars, 255)]
+    codes[chars > 255] = _NO_BASE
+  elif values.dtype.kind == "S":
+    single = np.char.str_len(values) == 1
+    codes = _BASE_CODES[values.astype("S1").view(np.uint8)]
+  else:
+    raise TypeError("Bases must be strings, not %s" % values.dtype)
+  codes[~single] = _NO_BASE
+  return codes
+
+
+class _ContigWriter(object):
+  """Accumulates the rows of one contig in temporary files."""
+
+  def __init__(self, prefix, reference_name, original_reference_name, dtype,
+               rows_per_chunk):
+    self.prefix = prefix
+    self.reference_name = reference_name
+    self.original_reference_name = original_reference_name
+    self.dtype = dtype
+    self.rows_per_chunk = rows_per_chunk
+    self.count = 0
+    self.sorted = True
+    self._last_key = -1
+    self._keys = []
+    self._values = []
+    self._text = []
+    self._heap_size = 0
+    # The files are only opened to append each chunk, so that the number of
+    # contigs is not limited by the number of open files.
+    for suffix in (".keys.tmp", ".rows.tmp", ".heap"):
+      open(prefix + suffix, "wb").close()
+
+  def add_text(self, text):
+    """Appends text to the heap, returning its (offset, length)."""
+    if text is None:
+      return (0, -1)
+    data = text.encode("utf-8")
+    offset = self._heap_size
+    self._text.append(data)
+    self._heap_size += len(data)
+    return (offset, len(data))
+
+  def add(self, key, values):
+    if key < self._last_key:
+      self.sorted = False
+    self._last_key = key
+    self._keys.append(key)
+    self._values.append(values)
+    self.count += 1
+    if len(self._values) >= self.rows_per_chunk:
+      self.flush()
+
+  def flush(self):
+    if self._values:
+      with open(self.prefix + ".keys.tmp", "ab") as f:
+        f.write(np.array(self._keys, dtype=np.uint64).tobytes())
+      with open(self.prefix + ".rows.tmp", "ab") as f:
+        f.write(np.array(self._values, dtype=self.dtype).tobytes())
+      with open(self.prefix + ".heap", "ab") as f:
+        f.write(b"".join(self._text))
+      self._keys = []
+      self._values = []
+      self._text = []
+
+  def finish(self):
+    """Writes the keys and rows sorted by key, and returns their count."""
+    self.flush()
+    keys = np.fromfile(self.prefix + ".keys.tmp", dtype=np.uint64)
+    raw = np.memmap(self.prefix + ".rows.tmp", dtype=self.dtype, mode="r",
+                    shape=(self.count,))
+    order = None if self.sorted else np.argsort(keys, kind="mergesort")
+    rows = np.lib.format.open_memmap(self.prefix + ".rows.npy", mode="w+",
+                                     dtype=self.dtype, shape=(self.count,))
+    for i in range(0, self.count, _COPY_BLOCK_ROWS):
+      block = slice(i, i + _COPY_BLOCK_ROWS)
+      rows[block] = raw[block] if order is None else raw[order[block]]
+    rows.flush()
+    del rows, raw
+    np.save(self.prefix + ".keys.npy", keys if order is None else keys[order])
+    os.remove(self.prefix + ".keys.tmp")
+    os.remove(self.prefix + ".rows.tmp")
+    return self.count
+
+
+class IndexWriter(object):
+  """Writes rows of the joined table to an AnnotationIndex directory."""
+
+  def __init__(self, output_dir, schema, columns=None, keep_unannotated=False,
+               rows_per_chunk=_DEFAULT_ROWS_PER_CHUNK):
+    """Create IndexWriter class.
+
+    Args:
+      output_dir: The directory of the index, created if needed.
+      schema: List of BigQuery schema fields of the joined table.
+      columns: The names of the annotation columns to index, or None for all.
+      keep_unannotated: Whether to index rows without any annotation.
+      rows_per_chunk: Number of rows of a contig held in memory before they
+          are appended to its temporary file.
+    """
+    if not os.path.isdir(output_dir):
+      os.makedirs(output_dir)
+    self.output_dir = output_dir
+    self.schema = schema
+    self.columns = annotation_columns(schema, columns)
+    self.dtype = row_dtype(self.columns)
+    self.keep_unannotated = keep_unannotated
+    self.rows_per_chunk = rows_per_chunk
+    self.skipped = collections.Counter()
+    self._contigs = collections.OrderedDict()
+    # A row can only be annotated if the name of an indexed column appears in
+    # its JSON text, so other lines are skipped without being parsed.
+    self._names = re.compile("|".join(
+        re.escape(json.dumps(column.name)) for column in self.columns).encode(
+            "utf-8"))
+
+  def _contig(self, row):
+    name = row["reference_name"]
+    contig = self._contigs.get(name)
+    if contig is None:
+      prefix = os.path.join(self.output_dir,
+                            "contig-%05d" % len(self._contigs))
+      contig = _ContigWriter(prefix, name,
+                             row.get("original_reference_name", name),
+                             self.dtype, self.rows_per_chunk)
+      self._contigs[name] = contig
+    return contig
+
+  def add_line(self, line):
+    """Adds one newline-delimited JSON row, given as bytes."""
+    if not self.keep_unannotated and not self._names.search(line):
+      self.skipped["unannotated"] += 1
+      return
+    self.add(json.loads(line.decode("utf-8")))
+
+  def add(self, row):
+    """Adds one row, given as a dictionary from column name to value."""
+    values = [row.get(column.name) for column in self.columns]
+    if not self.keep_unannotated and all(
+        value is None or value == [] for value in values):
+      self.skipped["unannotated"] += 1
+      return
+    reference_code = _BASE_INDEX.get(row["reference_bases"])
+    alternate_code = _BASE_INDEX.get(row["alternate_bases"])
+    if reference_code is None or alternate_code is None:
+      self.skipped["bases"] += 1
+      return
+    contig = self._contig(row)
+    key = ((int(row["start"]) << _POSITION_SHIFT) |
+           (reference_code << _BASE_BITS) | alternate_code)
+    stored = []
+    for column, value in zip(self.columns, values):
+      if column.kind == "int":
+        stored.append(_INT_NULL if value is None else int(value))
+      elif column.kind == "float":
+        stored.append(np.nan if value is None else float(value))
+      elif column.kind == "bool":
+        stored.append(-1 if value is None else int(value in (True, "true")))
+      elif column.kind == "string":
+        stored.append(contig.add_text(value))
+      else:
+        stored.append(contig.add_text(
+            None if value is None else json.dumps(value)))
+    contig.add(key, tuple(stored))
+
+  def close(self):
+    """Sorts and writes each contig, then the manifest.
+
+    Returns:
+      The number of rows indexed.
+    """
+    contigs = []
+    for contig in self._contigs.values():
+      count = contig.finish()
+      logging.info("Indexed %d rows of %s", count, contig.reference_name)
+      contigs.append({
+          "reference_name": contig.reference_name,
+          "original_reference_name": contig.original_reference_name,
+          "prefix": os.path.basename(contig.prefix),
+          "rows": count,
+      })
+    if self.skipped["bases"]:
+      logging.warning("Skipped %d rows whose bases are not one of %s",
+                      self.skipped["bases"], BASES)
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "columns": [column._asdict() for column in self.columns],
+        "schema": self.schema,
+        "contigs": contigs,
+    }
+    with open(os.path.join(self.output_dir, MANIFEST), "w") as outfile:
+      json.dump(manifest, outfile, indent=2)
+    return sum(contig["rows"] for contig in contigs)
+
+
+def build_index(paths, schema, output_dir, columns=None,
+                keep_unannotated=False):
+  """Builds an index from files of the joined table.
+
+  Args:
+    paths: Paths of plain or compressed newline-delimited JSON files.
+    schema: List of BigQuery schema fields of the joined table.
+    output_dir: The directory of the index.
+    columns: The names of the annotation columns to index, or None for all.
+    keep_unannotated: Whether to index rows without any annotation.
+
+  Returns:
+    The number of rows indexed.
+  """
+  writer = IndexWriter(output_dir, schema, columns, keep_unannotated)
+  for path in paths:
+    logging.info("Reading %s", path)
+    for line in fasta_to_kv.open_fasta(path):
+      if line.strip():
+        writer.add_line(line)
+  return writer.close()
+
+
+class _ContigIndex(object):
+  """The memory-mapped keys, rows and heap of one contig."""
+
+  def __init__(self, directory, entry):
+    prefix = os.path.join(directory, entry["prefix"])
+    self.reference_name = entry["reference_name"]
+    # Plain arrays over the memory maps avoid the overhead of indexing
+    # np.memmap objects.
+    self.keys = np.asarray(np.load(prefix + ".keys.npy", mmap_mode="r"))
+    self.rows = np.asarray(np.load(prefix + ".rows.npy", mmap_mode="r"))
+    if os.path.getsize(prefix + ".heap"):
+      self.heap = np.memmap(prefix + ".heap", dtype=np.uint8, mode="r")
+    else:
+      self.heap = np.zeros(0, dtype=np.uint8)
+
+  def find(self, keys):
+    """Returns the [first, last) rows of each key, as two int64 arrays."""
+    # Searching for keys in sorted order visits the pages of the keys in
+    # order, and lets each search start from the previous one.
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    found_first = np.searchsorted(self.keys, sorted_keys, side="left")
+    found_last = found_first.copy()
+    # Most keys are absent or unique, so the ends are only searched for keys
+    # that were found.
+    in_range = found_first < len(self.keys)
+    found = np.flatnonzero(in_range)[
+        self.keys[found_first[in_range]] == sorted_keys[in_range]]
+    found_last[found] = np.searchsorted(self.keys, sorted_keys[found],
+                                        side="right")
+    first = np.empty(len(keys), dtype=np.int64)
+    last = np.empty(len(keys), dtype=np.int64)
+    first[order] = found_first
+    last[order] = found_last
+    return first, last
+
+  def text(self, values):
+    """Returns an object array of the text of (offset, length) values."""
+    heap = self.heap
+    result = np.empty(len(values), dtype=object)
+    for i, (offset, length) in enumerate(values.tolist()):
+      if length >= 0:
+        result[i] = heap[offset:offset + length].tobytes().decode("utf-8")
+    return result
+
+
+def _expand_ranges(first, last):
+  """Returns the indices of all the ranges and the range of each index."""
+  counts = last - first
+  total = int(counts.sum())
+  owners = np.repeat(np.arange(len(first), dtype=np.int64), counts)
+  starts = np.cumsum(counts) - counts
+  indices = np.repeat(first, counts) + (
+      np.arange(total, dtype=np.int64) - np.repeat(starts, counts))
+  return indices, owners
+
+
+class AnnotationIndex(object):
+  """Lookups of variants in an index written by IndexWriter.
+
+  Positions are 0-based as in the start column of the table.  Contigs may be
+  named with or without the "chr" prefix.
+
+  Batch and range lookups return an OrderedDict from column name to a NumPy
+  array with one element per matching row, suitable for
+  pandas.DataFrame(result): the KEY_COLUMNS, then the requested annotation
+  columns.  FLOAT columns are float64 arrays with NaN for NULL; other columns
+  are object arrays with None for NULL, and lists for repeated columns.
+  """
+
+  def __init__(self, directory):
+    with open(os.path.join(directory, MANIFEST), "r") as f:
+      manifest = json.load(f)
+    if manifest["format_version"] != FORMAT_VERSION:
+      raise ValueError("Unsupported index format %s in %s" %
+                       (manifest["format_version"], directory))
+    self.directory = directory
+    self.schema = manifest["schema"]
+    self.columns = [Column(c["name"], c["kind"]) for c in manifest["columns"]]
+    self._entries = {}
+    for entry in manifest["contigs"]:
+      self._entries[entry["reference_name"]] = entry
+      self._entries.setdefault(entry["original_reference_name"], entry)
+    self._contigs = {}
+
+  @property
+  def contigs(self):
+    """The reference names of the indexed contigs."""
+    return sorted(set(entry["reference_name"]
+                      for entry in self._entries.values()))
+
+  def _contig(self, name):
+    """Returns the _ContigIndex of a contig, or None if it has no rows."""
+    entry = self._entries.get(name)
+    if entry is None and name.startswith("chr"):
+      entry = self._entries.get(name[3:])
+    if entry is None:
+      return None
+    contig = self._contigs.get(entry["reference_name"])
+    if contig is None:
+      contig = _ContigIndex(self.directory, entry)
+      self._contigs[entry["reference_name"]] = contig
+    return contig
+
+  def _columns(self, names):
+    if names is None:
+      return self.columns
+    by_name = dict((column.name, column) for column in self.columns)
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+      raise KeyError("Columns not in the index: %s" % ", ".join(unknown))
+    return [by_name[name] for name in names]
+
+  def _decode(self, contig, indices, columns):
+    """Returns the KEY_COLUMNS and columns of rows of a contig."""
+    result = collections.OrderedDict()
+    keys = np.asarray(contig.keys[indices], dtype=np.uint64)
+    starts = (keys >> np.uint64(_POSITION_SHIFT)).astype(np.int64)
+    bases = np.array(list(BASES), dtype=object)
+    result["reference_name"] = np.full(len(indices), contig.reference_name,
+                                       dtype=object)
+    result["start"] = starts
+    result["end"] = starts + 1
+    result["reference_bases"] = bases[
+        (keys >> np.uint64(_BASE_BITS)) & np.uint64(_BASE_MASK)]
+    result["alternate_bases"] = bases[keys & np.uint64(_BASE_MASK)]
+    if not len(indices):
+      for column in columns:
+        result[column.name] = np.zeros(
+            0, dtype=np.float64 if column.kind == "float" else object)
+      return result
+    rows = contig.rows[indices]
+    for column in columns:
+      values = rows[column.name]
+      if column.kind == "float":
+        result[column.name] = np.asarray(values, dtype=np.float64)
+        continue
+      if column.kind in ("string", "json"):
+        decoded = contig.text(values)
+        if column.kind == "json":
+          decoded[:] = [None if value is None else json.loads(value)
+                        for value in decoded]
+      elif column.kind == "int":
+        decoded = values.astype(object)
+        decoded[values == _INT_NULL] = None
+      else:
+        decoded = (values == 1).astype(object)
+        decoded[values < 0] = None
+      result[column.name] = decoded
+    return result
+
+  def lookup_batch(self, reference_names, starts, reference_bases,
+                   alternate_bases, columns=None):
+    """Looks up a batch of variants.
+
+    Args:
+      reference_names: The contig of each variant, or one contig for all.
+      starts: The 0-based positions of the variants.
+      reference_bases: The reference base of each variant.
+      alternate_bases: The alternate base of each variant.
+      columns: The annotation columns to return, or None for all of them.
+
+    Returns:
+      An OrderedDict of arrays as described in the class docstring, whose
+      first column, "query", holds the index of the variant each row matches.
+      Variants that are not found have no rows; variants with several rows in
+      the table have one for each.
+    """
+    columns = self._columns(columns)
+    starts = np.asarray(starts, dtype=np.int64)
+    reference_codes = encode_bases(reference_bases)
+    alternate_codes = encode_bases(alternate_bases)
+    valid = ((starts >= 0) & (reference_codes != _NO_BASE) &
+             (alternate_codes != _NO_BASE))
+    keys = pack_keys(np.where(valid, starts, 0), reference_codes & _BASE_MASK,
+                     alternate_codes & _BASE_MASK)
+    if isinstance(reference_names, (str, bytes)) or not hasattr(
+        reference_names, "__len__"):
+      groups = [(reference_names, np.arange(len(starts)))]
+    else:
+      names = np.asarray(reference_names, dtype=object)
+      groups = [(name, np.flatnonzero(names == name)) for name in set(names)]
+
+    parts = []
+    for name, queries in groups:
+      contig = self._contig(name)
+      queries = queries[valid[queries]]
+      if contig is None or not len(queries):
+        continue
+      first, last = contig.find(keys[queries])
+      indices, owners = _expand_ranges(first, last)
+      if not len(indices):
+        continue
+      part = collections.OrderedDict([("query", queries[owners])])
+      part.update(self._decode(contig, indices, columns))
+      parts.append(part)
+
+    if not parts:
+      part = collections.OrderedDict([("query", np.zeros(0, dtype=np.int64))])
+      part.update(self._decode(_EMPTY_CONTIG, np.zeros(0, dtype=np.int64),
+                               columns))
+      return part
+    if len(parts) == 1:
+      return parts[0]
+    result = collections.OrderedDict(
+        (name, np.concatenate([part[name] for part in parts]))
+        for name in parts[0])
+    order = np.argsort(result["query"], kind="mergesort")
+    return collections.OrderedDict(
+        (name, values[order]) for name, values in result.items())
+
+  def lookup(self, reference_name, start, reference_bases, alternate_bases):
+    """Looks up one variant.
+
+    Returns:
+      A list of OrderedDicts of the values of the KEY_COLUMNS and annotation
+      columns, with None for NULL, one for each row of the variant.
+    """
+    contig = self._contig(reference_name)
+    reference_code = _BASE_INDEX.get(reference_bases)
+    alternate_code = _BASE_INDEX.get(alternate_bases)
+    if (contig is None or reference_code is None or alternate_code is None or
+        start < 0):
+      return []
+    key = np.uint64((start << _POSITION_SHIFT) |
+                    (reference_code << _BASE_BITS) | alternate_code)
+    first = contig.keys.searchsorted(key, side="left")
+    if first == len(contig.keys) or contig.keys[first] != key:
+      return []
+    last = contig.keys.searchsorted(key, side="right")
+    return _as_dicts(self._decode(contig, np.arange(first, last),
+                                  self.columns))
+
+  def range(self, reference_name, start, end, columns=None):
+    """Returns the rows of a region.
+
+    Args:
+      reference_name: The contig of the region.
+      start: The 0-based start of the region.
+      end: The 0-based, exclusive end of the region, or None for the rest of
+          the contig.
+      columns: The annotation columns to return, or None for all of them.
+
+    Returns:
+      An OrderedDict of arrays as described in the class docstring.
+    """
+    columns = self._columns(columns)
+    contig = self._contig(reference_name) or _EMPTY_CONTIG
+    first = np.searchsorted(contig.keys, pack_keys(max(start, 0), 0, 0))
+    last = len(contig.keys) if end is None else np.searchsorted(
+        contig.keys, pack_keys(max(end, 0), 0, 0))
+    return self._decode(contig, np.arange(first, max(first, last)), columns)
+
+
+def _as_dicts(result):
+  """Converts an OrderedDict of arrays to a list of OrderedDicts."""
+  names = list(result)
+  rows = []
+  for values in zip(*[result[name].tolist() for name in names]):
+    rows.append(collections.OrderedDict(
+        (name, None if isinstance(value, float) and np.isnan(value) else value)
+        for name, value in zip(names, values)))
+  return rows
+
+
+class _EmptyContig(object):
+  reference_name = ""
+  keys = np.zeros(0, dtype=np.uint64)
+
+
+_EMPTY_CONTIG = _EmptyContig()
+
+
+def parse_variant(variant):
+  """Parses a variant given as CHROM:POS:REF:ALT with a 1-based POS.
+
+  Returns:
+    A tuple of (reference_name, start, reference_bases, alternate_bases) with
+    a 0-based start.
+
+  Raises:
+    ValueError: If the variant cannot be parsed.
+  """
+  parts = variant.strip().rsplit(":", 3)
+  if len(parts) != 4 or not parts[1].isdigit() or int(parts[1]) < 1:
+    raise ValueError("Failed to parse variant: %s" % variant)
+  return parts[0], int(parts[1]) - 1, parts[2], parts[3]
+
+
+def run(argv=None):
+  """Main entry point."""
+  parser = argparse.ArgumentParser(
+      description="Build or query a memory-mapped index of annotated SNPs.")
+  subparsers = parser.add_subparsers(dest="command")
+  subparsers.required = True
+
+  build = subparsers.add_parser(
+      "build", help="Index files of the joined table.")
+  build.add_argument(
+      "--input",
+      action="append",
+      required=True,
+      help="Newline-delimited JSON files, plain or compressed, of the table "
+      "produced by join_annotations.sql.  May be a glob, and may be "
+      "repeated.")
+  build.add_argument(
+      "--schema",
+      required=True,
+      help="The BigQuery schema of the table as JSON, as written by "
+      "join_annotations.py or by bq show --schema.")
+  build.add_argument(
+      "--output_dir", required=True, help="The directory of the index.")
+  build.add_argument(
+      "--column",
+      action="append",
+      help="An annotation column to index, e.g. CLNSIG.  May be repeated.  "
+      "Defaults to all of them.")
+  build.add_argument(
+      "--keep_unannotated",
+      action="store_true",
+      help="Also index the rows without any annotation.")
+
+  query = subparsers.add_parser(
+      "query", help="Print the rows of variants or regions as JSON.")
+  query.add_argument("--index", required=True, help="The index directory.")
+  query.add_argument(
+      "--variant",
+      action="append",
+      default=[],
+      help="A variant as CHROM:POS:REF:ALT, with a 1-based POS as in VCF.  "
+      "May be repeated.")
+  query.add_argument(
+      "--region",
+      action="append",
+      default=[],
+      help="A samtools-style region such as chr17:41196312-41277499.  May "
+      "be repeated.")
+  query.add_argument(
+      "--column",
+      action="append",
+      help="An annotation column to print.  May be repeated.  Defaults to "
+      "all of them.")
+
+  args = parser.parse_args(argv)
+
+  if args.command == "build":
+    paths = []
+    for pattern in args.input:
+      matches = sorted(glob.glob(pattern))
+      if not matches:
+        parser.error("No files match --input %s" % pattern)
+      paths.extend(matches)
+    with open(args.schema, "r") as f:
+      schema = json.load(f)
+    count = build_index(paths, schema, args.output_dir, args.column,
+                        args.keep_unannotated)
+    logging.info("Indexed %d rows in %s", count, args.output_dir)
+    return
+
+  index = AnnotationIndex(args.index)
+  results = []
+  if args.variant:
+    try:
+      variants = [parse_variant(variant) for variant in args.variant]
+    except ValueError as e:
+      parser.error(str(e))
+    names, starts, references, alternates = zip(*variants)
+    result = index.lookup_batch(list(names), starts, references, alternates,
+                                args.column)
+    del result["query"]
+    results.append(result)
+  for region in args.region:
+    try:
+      name, start, end = fasta_to_kv.parse_region(region)
+    except ValueError as e:
+      parser.error(str(e))
+    results.append(index.range(name, start, end, args.column))
+  for result in results:
+    for row in _as_dicts(result):
+      print(json.dumps(row))
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  run()
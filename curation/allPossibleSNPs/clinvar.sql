@@ -8,22 +8,49 @@
     `end`,
     reference_bases,
     alternate_bases,
+    {%- if 'clinvar_rsid' in columns.clinvar %}
     -- Used to check for correctness of the JOIN.
     CONCAT('rs', CAST(RS AS STRING)) AS clinvar_rsid,
+    {%- endif %}
     -- ClinVar uses field CLNALLE to indicate "variant alleles from REF
     -- or ALT columns.  0 is REF, 1 is the first ALT allele, etc.  This
     -- is used to match alleles with other corresponding clinical (CLN)
     -- INFO tags.  A value of -1 indicates that no allele was found to
     -- match a corresponding HGVS allele name."
+    {%- if 'CLNDBN' in columns.clinvar %}
     CLNDBN[OFFSET(clnalle_offset)] AS CLNDBN,
+    {%- endif %}
+    {%- if 'CLNACC' in columns.clinvar %}
     CLNACC[OFFSET(clnalle_offset)] AS CLNACC,
+    {%- endif %}
+    {%- if 'CLNDSDB' in columns.clinvar %}
     CLNDSDB[OFFSET(clnalle_offset)] AS CLNDSDB,
+    {%- endif %}
+    {%- if 'CLNDSDBID' in columns.clinvar %}
     CLNDSDBID[OFFSET(clnalle_offset)] AS CLNDSDBID,
+    {%- endif %}
+    {%- if 'CLNREVSTAT' in columns.clinvar %}
     CLNREVSTAT[OFFSET(clnalle_offset)] AS CLNREVSTAT,
+    {%- endif %}
+    {%- if 'CLNSIG' in columns.clinvar %}
     CLNSIG[OFFSET(clnalle_offset)] AS CLNSIG
+    {%- endif %}
   FROM
+    {%- if SOURCE_FILTER %}
+    (
+    SELECT
+      *
+    FROM
+      `{{ CLINVAR_TABLE }}`
+    WHERE
+      {{ SOURCE_FILTER }}) v,
+    {%- else %}
     `{{ CLINVAR_TABLE }}` v,
+    {%- endif %}
     UNNEST(ARRAY_CONCAT([reference_bases], v.alternate_bases)) AS alternate_bases WITH OFFSET alt_offset,
     v.CLNALLE clnalle WITH OFFSET clnalle_offset
   WHERE
-    clnalle = alt_offset)
+    clnalle = alt_offset
+    {%- if ALLELE_FILTER %}
+    AND {{ ALLELE_FILTER }}
+    {%- endif %})
@@ -12,10 +12,30 @@
     `end`,
     reference_bases, -- on the + strand
     alternate_bases, -- on the + strand
+    {%- if 'rs_names' in columns.dbSNP %}
     names AS rs_names,
+    {%- endif %}
+    {%- if 'RS' in columns.dbSNP %}
     RS,
+    {%- endif %}
+    {%- if 'dbSNP_rsid' in columns.dbSNP %}
     -- Used to check for correctness of the JOIN.
     CONCAT('rs', CAST(RS AS STRING)) AS dbSNP_rsid
+    {%- endif %}
   FROM
+    {%- if SOURCE_FILTER %}
+    (
+    SELECT
+      *
+    FROM
+      `{{ DBSNP_TABLE }}`
+    WHERE
+      {{ SOURCE_FILTER }}) v,
+    {%- else %}
     `{{ DBSNP_TABLE }}` v,
-    v.alternate_bases alternate_bases )
+    {%- endif %}
+    v.alternate_bases alternate_bases
+  {%- if ALLELE_FILTER %}
+  WHERE
+    {{ ALLELE_FILTER }}
+  {%- endif %} )
@@ -26,11 +26,26 @@ Example Output:
 >chr22>5>TTAGC
 >chr22>10>CCCCC
 
-It is very fast (~2 minutes for a 3 GB FASTA) when run on Compute Engine
-utilizing streaming download and upload.
-https://cloud.google.com/storage/docs/gsutil/commands/cp#streaming-transfers
+The input is read in large blocks rather than line by line and the records
+are written in batches, so a 3 GB FASTA converts in seconds of CPU time.  By
+default each record holds as many bases as the first sequence line of its
+contig; use --width to re-chunk the sequence to a fixed number of bases per
+record instead.
+
+Plain, gzip and BGZF compressed input are all read natively, so there is no
+need to decompress the file before passing it to this script.
+
+With --output_format 2bit the FASTA is instead converted to the .2bit format
+of the UCSC Genome Browser, which packs four bases to a byte and keeps the
+blocks of N and lowercase (soft-masked) bases, so that the original bases can
+be rebuilt; bases other than A, C, G, T and N become N, as with faToTwoBit.
+It is about a quarter of the size of the key-value output.  TwoBitFile reads
+any base or region of a .2bit file directly through a memory map, and a .2bit
+file can be given as the input to convert all of it, or --region, to
+key-value records without parsing text.
 
-For uncompressed FASTA files:
+It is best run on Compute Engine utilizing streaming download and upload.
+https://cloud.google.com/storage/docs/gsutil/commands/cp#streaming-transfers
 
 gsutil cat \
   gs://genomics-public-data/references/GRCh38_Verily/GRCh38_Verily_v1.genome.fa
@@ -40,40 +55,999 @@ gsutil cat \
   | \
   gsutil cp - gs://MY-BUCKET/refs/GRCh38_Verily_v1.genome.txt
 
-For compressed FASTA files, use the appropriate command to unzip the file
-before passing it to this script:
-
 gsutil cat \
   gs://genomics-public-data/references/hg19/*fa.gz \
   | \
-  gunzip \
-  | \
-  ./fasta_to_kv.py \
+  ./fasta_to_kv.py --width 1000 \
   | \
   gsutil cp - gs://MY-BUCKET/refs/hg19.txt
 """
 
+from __future__ import absolute_import
+
+import argparse
+import bisect
+import collections
+import gzip
+import itertools
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import struct
 import sys
+import tempfile
+
+# If NumPy is installed, it is used to unpack .2bit sequences faster.
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+# Number of bytes read from the input at a time.
+_CHUNK_SIZE = 16 * 1024 * 1024
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+# A samtools region, e.g. "chr17" or "chr17:41196312-41277499".
+_REGION_PATTERN = re.compile(r"^(.+?)(?::([\d,]+)(?:-([\d,]*))?)?$")
+
+# Characters replaced when a contig name is used in a file name.
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+
+# One line of a samtools-compatible .fai index.
+FaiEntry = collections.namedtuple(
+    "FaiEntry", ["name", "length", "offset", "line_bases", "line_width"])
+
+# Bytes removed from sequence data.  Line breaks separate the source lines and
+# any other whitespace is stripped, as it was when reading line by line.
+_WHITESPACE = b"\r\n\t "
+
+
+def open_fasta(path):
+  """Opens a plain, gzip or BGZF compressed FASTA file for binary reading.
+
+  Args:
+    path: Path to a local FASTA file, or "-" to read from stdin.
+
+  Returns:
+    A file-like object yielding the uncompressed bytes of the FASTA.
+  """
+  if path == "-":
+    stream = getattr(sys.stdin, "buffer", sys.stdin)
+  else:
+    stream = open(path, "rb")
+
+  # BGZF is a series of gzip members, which the gzip module reads as one
+  # stream.
+  if stream.peek(2)[:2] == _GZIP_MAGIC:
+    return gzip.GzipFile(fileobj=stream, mode="rb")
+  return stream
+
+
+def iter_contig_blocks(stream, width=0, chunk_size=_CHUNK_SIZE):
+  """Parses a FASTA stream into large blocks of contiguous sequence.
+
+  Args:
+    stream: Binary file-like object holding uncompressed FASTA.
+    width: Number of bases per output record.  If 0, the length of the first
+        sequence line of each contig is used.
+    chunk_size: Number of bytes to read from the stream at a time.
+
+  Yields:
+    Tuples of (header, offset, sequence, width) where header is the stripped
+    ">" line of the contig, offset is the 0-based position of the first base of
+    sequence within the contig and width is the record width for the contig.
+    The sequence length is a multiple of width, except for the final block of
+    each contig.
+  """
+  # Per-contig state, shared with the nested helpers below.
+  state = {"header": b"", "offset": 0, "width": width, "pending": []}
+
+  def flush(final):
+    pending = b"".join(state["pending"])
+    state["pending"] = []
+    if not pending:
+      return
+    if final or not state["width"]:
+      size = len(pending)
+    else:
+      size = len(pending) - len(pending) % state["width"]
+    if size < len(pending):
+      state["pending"].append(pending[size:])
+    if size:
+      yield (state["header"], state["offset"], pending[:size],
+             state["width"] or size)
+      state["offset"] += size
+
+  def parse(data):
+    # data always holds complete lines.
+    pos = 0
+    end = len(data)
+    while pos < end:
+      first = data[pos:pos + 1]
+      if first in (b">", b";"):
+        eol = data.find(b"\n", pos)
+        eol = end if eol < 0 else eol
+        if first == b">":
+          # We've started a new sequence.  Reset the state.
+          for block in flush(True):
+            yield block
+          state["header"] = data[pos:eol].strip()
+          state["offset"] = 0
+          state["width"] = width
+        # Otherwise skip comment lines.
+        pos = eol + 1
+        continue
+
+      # Find the start of the next header or comment line.
+      stop = end
+      for marker in (b"\n>", b"\n;"):
+        found = data.find(marker, pos, stop)
+        if found >= 0:
+          stop = found + 1
+      segment = data[pos:stop]
+      pos = stop
+
+      if not state["width"]:
+        first_line = segment.lstrip().split(b"\n", 1)[0].strip()
+        state["width"] = len(first_line)
+      state["pending"].append(segment.translate(None, _WHITESPACE))
+
+    for block in flush(False):
+      yield block
+
+  carry = b""
+  while True:
+    chunk = stream.read(chunk_size)
+    if not chunk:
+      break
+    data = carry + chunk
+    cut = data.rfind(b"\n") + 1
+    carry = data[cut:]
+    for block in parse(data[:cut]):
+      yield block
+
+  if carry:
+    for block in parse(carry):
+      yield block
+  for block in flush(True):
+    yield block
+
+
+def format_records(header, offset, sequence, width):
+  """Formats a block of sequence as key-value records.
+
+  Use '>' as the delimiter since its a safe character to use in the file.
+
+  Args:
+    header: The ">" line of the contig.
+    offset: 0-based position of the first base of sequence within the contig.
+    sequence: The bases to format.
+    width: Number of bases per record.
+
+  Returns:
+    The records as bytes, one per line.
+  """
+  prefix = header + b">"
+  return b"".join([
+      b"%s%d>%s\n" % (prefix, offset + i, sequence[i:i + width])
+      for i in range(0, len(sequence), width)
+  ])
+
+
+def convert(stream, outfile, width=0, chunk_size=_CHUNK_SIZE):
+  """Converts a FASTA stream to key-value records.
+
+  Args:
+    stream: Binary file-like object holding uncompressed FASTA.
+    outfile: Binary file-like object to which records are written.
+    width: Number of bases per output record, 0 to use the source line width.
+    chunk_size: Number of bytes to read from the stream at a time.
+  """
+  for header, offset, sequence, block_width in iter_contig_blocks(
+      stream, width=width, chunk_size=chunk_size):
+    outfile.write(format_records(header, offset, sequence, block_width))
+
+
+def build_fai(path):
+  """Scans an uncompressed FASTA file to build its samtools-style index.
+
+  Args:
+    path: Path to a local, uncompressed FASTA file.
+
+  Returns:
+    A list of FaiEntry tuples, in file order.
+
+  Raises:
+    ValueError: If the file is compressed or has irregular line lengths.
+  """
+  entries = []
+  with open(path, "rb") as f:
+    if f.read(2) == _GZIP_MAGIC:
+      raise ValueError("Cannot index compressed FASTA file %s" % path)
+    if os.fstat(f.fileno()).st_size == 0:
+      return entries
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  try:
+    header = 0 if mm[:1] == b">" else mm.find(b"\n>") + 1
+    if not header and mm[:1] != b">":
+      return entries
+    while True:
+      header_end = mm.find(b"\n", header)
+      if header_end < 0:
+        header_end = len(mm)
+      name = mm[header + 1:header_end].split(None, 1)
+      name = name[0].decode("ascii") if name else ""
+      offset = header_end + 1
+
+      # The contig runs to the next header line or the end of the file.
+      next_header = mm.find(b"\n>", header_end)
+      end = next_header + 1 if next_header >= 0 else len(mm)
+      while end > offset and mm[end - 1:end] in (b"\r", b"\n"):
+        end -= 1
+
+      line_end = mm.find(b"\n", offset, end)
+      if line_end < 0:
+        line_width = line_bases = end - offset
+      else:
+        line_width = line_end + 1 - offset
+        line_bases = len(mm[offset:line_end].rstrip(b"\r"))
+
+      size = end - offset
+      length = size
+      if line_width:
+        length = (size // line_width) * line_bases + size % line_width
+        # Lines must all be the same length, except for the last one.
+        last_line = mm.rfind(b"\n", offset, end) + 1 or offset
+        if ((last_line - offset) % line_width or
+            end - last_line > line_bases):
+          raise ValueError("Different line length in sequence %s" % name)
+      entries.append(FaiEntry(name, length, offset, line_bases, line_width))
+
+      if next_header < 0:
+        break
+      header = next_header + 1
+  finally:
+    mm.close()
+  return entries
+
+
+def read_fai(path):
+  """Reads a samtools .fai index file into a list of FaiEntry tuples."""
+  entries = []
+  with open(path, "r") as f:
+    for line in f:
+      fields = line.rstrip("\n").split("\t")
+      if len(fields) < 5:
+        continue
+      entries.append(FaiEntry(fields[0], *[int(x) for x in fields[1:5]]))
+  return entries
+
+
+def write_fai(path, entries):
+  """Writes a list of FaiEntry tuples as a samtools .fai index file."""
+  with open(path, "w") as f:
+    for entry in entries:
+      f.write("%s\t%d\t%d\t%d\t%d\n" % entry)
+
+
+class SequenceIndex(object):
+  """Random access to the contigs of a reference genome.
+
+  Subclasses provide the entries, an OrderedDict from contig name to an entry
+  with the contig's length, and fetch.
+  """
+
+  def close(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_args):
+    self.close()
+
+  def fetch(self, name, start, end):
+    raise NotImplementedError
+
+  def record_width(self, name):
+    """Returns the default number of bases per record of a contig."""
+    raise NotImplementedError
+
+  def header(self, name):
+    """Returns the ">" line of a contig, as format_records keys it."""
+    return b">" + name.encode("ascii")
+
+  def iter_region_blocks(self, name, start, end, width=0,
+                         chunk_size=_CHUNK_SIZE):
+    """Yields blocks of a region in the form returned by iter_contig_blocks.
+
+    Records are aligned to the same multiples of width that a full conversion
+    of the contig would produce, so a region's records carry the same
+    sequence_start offsets and header, and records wholly inside the region
+    are identical to those of a full conversion.
+
+    Args:
+      name: Name of the contig.
+      start: 0-based position of the first base.
+      end: 0-based position one past the last base.
+      width: Number of bases per record.  If 0, record_width of the contig.
+      chunk_size: Approximate number of bases fetched at a time.
+
+    Yields:
+      Tuples of (header, offset, sequence, width).
+    """
+    entry = self.entries[name]
+    width = width or self.record_width(name)
+    header = self.header(name)
+    end = min(end, entry.length)
+    block_size = max(width, chunk_size - chunk_size % width)
+
+    # Emit the leading partial record on its own to stay aligned.
+    if start % width and start < end:
+      aligned = min(end, start - start % width + width)
+      yield header, start, self.fetch(name, start, aligned), width
+      start = aligned
+
+    while start < end:
+      block_end = min(end, start + block_size)
+      yield header, start, self.fetch(name, start, block_end), width
+      start = block_end
+
+
+class FastaIndex(SequenceIndex):
+  """Random access to the sequences of an uncompressed, indexed FASTA file.
+
+  The FASTA file is memory-mapped, so fetching a region reads only the pages
+  that hold it.  A samtools-compatible PATH.fai index is reused when it is at
+  least as new as the FASTA file and built otherwise.
+  """
+
+  def __init__(self, path, fai_path=None):
+    """Opens an indexed FASTA file.
+
+    Args:
+      path: Path to a local, uncompressed FASTA file.
+      fai_path: Path to the .fai index, PATH.fai by default.
+    """
+    fai_path = fai_path or path + ".fai"
+    if (os.path.exists(fai_path) and
+        os.path.getmtime(fai_path) >= os.path.getmtime(path)):
+      entries = read_fai(fai_path)
+    else:
+      entries = build_fai(path)
+      try:
+        write_fai(fai_path, entries)
+      except IOError:
+        # The index is still usable for this run.
+        pass
+
+    self.entries = collections.OrderedDict((e.name, e) for e in entries)
+    self._file = open(path, "rb")
+    self._mmap = None
+    if entries:
+      self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def close(self):
+    if self._mmap is not None:
+      self._mmap.close()
+    self._file.close()
+
+  def _file_offset(self, entry, position):
+    return (entry.offset + (position // entry.line_bases) * entry.line_width +
+            position % entry.line_bases)
+
+  def fetch(self, name, start, end):
+    """Returns the bases of a region of a contig.
+
+    Args:
+      name: Name of the contig.
+      start: 0-based position of the first base.
+      end: 0-based position one past the last base.  Clipped to the length of
+          the contig.
+
+    Returns:
+      The bases, with line breaks removed.
+
+    Raises:
+      KeyError: If the contig is not in the index.
+    """
+    entry = self.entries[name]
+    end = min(end, entry.length)
+    if start >= end:
+      return b""
+    raw = self._mmap[self._file_offset(entry, start):
+                     self._file_offset(entry, end - 1) + 1]
+    if entry.line_width == entry.line_bases:
+      return raw
+    return raw.translate(None, _WHITESPACE)
+
+  def record_width(self, name):
+    """Returns the line width of a contig."""
+    return self.entries[name].line_bases or 1
+
+  def header(self, name):
+    """Returns the whole ">" line of a contig, including any description."""
+    offset = self.entries[name].offset
+    # The header line ends just before the sequence.
+    line_start = self._mmap.rfind(b"\n", 0, max(0, offset - 1)) + 1
+    return self._mmap[line_start:offset - 1].strip()
+
+
+# The .2bit format of the UCSC Genome Browser:
+# https://genome.ucsc.edu/FAQ/FAQformat.html#format7
+#
+# A header of signature, version, sequence count and a reserved word, then
+# the name and file offset of each sequence, then the sequences.  Each has
+# its length, the starts and sizes of its blocks of N, the starts and sizes of
+# its blocks of lowercase bases, a reserved word and its bases packed four to
+# a byte, T=0, C=1, A=2 and G=3 from the most significant bits.  Version 0
+# has 32-bit offsets, version 1 64-bit offsets.
+TWOBIT_SIGNATURE = 0x1A412743
+
+_TWOBIT_BASES = b"TCAG"
+
+# Maps each byte of a sequence to the base-4 digit of its 2-bit code.  Bases
+# other than A, C, G and T are stored as T and restored from the N blocks.
+_TWOBIT_DIGITS = bytearray(b"0" * 256)
+for _code, _base in enumerate(bytearray(_TWOBIT_BASES)):
+  _TWOBIT_DIGITS[_base] = _TWOBIT_DIGITS[_base + 32] = ord("0") + _code
+_TWOBIT_DIGITS = bytes(_TWOBIT_DIGITS)
+
+# The four bases of each packed byte.
+_TWOBIT_UNPACK = [
+    bytes(bytearray(_TWOBIT_BASES[(byte >> shift) & 3]
+                    for shift in (6, 4, 2, 0)))
+    for byte in range(256)
+]
+if np is not None:
+  _TWOBIT_UNPACK_ARRAY = np.frombuffer(b"".join(_TWOBIT_UNPACK),
+                                       dtype=np.uint8).reshape((256, 4))
+
+def _flag_table(flagged):
+  """Returns a table translating bytes to b"1" if flagged, else b"0"."""
+  return bytes(bytearray(ord("1") if flagged(byte) else ord("0")
+                         for byte in range(256)))
+
+
+# The bases of N blocks, and of lowercase blocks.
+_N_BLOCK_TABLE = _flag_table(lambda byte: byte not in bytearray(b"ACGTacgt"))
+_MASK_BLOCK_TABLE = _flag_table(lambda byte: ord("a") <= byte <= ord("z"))
+
+# Number of bases per record when converting a .2bit file, which does not
+# record the line width of the FASTA it was made from.
+_TWOBIT_RECORD_WIDTH = 60
+
+
+def _pack_bases(sequence):
+  """Packs bases four to a byte.  len(sequence) must be a multiple of 4."""
+  if not sequence:
+    return b""
+  return int(sequence.translate(_TWOBIT_DIGITS), 4).to_bytes(
+      len(sequence) // 4, "big")
+
+
+class _BlockList(object):
+  """Runs of flagged bases found in consecutive blocks of a contig."""
+
+  def __init__(self, table):
+    self.table = table
+    self.starts = []
+    self.sizes = []
+
+  def add(self, offset, sequence):
+    # Runs are found with bytes.find rather than a regular expression, which
+    # is several times slower to scan a sequence.
+    flags = sequence.translate(self.table)
+    end = 0
+    while True:
+      start = flags.find(b"1", end)
+      if start < 0:
+        break
+      end = flags.find(b"0", start)
+      if end < 0:
+        end = len(flags)
+      if self.starts and self.starts[-1] + self.sizes[-1] == offset + start:
+        # The run continues one that ended the previous block.
+        self.sizes[-1] += end - start
+      else:
+        self.starts.append(offset + start)
+        self.sizes.append(end - start)
+
+  def pack(self):
+    count = len(self.starts)
+    return struct.pack("<I%dI%dI" % (count, count), count,
+                       *(self.starts + self.sizes))
+
+
+def _twobit_record(stream, name):
+  """Packs the bases of one contig to a .2bit sequence record.
+
+  Args:
+    stream: Iterable of consecutive blocks of the contig's bases.
+    name: Name of the contig as bytes, for logging.
+
+  Returns:
+    A tuple of (record, number of bases).
+  """
+  n_blocks = _BlockList(_N_BLOCK_TABLE)
+  mask_blocks = _BlockList(_MASK_BLOCK_TABLE)
+  packed = []
+  carry = b""
+  length = 0
+  iupac = False
+  for sequence in stream:
+    n_blocks.add(length, sequence)
+    mask_blocks.add(length, sequence)
+    iupac = iupac or bool(sequence.translate(None, b"ACGTNacgtn"))
+    length += len(sequence)
+    data = carry + sequence
+    cut = len(data) - len(data) % 4
+    packed.append(_pack_bases(data[:cut]))
+    carry = data[cut:]
+  if carry:
+    packed.append(_pack_bases(carry + b"T" * (4 - len(carry))))
+  if iupac:
+    logging.warning("%s has bases other than A, C, G, T and N, which are "
+                    "stored as N", name.decode("ascii", "replace"))
+  return b"".join([struct.pack("<I", length), n_blocks.pack(),
+                   mask_blocks.pack(), struct.pack("<I", 0)] + packed), length
+
+
+def convert_to_twobit(stream, outfile, chunk_size=_CHUNK_SIZE):
+  """Converts a FASTA stream to the .2bit format.
+
+  Sequences are named by the first word of their header, and a sequence is
+  held in memory, packed, while it is converted.
+
+  Args:
+    stream: Binary file-like object holding uncompressed FASTA.
+    outfile: Binary file-like object to which the .2bit file is written.
+    chunk_size: Number of bytes to read from the stream at a time.
+
+  Returns:
+    An OrderedDict from sequence name to length.
+  """
+  lengths = collections.OrderedDict()
+  # The index precedes the sequences, so they are spooled until all of their
+  # sizes are known.
+  with tempfile.TemporaryFile() as records:
+    sizes = []
+    blocks = iter_contig_blocks(stream, chunk_size=chunk_size)
+    for header, group in itertools.groupby(blocks, key=lambda block: block[0]):
+      name = (header[1:].split() or [b""])[0]
+      if name in lengths:
+        raise ValueError("Duplicate sequence name %s" % name.decode("ascii"))
+      record, lengths[name] = _twobit_record(
+          (sequence for _, _, sequence, _ in group), name)
+      records.write(record)
+      sizes.append(len(record))
+
+    index_size = sum(1 + len(name) for name in lengths)
+    version = 0
+    if 16 + index_size + 4 * len(lengths) + sum(sizes) > 0xFFFFFFFF:
+      version = 1
+    offset_format = "<Q" if version else "<I"
+    offset = 16 + index_size + struct.calcsize(offset_format) * len(lengths)
+    outfile.write(struct.pack("<IIII", TWOBIT_SIGNATURE, version, len(lengths),
+                              0))
+    for name, size in zip(lengths, sizes):
+      outfile.write(struct.pack("<B", len(name)) + name +
+                    struct.pack(offset_format, offset))
+      offset += size
+    records.seek(0)
+    shutil.copyfileobj(records, outfile, _CHUNK_SIZE)
+  return collections.OrderedDict(
+      (name.decode("ascii"), length) for name, length in lengths.items())
+
+
+def is_twobit(path):
+  """Returns True if path is a .2bit file, judged by its signature."""
+  if path == "-" or not os.path.isfile(path):
+    return False
+  with open(path, "rb") as f:
+    data = f.read(4)
+  return len(data) == 4 and TWOBIT_SIGNATURE in (struct.unpack("<I", data)[0],
+                                                 struct.unpack(">I", data)[0])
+
+
+# One sequence of a .2bit file: its length and the file offset of its record.
+TwoBitEntry = collections.namedtuple("TwoBitEntry", ["name", "length",
+                                                     "offset"])
+
+
+class TwoBitFile(SequenceIndex):
+  """Random access to the sequences of a .2bit file.
+
+  The file is memory-mapped, and fetching a region reads only the bytes that
+  pack it, plus a binary search of the N and lowercase blocks of its
+  sequence, so any base or region is found in constant time.  Regions are
+  returned with their N and lowercase bases, like FastaIndex.fetch.
+  """
+
+  def __init__(self, path):
+    """Opens a .2bit file.
+
+    Args:
+      path: Path to a local .2bit file.
+
+    Raises:
+      ValueError: If the file is not in the .2bit format.
+    """
+    self._file = open(path, "rb")
+    self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    data = self._mmap
+    signature = struct.unpack("<I", data[:4])[0]
+    if signature == TWOBIT_SIGNATURE:
+      self._byte_order = "<"
+    elif struct.unpack(">I", data[:4])[0] == TWOBIT_SIGNATURE:
+      self._byte_order = ">"
+    else:
+      self.close()
+      raise ValueError("%s is not a .2bit file" % path)
+    version, count = struct.unpack(self._byte_order + "II", data[4:12])
+    if version not in (0, 1):
+      self.close()
+      raise ValueError("Unsupported .2bit version %d in %s" % (version, path))
+    offset_format = self._byte_order + ("Q" if version else "I")
+    offset_size = struct.calcsize(offset_format)
+
+    self.entries = collections.OrderedDict()
+    position = 16
+    for _ in range(count):
+      name_size = bytearray(data[position:position + 1])[0]
+      name = data[position + 1:position + 1 + name_size].decode("ascii")
+      position += 1 + name_size
+      record = struct.unpack(offset_format,
+                             data[position:position + offset_size])[0]
+      position += offset_size
+      length = self._read_words(record, 1)[0]
+      self.entries[name] = TwoBitEntry(name, length, record)
+    self._records = {}
+
+  def close(self):
+    self._mmap.close()
+    self._file.close()
+
+  def _read_words(self, offset, count):
+    return struct.unpack("%s%dI" % (self._byte_order, count),
+                         self._mmap[offset:offset + 4 * count])
+
+  def _record(self, name):
+    """Returns the N blocks, lowercase blocks and bases offset of a contig."""
+    record = self._records.get(name)
+    if record is None:
+      offset = self.entries[name].offset + 4
+      blocks = []
+      for _ in range(2):
+        count = self._read_words(offset, 1)[0]
+        words = self._read_words(offset + 4, 2 * count)
+        starts = list(words[:count])
+        ends = [start + size for start, size in zip(starts, words[count:])]
+        blocks.append((starts, ends))
+        offset += 4 + 8 * count
+      # Skip the reserved word.
+      record = (blocks[0], blocks[1], offset + 4)
+      self._records[name] = record
+    return record
+
+  def fetch(self, name, start, end):
+    """Returns the bases of a region of a contig.
+
+    Args:
+      name: Name of the contig.
+      start: 0-based position of the first base.
+      end: 0-based position one past the last base.  Clipped to the length of
+          the contig.
+
+    Returns:
+      The bases, as in the FASTA file the .2bit file was made from.
+
+    Raises:
+      KeyError: If the contig is not in the file.
+    """
+    entry = self.entries[name]
+    end = min(end, entry.length)
+    if start >= end:
+      return b""
+    n_blocks, mask_blocks, bases_offset = self._record(name)
+    packed = self._mmap[bases_offset + start // 4:
+                        bases_offset + (end - 1) // 4 + 1]
+    if np is not None:
+      unpacked = _TWOBIT_UNPACK_ARRAY[np.frombuffer(packed, dtype=np.uint8)]
+      unpacked = unpacked.tobytes()
+    else:
+      unpacked = b"".join(map(_TWOBIT_UNPACK.__getitem__,
+                              bytearray(packed)))
+    sequence = bytearray(unpacked[start % 4:start % 4 + end - start])
+
+    for block_start, block_end in _overlapping_blocks(n_blocks, start, end):
+      sequence[block_start - start:block_end - start] = (
+          b"N" * (block_end - block_start))
+    for block_start, block_end in _overlapping_blocks(mask_blocks, start, end):
+      sequence[block_start - start:block_end - start] = (
+          sequence[block_start - start:block_end - start].lower())
+    return bytes(sequence)
+
+  def record_width(self, name):
+    """Returns the number of bases per record of contigs of .2bit files."""
+    return _TWOBIT_RECORD_WIDTH
+
+
+def _overlapping_blocks(blocks, start, end):
+  """Yields the parts of sorted, disjoint blocks within [start, end).
+
+  Args:
+    blocks: A tuple of (starts, ends) lists.
+    start: 0-based start of the region.
+    end: 0-based end of the region.
+  """
+  starts, ends = blocks
+  i = max(0, bisect.bisect_right(starts, start) - 1)
+  while i < len(starts) and starts[i] < end:
+    if ends[i] > start:
+      yield max(starts[i], start), min(ends[i], end)
+    i += 1
+
+
+def open_index(path):
+  """Returns a TwoBitFile for a .2bit file, or else a FastaIndex."""
+  if is_twobit(path):
+    return TwoBitFile(path)
+  return FastaIndex(path)
+
+
+def parse_region(region):
+  """Parses a samtools-style region string.
+
+  Args:
+    region: "NAME", "NAME:START" or "NAME:START-END" with 1-based, inclusive
+        coordinates, e.g. "chr17:41196312-41277499".
+
+  Returns:
+    A tuple of (name, start, end) in 0-based, half-open coordinates.  end is
+    None if it was not specified.
+
+  Raises:
+    ValueError: If the region cannot be parsed.
+  """
+  m = _REGION_PATTERN.match(region.strip())
+  if not m:
+    raise ValueError("Failed to parse region: %s" % region)
+  name, start, end = m.groups()
+  start = int(start.replace(",", "")) - 1 if start else 0
+  end = int(end.replace(",", "")) if end else None
+  if start < 0 or (end is not None and end < start):
+    raise ValueError("Invalid region: %s" % region)
+  return name, start, end
+
+
+def read_bed(path):
+  """Reads regions from a BED file.
+
+  Args:
+    path: Path to a BED file, with 0-based, half-open coordinates.
+
+  Returns:
+    A list of (name, start, end) tuples.
+  """
+  regions = []
+  with open(path, "r") as f:
+    for line in f:
+      if not line.strip() or line.startswith(("#", "track", "browser")):
+        continue
+      fields = line.split("\t")
+      regions.append((fields[0], int(fields[1]), int(fields[2])))
+  return regions
+
+
+def convert_regions(index, regions, outfile, width=0):
+  """Converts regions of an indexed FASTA file to key-value records.
+
+  Args:
+    index: A FastaIndex or TwoBitFile.
+    regions: Iterable of (name, start, end) tuples in 0-based, half-open
+        coordinates.  An end of None means the end of the contig.
+    outfile: Binary file-like object to which records are written.
+    width: Number of bases per output record, 0 to use the source line width.
+
+  Raises:
+    KeyError: If a region names a contig that is not in the index.
+  """
+  for name, start, end in regions:
+    if name not in index.entries:
+      raise KeyError("Sequence %s not found in the FASTA index" % name)
+    if end is None:
+      end = index.entries[name].length
+    for header, offset, sequence, block_width in index.iter_region_blocks(
+        name, start, end, width=width):
+      outfile.write(format_records(header, offset, sequence, block_width))
+
+
+# The FastaIndex opened by each worker process of convert_parallel.
+_worker_index = None
+
+
+def _init_worker(path):
+  global _worker_index
+  _worker_index = open_index(path)
+
+
+def _convert_region_to_file(task):
+  region, width, path = task
+  with open(path, "wb") as outfile:
+    convert_regions(_worker_index, [region], outfile, width=width)
+  return path
+
+
+def shard_filename(number, name):
+  """Returns the file name of the output shard for a region."""
+  return "%05d_%s.txt" % (number, _UNSAFE_FILENAME_CHARS.sub("_", name))
+
+
+def convert_parallel(path, regions, processes, outfile=None, shard_dir=None,
+                     width=0):
+  """Converts regions of an indexed FASTA file using a pool of processes.
+
+  Each region (typically a whole contig) is converted independently.  The
+  largest regions are started first to balance the load, but the output is
+  always in the order of regions.
+
+  Args:
+    path: Path to a local, uncompressed FASTA file, which must already be
+        indexed (see FastaIndex), or a .2bit file.
+    regions: List of (name, start, end) tuples in 0-based, half-open
+        coordinates.  An end of None means the end of the contig.
+    processes: Number of worker processes.
+    outfile: Binary file-like object to which all records are written, in
+        order.  Ignored if shard_dir is set.
+    shard_dir: If set, write the records for each region to their own file in
+        this directory, named by shard_filename.
+    width: Number of bases per output record, 0 to use the source line width.
+
+  Returns:
+    The paths of the shards written to shard_dir, in order, or an empty list.
+  """
+  with open_index(path) as index:
+    lengths = []
+    for name, start, end in regions:
+      if name not in index.entries:
+        raise KeyError("Sequence %s not found in the FASTA index" % name)
+      length = index.entries[name].length
+      lengths.append(min(length, length if end is None else end) - start)
+
+  work_dir = shard_dir or tempfile.mkdtemp()
+  paths = [os.path.join(work_dir, shard_filename(i, region[0]))
+           for i, region in enumerate(regions)]
+
+  pool = multiprocessing.Pool(processes, _init_worker, (path,))
+  try:
+    results = [None] * len(regions)
+    for i in sorted(range(len(regions)), key=lambda i: -lengths[i]):
+      results[i] = pool.apply_async(_convert_region_to_file,
+                                    ((regions[i], width, paths[i]),))
+    pool.close()
+
+    for result in results:
+      shard_path = result.get()
+      if not shard_dir:
+        with open(shard_path, "rb") as shard:
+          shutil.copyfileobj(shard, outfile, _CHUNK_SIZE)
+        os.remove(shard_path)
+  finally:
+    pool.terminate()
+    if not shard_dir:
+      shutil.rmtree(work_dir, ignore_errors=True)
+
+  return paths if shard_dir else []
+
+
+def run(argv=None):
+  """Main entry point."""
+  parser = argparse.ArgumentParser(
+      description="Convert FASTA files to a map-reduceable format.")
+  parser.add_argument(
+      "input",
+      nargs="?",
+      default="-",
+      help="Plain, gzip or BGZF compressed FASTA file, or a .2bit file.  "
+      "Reads stdin if omitted.")
+  parser.add_argument(
+      "--output",
+      default="-",
+      help="Output file to which to write records.  Writes stdout if omitted.")
+  parser.add_argument(
+      "--output_format",
+      choices=("kv", "2bit"),
+      default="kv",
+      help="Write key-value records, or the .2bit format, which packs four "
+      "bases to a byte and keeps blocks of N and lowercase bases.")
+  parser.add_argument(
+      "--width",
+      type=int,
+      default=0,
+      help="Number of bases per output record.  If 0, use the length of the "
+      "first sequence line of each contig, or 60 for a .2bit input.")
+  parser.add_argument(
+      "--region",
+      action="append",
+      default=[],
+      help="Only convert this region, given as NAME[:START[-END]] with "
+      "1-based, inclusive coordinates.  May be repeated.  Requires an "
+      "uncompressed input file, which is indexed as INPUT.fai if needed, or "
+      "a .2bit file.")
+  parser.add_argument(
+      "--regions_bed",
+      help="Only convert the regions listed in this BED file.  Requires an "
+      "uncompressed input file, which is indexed as INPUT.fai if needed, or "
+      "a .2bit file.")
+  parser.add_argument(
+      "--processes",
+      type=int,
+      default=1,
+      help="Number of processes converting contigs (or regions) in "
+      "parallel.  More than 1 requires an uncompressed input file, which is "
+      "indexed as INPUT.fai if needed, or a .2bit file.")
+  parser.add_argument(
+      "--shard_dir",
+      help="With --processes, write one output file per contig (or region) "
+      "to this directory instead of a single output.")
+  args = parser.parse_args(argv)
+
+  if args.width < 0:
+    parser.error("--width must not be negative.")
 
-sequence = ""
-position = 0
+  regions = []
+  try:
+    regions.extend(parse_region(region) for region in args.region)
+  except ValueError as e:
+    parser.error(str(e))
+  if args.regions_bed:
+    regions.extend(read_bed(args.regions_bed))
+  if (args.region or args.regions_bed) and args.input == "-":
+    parser.error("Region extraction requires an input file.")
+  if args.processes > 1 and args.input == "-":
+    parser.error("--processes requires an input file.")
+  if args.shard_dir and args.processes <= 1:
+    parser.error("--shard_dir requires --processes.")
+  twobit_input = is_twobit(args.input)
+  if args.output_format == "2bit" and (args.region or args.regions_bed or
+                                       args.processes > 1 or twobit_input):
+    parser.error("--output_format 2bit converts a whole FASTA file, without "
+                 "--region, --regions_bed or --processes.")
 
-for line in sys.stdin:
-  trimmed = line.strip()
-  if not trimmed:
-    break
+  if args.output == "-":
+    outfile = getattr(sys.stdout, "buffer", sys.stdout)
+  else:
+    outfile = open(args.output, "wb")
 
-  if trimmed.startswith(";"):
-    # Skip comment lines.
-    continue
+  try:
+    if args.output_format == "2bit":
+      convert_to_twobit(open_fasta(args.input), outfile)
+    elif args.processes > 1:
+      with open_index(args.input) as index:
+        if not (args.region or args.regions_bed):
+          regions = [(name, 0, None) for name in index.entries]
+      if args.shard_dir and not os.path.isdir(args.shard_dir):
+        os.makedirs(args.shard_dir)
+      convert_parallel(args.input, regions, args.processes, outfile=outfile,
+                       shard_dir=args.shard_dir, width=args.width)
+    elif args.region or args.regions_bed or twobit_input:
+      with open_index(args.input) as index:
+        if not (args.region or args.regions_bed):
+          regions = [(name, 0, None) for name in index.entries]
+        convert_regions(index, regions, outfile, width=args.width)
+    else:
+      convert(open_fasta(args.input), outfile, width=args.width)
+  finally:
+    outfile.flush()
+    if outfile is not getattr(sys.stdout, "buffer", sys.stdout):
+      outfile.close()
 
-  if trimmed.startswith(">"):
-    # We've started a new sequence.  Reset the state.
-    sequence = trimmed
-    position = 0
-    continue
 
-  # Write out the sequence with a prefix indicating its context.  Use '>'
-  # as the delimiter since its a safe character to use in the file.
-  sys.stdout.write(sequence + ">" + str(position) + ">" + trimmed + "\n")
-  position += len(trimmed)
+if __name__ == "__main__":
+  run()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Generate the all-possible-SNPs table locally from a reference genome.
+
+This produces the same rows as the all_possible_snps CTE in
+all_possible_snps.sql without expanding the genome in BigQuery.  Each base of
+the reference yields four rows, one for each of A, C, G and T:
+
+  reference_name, original_reference_name, start, end, reference_bases,
+  original_reference_bases, alternate_bases
+
+The rows are generated with NumPy one batch of bases at a time and written to
+sharded, compressed files that can be bulk loaded into BigQuery, so memory use
+is bounded by the batch size regardless of the size of the genome.
+
+Example usage:
+
+python generate_all_possible_snps.py \
+    --input GRCh38_Verily_v1.genome.fa \
+    --output_prefix snps/GRCh38_Verily_v1 \
+    --format ndjson
+
+bq load --source_format NEWLINE_DELIMITED_JSON \
+    ${DATASET}.all_possible_snps 'gs://MY-BUCKET/snps/GRCh38_Verily_v1-*'
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import gzip
+import json
+import logging
+import os
+
+import numpy as np
+
+import fasta_to_kv
+
+# If pyarrow is installed, Parquet output is supported.
+try:
+  import pyarrow
+  from pyarrow import parquet
+except ImportError:
+  pyarrow = None
+
+ALTERNATE_BASES = b"ACGT"
+
+# Number of reference bases processed at a time.  Each base yields four rows.
+_DEFAULT_BASES_PER_BATCH = 1 << 16
+
+_DEFAULT_ROWS_PER_SHARD = 100 * 1000 * 1000
+
+_COLUMNS = ("reference_name", "original_reference_name", "start", "end",
+            "reference_bases", "original_reference_bases", "alternate_bases")
+
+
+class SequenceBatch(object):
+  """A batch of reference bases from one contig.
+
+  Attributes:
+    original_reference_name: The contig name as it appears in the FASTA file.
+    reference_name: The contig name with the "chr" prefix removed, computed
+        as SUBSTR(chr, 4) is in all_possible_snps.sql.
+    starts: int64 NumPy array of the 0-based position of each base.
+    bases: uint8 NumPy array of the bases, in their original case.
+  """
+
+  def __init__(self, original_reference_name, starts, bases):
+    self.original_reference_name = original_reference_name
+    self.reference_name = original_reference_name[3:]
+    self.starts = starts
+    self.bases = bases
+
+  def __len__(self):
+    return len(self.bases)
+
+
+def iter_fasta_batches(path, bases_per_batch=_DEFAULT_BASES_PER_BATCH):
+  """Yields SequenceBatch objects parsed from a FASTA file.
+
+  Args:
+    path: Path to a plain, gzip or BGZF compressed FASTA file, or "-".
+    bases_per_batch: Maximum number of bases per batch.
+  """
+  stream = fasta_to_kv.open_fasta(path)
+  for header, offset, sequence, _ in fasta_to_kv.iter_contig_blocks(
+      stream, width=bases_per_batch):
+    name = header[1:].decode("ascii")
+    for i in range(0, len(sequence), bases_per_batch):
+      bases = np.frombuffer(sequence[i:i + bases_per_batch], dtype=np.uint8)
+      starts = np.arange(offset + i, offset + i + len(bases), dtype=np.int64)
+      yield SequenceBatch(name, starts, bases)
+
+
+def iter_kv_batches(path, bases_per_batch=_DEFAULT_BASES_PER_BATCH):
+  """Yields SequenceBatch objects parsed from the output of fasta_to_kv.py.
+
+  Args:
+    path: Path to a plain or compressed fasta_to_kv.py output file, or "-".
+    bases_per_batch: Approximate maximum number of bases per batch.
+  """
+  stream = fasta_to_kv.open_fasta(path)
+
+  name = None
+  offsets = []
+  sequences = []
+  size = 0
+
+  def make_batch():
+    lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+    bases = np.frombuffer(b"".join(sequences), dtype=np.uint8)
+    # Each base is at the offset of its record plus its index in the record.
+    record_starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    starts = (np.repeat(np.array(offsets, dtype=np.int64), lengths) +
+              np.arange(len(bases), dtype=np.int64) - record_starts)
+    return SequenceBatch(name, starts, bases)
+
+  for line in stream:
+    line = line.rstrip(b"\r\n")
+    if not line:
+      continue
+    _, chr_name, sequence_start, sequence = line.split(b">", 3)
+    chr_name = chr_name.decode("ascii")
+    if sequences and (chr_name != name or size >= bases_per_batch):
+      yield make_batch()
+      offsets, sequences, size = [], [], 0
+    name = chr_name
+    offsets.append(int(sequence_start))
+    sequences.append(sequence)
+    size += len(sequence)
+
+  if sequences:
+    yield make_batch()
+
+
+def iter_twobit_batches(path, bases_per_batch=_DEFAULT_BASES_PER_BATCH):
+  """Yields SequenceBatch objects read from a .2bit file.
+
+  Args:
+    path: Path to a .2bit file, as written by fasta_to_kv.py --output_format
+        2bit.
+    bases_per_batch: Maximum number of bases per batch.
+  """
+  with fasta_to_kv.TwoBitFile(path) as twobit:
+    for name, entry in twobit.entries.items():
+      for start in range(0, entry.length, bases_per_batch):
+        end = min(entry.length, start + bases_per_batch)
+        bases = np.frombuffer(twobit.fetch(name, start, end), dtype=np.uint8)
+        yield SequenceBatch(name, np.arange(start, end, dtype=np.int64), bases)
+
+
+def _to_upper(bases):
+  """Upper cases an array of ASCII bases."""
+  lower = (bases >= ord("a")) & (bases <= ord("z"))
+  return np.where(lower, bases - 32, bases).astype(np.uint8)
+
+
+def _fill_digits(rows, column, width, values):
+  """Writes right-aligned, space-padded decimal numbers into rows.
+
+  Args:
+    rows: uint8 array of shape (n, 4, row_length).
+    column: Index within each row of the first character of the number.
+    width: Number of characters reserved for the number.
+    values: int64 array of n non-negative numbers, one per base.
+  """
+  powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+  digits = (values[:, None] // powers) % 10 + ord("0")
+  # Replace leading zeros with spaces, which JSON allows between tokens.
+  digits[(values[:, None] < powers) & (powers > 1)] = ord(" ")
+  rows[:, :, column:column + width] = digits.astype(np.uint8)[:, None, :]
+
+
+def ndjson_rows(batch):
+  """Returns the rows for a SequenceBatch as newline-delimited JSON.
+
+  Every row of a batch has the same length, so rows are built by filling the
+  variable columns of a byte template instead of serializing row by row.
+
+  Args:
+    batch: A SequenceBatch.
+
+  Returns:
+    A uint8 array of shape (4 * len(batch), row_length) holding one JSON row,
+    including its newline, per line.  The four rows of each base are
+    consecutive, in the order of alternate bases A, C, G, T.
+  """
+  number_width = len(str(int(batch.starts[-1]) + 1))
+  values = {
+      "reference_name": json.dumps(batch.reference_name),
+      "original_reference_name": json.dumps(batch.original_reference_name),
+      "start": " " * number_width,
+      "end": " " * number_width,
+      "reference_bases": "\" \"",
+      "original_reference_bases": "\" \"",
+      "alternate_bases": "\" \"",
+  }
+
+  # Record where each value starts within the template.
+  template = ""
+  columns = {}
+  for name in _COLUMNS:
+    template += ("," if template else "{") + json.dumps(name) + ":"
+    # Quoted values start after the opening quote.
+    columns[name] = len(template) + (1 if values[name][0] == "\"" else 0)
+    template += values[name]
+  template = (template + "}\n").encode("ascii")
+
+  rows = np.empty((len(batch), len(ALTERNATE_BASES), len(template)),
+                  dtype=np.uint8)
+  rows[:] = np.frombuffer(template, dtype=np.uint8)
+  _fill_digits(rows, columns["start"], number_width, batch.starts)
+  _fill_digits(rows, columns["end"], number_width, batch.starts + 1)
+  rows[:, :, columns["reference_bases"]] = _to_upper(batch.bases)[:, None]
+  rows[:, :, columns["original_reference_bases"]] = batch.bases[:, None]
+  rows[:, :, columns["alternate_bases"]] = np.frombuffer(ALTERNATE_BASES,
+                                                        dtype=np.uint8)
+  return rows.reshape((-1, len(template)))
+
+
+def format_ndjson(batch):
+  """Returns the rows for a SequenceBatch as newline-delimited JSON bytes."""
+  return ndjson_rows(batch).tobytes()
+
+
+def _string_array(bases):
+  """Builds a pyarrow string array of single characters without copies."""
+  offsets = np.arange(len(bases) + 1, dtype=np.int32)
+  return pyarrow.StringArray.from_buffers(
+      len(bases), pyarrow.py_buffer(offsets), pyarrow.py_buffer(bases))
+
+
+def _constant_array(value, length):
+  """Builds a dictionary-encoded pyarrow array holding one repeated string."""
+  return pyarrow.DictionaryArray.from_arrays(
+      pyarrow.array(np.zeros(length, dtype=np.int32)), pyarrow.array([value]))
+
+
+def _parquet_schema():
+  """Returns the Parquet schema matching the all_possible_snps CTE."""
+  name_type = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+  types = [name_type, name_type, pyarrow.int64(), pyarrow.int64(),
+           pyarrow.string(), pyarrow.string(), pyarrow.string()]
+  return pyarrow.schema(list(zip(_COLUMNS, types)))
+
+
+def parquet_table(batch):
+  """Returns the rows for a SequenceBatch as a pyarrow Table."""
+  count = len(batch) * len(ALTERNATE_BASES)
+  starts = np.repeat(batch.starts, len(ALTERNATE_BASES))
+  alternates = np.tile(np.frombuffer(ALTERNATE_BASES, dtype=np.uint8),
+                       len(batch))
+  columns = [
+      _constant_array(batch.reference_name, count),
+      _constant_array(batch.original_reference_name, count),
+      pyarrow.array(starts),
+      pyarrow.array(starts + 1),
+      _string_array(np.repeat(_to_upper(batch.bases), len(ALTERNATE_BASES))),
+      _string_array(np.repeat(batch.bases, len(ALTERNATE_BASES))),
+      _string_array(alternates),
+  ]
+  return pyarrow.Table.from_arrays(columns, schema=_parquet_schema())
+
+
+class ShardWriter(object):
+  """Writes rows to a series of numbered, compressed output shards."""
+
+  def __init__(self, output_prefix, file_format, rows_per_shard,
+               compress_level):
+    self.output_prefix = output_prefix
+    self.file_format = file_format
+    self.rows_per_shard = rows_per_shard
+    self.compress_level = compress_level
+    self.paths = []
+    self.total_rows = 0
+    self._outfile = None
+    self._shard_rows = 0
+
+  def _open_shard(self):
+    extension = ".json.gz" if self.file_format == "ndjson" else ".parquet"
+    path = "%s-%05d%s" % (self.output_prefix, len(self.paths), extension)
+    logging.info("Writing %s", path)
+    self.paths.append(path)
+    self._shard_rows = 0
+    if self.file_format == "ndjson":
+      self._outfile = gzip.open(path, "wb", compresslevel=self.compress_level)
+    else:
+      self._outfile = parquet.ParquetWriter(
+          path, _parquet_schema(), compression="zstd",
+          compression_level=self.compress_level)
+
+  def write(self, batch):
+    """Writes the rows generated for one SequenceBatch."""
+    if not len(batch):
+      return
+    if self._outfile is None or self._shard_rows >= self.rows_per_shard:
+      self.close()
+      self._open_shard()
+
+    if self.file_format == "ndjson":
+      self._outfile.write(format_ndjson(batch))
+    else:
+      self._outfile.write_table(parquet_table(batch))
+
+    rows = len(batch) * len(ALTERNATE_BASES)
+    self._shard_rows += rows
+    self.total_rows += rows
+
+  def close(self):
+    """Closes the current shard, if any."""
+    if self._outfile is not None:
+      self._outfile.close()
+      self._outfile = None
+
+
+def run(argv=None):
+  """Main entry point."""
+  parser = argparse.ArgumentParser(
+      description="Generate all possible SNPs for a reference genome.")
+  parser.add_argument(
+      "--input",
+      default="-",
+      help="Plain or compressed FASTA file, or the output of fasta_to_kv.py "
+      "when --input_format is kv or 2bit.  Reads stdin if omitted, except "
+      "for 2bit.")
+  parser.add_argument(
+      "--input_format",
+      choices=("fasta", "kv", "2bit"),
+      default="fasta",
+      help="Format of the input file.")
+  parser.add_argument(
+      "--output_prefix",
+      required=True,
+      help="Path prefix for the output shards, which are numbered "
+      "PREFIX-00000, PREFIX-00001, etc.")
+  parser.add_argument(
+      "--format",
+      dest="file_format",
+      choices=("ndjson", "parquet"),
+      default="ndjson",
+      help="Output file format.  Parquet requires pyarrow.")
+  parser.add_argument(
+      "--rows_per_shard",
+      type=int,
+      default=_DEFAULT_ROWS_PER_SHARD,
+      help="Approximate number of rows per output shard.")
+  parser.add_argument(
+      "--bases_per_batch",
+      type=int,
+      default=_DEFAULT_BASES_PER_BATCH,
+      help="Number of reference bases to process at a time.  Memory use is "
+      "proportional to this value.")
+  parser.add_argument(
+      "--compress_level",
+      type=int,
+      default=1,
+      help="Compression level for gzip (NDJSON) or zstd (Parquet).")
+  args = parser.parse_args(argv)
+
+  if args.file_format == "parquet" and pyarrow is None:
+    parser.error("--format parquet requires pyarrow to be installed.")
+
+  output_dir = os.path.dirname(args.output_prefix)
+  if output_dir and not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+
+  if args.input_format == "2bit" and args.input == "-":
+    parser.error("--input_format 2bit requires an input file.")
+
+  if args.input_format == "kv":
+    batches = iter_kv_batches(args.input, args.bases_per_batch)
+  elif args.input_format == "2bit":
+    batches = iter_twobit_batches(args.input, args.bases_per_batch)
+  else:
+    batches = iter_fasta_batches(args.input, args.bases_per_batch)
+
+  writer = ShardWriter(args.output_prefix, args.file_format,
+                       args.rows_per_shard, args.compress_level)
+  try:
+    for batch in batches:
+      writer.write(batch)
+  finally:
+    writer.close()
+
+  logging.info("Wrote %d rows to %d shards.", writer.total_rows,
+               len(writer.paths))
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  run()
@@ -0,0 +1,595 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""JOIN all possible SNPs with variant annotation databases locally.
+
+This produces the same rows as the query rendered from join_annotations.sql,
+but instead of a series of LEFT OUTER JOINs in BigQuery it merges position
+sorted streams: the bases of an indexed reference genome and one VCF file per
+annotation source.  Each source record is expanded exactly as its CTE does
+(for example one row per alternate allele of dbSNP, or the CLNALLE offset
+match of ClinVar) and joined on (reference_name, start, end, reference_bases,
+alternate_bases).  Memory use is bounded by the batch size and the number of
+sources, regardless of the size of the genome or the sources.
+
+Each contig is joined independently, in parallel, and written to its own
+compressed newline-delimited JSON file along with a BigQuery schema for the
+result:
+
+  PREFIX-00000.json.gz, PREFIX-00001.json.gz, ..., PREFIX-schema.json
+
+Sources indexed with tabix are read one contig at a time; others are scanned
+for each contig.  Source contig names may include or omit the "chr" prefix of
+the reference, as the JOIN uses SUBSTR(chr, 4) for the reference_name.
+
+Example usage:
+
+python join_annotations.py \
+    --fasta GRCh38_Verily_v1.genome.fa \
+    --source dbSNP=All_20170710.vcf.gz \
+    --source clinvar=clinvar_20170705.vcf.gz \
+    --output_prefix joined/GRCh38_Verily_v1 \
+    --processes 8
+
+bq load --source_format NEWLINE_DELIMITED_JSON \
+    ${DATASET}.annotated_snps 'gs://MY-BUCKET/joined/GRCh38_Verily_v1-0*' \
+    joined/GRCh38_Verily_v1-schema.json
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import collections
+import functools
+import gzip
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import subprocess
+
+import numpy as np
+
+import fasta_to_kv
+import generate_all_possible_snps
+
+_DEFAULT_BASES_PER_BATCH = 1 << 16
+
+# The VCF INFO header line, e.g.
+# ##INFO=<ID=RS,Number=1,Type=Integer,Description="dbSNP ID">
+_INFO_PATTERN = re.compile(r"^##INFO=<ID=([^,]+),Number=([^,]+),Type=([^,>]+)")
+
+_BIGQUERY_TYPES = {
+    "Integer": "INTEGER",
+    "Float": "FLOAT",
+    "Flag": "BOOLEAN",
+    "Character": "STRING",
+    "String": "STRING",
+}
+
+_SNP_SCHEMA = [
+    {"name": "reference_name", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "original_reference_name", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "start", "type": "INTEGER", "mode": "NULLABLE"},
+    {"name": "end", "type": "INTEGER", "mode": "NULLABLE"},
+    {"name": "reference_bases", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "original_reference_bases", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "alternate_bases", "type": "STRING", "mode": "NULLABLE"},
+]
+
+# A source record restricted to the fields used by the CTEs.  start is
+# 0-based, names are the IDs and info maps INFO keys to typed values.
+VcfRecord = collections.namedtuple(
+    "VcfRecord",
+    ["start", "reference_bases", "alternate_bases", "names", "info"])
+
+# How to prepare an annotation source for the JOIN.
+#
+# info_fields: The INFO keys that are used.
+# rows: Function from (VcfRecord) to an iterable of (alternate_bases,
+#     columns) for each row of the CTE, where columns is an OrderedDict.
+# schema: Function from (info_types) to the BigQuery schema of the columns.
+Source = collections.namedtuple("Source", ["info_fields", "rows", "schema"])
+
+
+def _at(values, offset):
+  """Returns values[OFFSET(offset)], or None if it does not exist."""
+  if isinstance(values, list) and 0 <= offset < len(values):
+    return values[offset]
+  return None
+
+
+def _as_list(value):
+  if value is None:
+    return []
+  return value if isinstance(value, list) else [value]
+
+
+def _rsid(rs):
+  """Returns CONCAT('rs', CAST(RS AS STRING))."""
+  return None if rs is None else "rs%s" % rs
+
+
+def _field(name, info_types=None, info_key=None, element=False):
+  """Returns a BigQuery schema field.
+
+  Args:
+    name: Name of the column.
+    info_types: Dictionary from INFO key to (Number, Type) from the header.
+    info_key: The INFO key holding the values of the column, or None for a
+        STRING column.
+    element: Whether the column holds one element of a repeated INFO value.
+  """
+  number, vcf_type = (info_types or {}).get(info_key, ("1", "String"))
+  repeated = not element and _is_repeated(number)
+  return {"name": name, "type": _BIGQUERY_TYPES.get(vcf_type, "STRING"),
+          "mode": "REPEATED" if repeated else "NULLABLE"}
+
+
+def _dbsnp_rows(record):
+  rs = record.info.get("RS")
+  for alternate_bases in record.alternate_bases:
+    yield alternate_bases, collections.OrderedDict([
+        ("rs_names", record.names),
+        ("RS", rs),
+        ("dbSNP_rsid", _rsid(rs)),
+    ])
+
+
+def _dbsnp_schema(info_types):
+  return [{"name": "rs_names", "type": "STRING", "mode": "REPEATED"},
+          _field("RS", info_types, "RS"),
+          _field("dbSNP_rsid")]
+
+
+_CLINVAR_FIELDS = ("CLNDBN", "CLNACC", "CLNDSDB", "CLNDSDBID", "CLNREVSTAT",
+                   "CLNSIG")
+
+
+def _clinvar_rows(record):
+  alleles = [record.reference_bases] + record.alternate_bases
+  clnalle = _as_list(record.info.get("CLNALLE"))
+  for alt_offset, alternate_bases in enumerate(alleles):
+    for clnalle_offset, value in enumerate(clnalle):
+      if value != alt_offset:
+        continue
+      columns = collections.OrderedDict()
+      columns["clinvar_rsid"] = _rsid(record.info.get("RS"))
+      for key in _CLINVAR_FIELDS:
+        columns[key] = _at(record.info.get(key), clnalle_offset)
+      yield alternate_bases, columns
+
+
+def _clinvar_schema(info_types):
+  return [_field("clinvar_rsid")] + [
+      _field(key, info_types, key, element=True) for key in _CLINVAR_FIELDS]
+
+
+_THOUSAND_GENOMES_FIELDS = ("AFR_AF", "AMR_AF", "EAS_AF", "EUR_AF", "SAS_AF")
+
+
+def _thousand_genomes_rows(record):
+  for alt_offset, alternate_bases in enumerate(record.alternate_bases):
+    columns = collections.OrderedDict()
+    for key in _THOUSAND_GENOMES_FIELDS:
+      columns[key + "_1000G"] = _at(record.info.get(key), alt_offset)
+    columns["thousandGenomes_rsid"] = _at(record.names, 0)
+    yield alternate_bases, columns
+
+
+def _thousand_genomes_schema(info_types):
+  return [_field(key + "_1000G", info_types, key, element=True)
+          for key in _THOUSAND_GENOMES_FIELDS] + [
+              _field("thousandGenomes_rsid")]
+
+
+def _esp_rows(prefix, record):
+  for alternate_bases in record.alternate_bases:
+    yield alternate_bases, collections.OrderedDict([
+        (prefix + "_AF", record.info.get("AF")),
+        (prefix + "_rsid", _at(record.names, 0)),
+    ])
+
+
+def _esp_schema(prefix, info_types):
+  return [_field(prefix + "_AF", info_types, "AF"), _field(prefix + "_rsid")]
+
+
+# The table alias and the query filename of each source, as in
+# render_templated_sql.py.
+SOURCES = collections.OrderedDict([
+    ("dbSNP", Source(("RS",), _dbsnp_rows, _dbsnp_schema)),
+    ("clinvar", Source(("RS", "CLNALLE") + _CLINVAR_FIELDS, _clinvar_rows,
+                       _clinvar_schema)),
+    ("thousandGenomes", Source(_THOUSAND_GENOMES_FIELDS,
+                               _thousand_genomes_rows,
+                               _thousand_genomes_schema)),
+    ("ESP_AA", Source(("AF",), functools.partial(_esp_rows, "ESP_AA"),
+                      functools.partial(_esp_schema, "ESP_AA"))),
+    ("ESP_EA", Source(("AF",), functools.partial(_esp_rows, "ESP_EA"),
+                      functools.partial(_esp_schema, "ESP_EA"))),
+])
+
+
+def _is_repeated(number):
+  return number not in ("0", "1")
+
+
+def read_info_types(path):
+  """Returns a dictionary from INFO key to (Number, Type) for a VCF file."""
+  info_types = {}
+  for line in fasta_to_kv.open_fasta(path):
+    if not line.startswith(b"#"):
+      break
+    m = _INFO_PATTERN.match(line.decode("utf-8"))
+    if m:
+      info_types[m.group(1)] = (m.group(2), m.group(3))
+  return info_types
+
+
+def _parse_value(value, vcf_type):
+  if value == ".":
+    return None
+  if vcf_type == "Integer":
+    return int(value)
+  if vcf_type == "Float":
+    return float(value)
+  return value
+
+
+def parse_record(line, info_types, info_fields):
+  """Parses the fields of a VCF line that are used by the CTEs.
+
+  Args:
+    line: A VCF data line, as bytes.
+    info_types: Dictionary from INFO key to (Number, Type).
+    info_fields: The INFO keys to parse; others are ignored.
+
+  Returns:
+    A VcfRecord.
+  """
+  fields = line.rstrip(b"\r\n").decode("utf-8").split("\t", 8)
+  info = {}
+  if fields[7] != ".":
+    for item in fields[7].split(";"):
+      key, has_value, value = item.partition("=")
+      if key not in info_fields:
+        continue
+      number, vcf_type = info_types.get(key, ("1", "String"))
+      if vcf_type == "Flag" or not has_value:
+        info[key] = True
+      elif _is_repeated(number):
+        info[key] = [_parse_value(v, vcf_type) for v in value.split(",")]
+      else:
+        info[key] = _parse_value(value, vcf_type)
+  alternate_bases = [] if fields[4] == "." else fields[4].split(",")
+  names = [] if fields[2] == "." else fields[2].split(";")
+  return VcfRecord(int(fields[1]) - 1, fields[3], alternate_bases, names, info)
+
+
+def _tabix_contigs(path):
+  """Returns the contigs in the tabix index of path, or None."""
+  if not os.path.exists(path + ".tbi"):
+    return None
+  try:
+    output = subprocess.check_output(["tabix", "-l", path])
+  except OSError:
+    logging.warning("tabix not found; scanning %s instead", path)
+    return None
+  return output.decode("utf-8").split()
+
+
+def iter_contig_lines(path, contig_names):
+  """Yields the data lines of a VCF file for one contig.
+
+  Args:
+    path: Path to a plain, gzip or BGZF compressed VCF file.  If it has a
+        tabix index, only the lines of the contig are read.
+    contig_names: The names the contig may have in the VCF file.
+  """
+  indexed = _tabix_contigs(path)
+  if indexed is not None:
+    names = [name for name in contig_names if name in indexed]
+    if not names:
+      return
+    proc = subprocess.Popen(["tabix", path, names[0]], stdout=subprocess.PIPE)
+    try:
+      for line in proc.stdout:
+        yield line
+    finally:
+      proc.stdout.close()
+      if proc.wait() not in (0, -13):  # -13 is SIGPIPE.
+        raise subprocess.CalledProcessError(proc.returncode, "tabix")
+    return
+
+  names = set(name.encode("utf-8") for name in contig_names)
+  for line in fasta_to_kv.open_fasta(path):
+    if line.startswith(b"#"):
+      continue
+    if line[:line.find(b"\t")] in names:
+      yield line
+
+
+def iter_source_rows(path, contig_names, source, info_types):
+  """Yields the rows of a source CTE for one contig, sorted by start.
+
+  Only rows with a single reference base can JOIN with an SNP, so records with
+  longer reference_bases are skipped.
+
+  Yields:
+    Tuples of (start, reference_bases, alternate_bases, columns).
+
+  Raises:
+    ValueError: If the VCF file is not sorted by position.
+  """
+  previous = -1
+  for line in iter_contig_lines(path, contig_names):
+    record = parse_record(line, info_types, source.info_fields)
+    if record.start < previous:
+      raise ValueError("%s is not sorted by position at %s:%d" %
+                       (path, contig_names[0], record.start + 1))
+    previous = record.start
+    if len(record.reference_bases) != 1:
+      continue
+    for alternate_bases, columns in source.rows(record):
+      yield record.start, record.reference_bases, alternate_bases, columns
+
+
+def _joined_rows(rows, index, matches):
+  """Returns the JSON lines for one SNP row and its matches in each source."""
+  base = json.loads(rows[index].tobytes().decode("ascii"),
+                    object_pairs_hook=collections.OrderedDict)
+  lines = []
+  # Like the chained LEFT OUTER JOINs, emit every combination of matches.
+  for combination in itertools.product(*[m or [None] for m in matches]):
+    row = base.copy()
+    for columns in combination:
+      if columns:
+        row.update(columns)
+    lines.append(json.dumps(row, separators=(",", ":")) + "\n")
+  return "".join(lines).encode("utf-8")
+
+
+class SourceCursor(object):
+  """A sorted stream of source rows with one row of lookahead.
+
+  Attributes:
+    head: The next (start, reference_bases, alternate_bases, columns) row, or
+        None at the end of the stream.
+  """
+
+  def __init__(self, rows):
+    self._rows = iter(rows)
+    self.head = next(self._rows, None)
+
+  def advance(self):
+    self.head = next(self._rows, None)
+
+
+def join_batch(batch, cursors):
+  """Joins one SequenceBatch with the source rows for its positions.
+
+  Args:
+    batch: A SequenceBatch of consecutive bases.
+    cursors: One SourceCursor per source, positioned at or after the start of
+        batch.  Each is advanced past the end of batch.
+
+  Returns:
+    A tuple of (newline-delimited JSON bytes, number of rows).
+  """
+  first = int(batch.starts[0])
+  end = first + len(batch)
+  reference = batch.bases.tobytes().upper().decode("ascii")
+  alternates = generate_all_possible_snps.ALTERNATE_BASES.decode("ascii")
+
+  matches = {}
+  for i, cursor in enumerate(cursors):
+    while cursor.head is not None and cursor.head[0] < end:
+      start, reference_bases, alternate_bases, columns = cursor.head
+      cursor.advance()
+      if (start >= first and reference_bases == reference[start - first] and
+          len(alternate_bases) == 1 and alternate_bases in alternates):
+        index = (start - first) * len(alternates) + alternates.index(
+            alternate_bases)
+        if index not in matches:
+          matches[index] = [[] for _ in cursors]
+        matches[index][i].append(columns)
+
+  rows = generate_all_possible_snps.ndjson_rows(batch)
+  if not matches:
+    return rows.tobytes(), len(rows)
+
+  pieces = []
+  count = len(rows) - len(matches)
+  previous = 0
+  for index in sorted(matches):
+    pieces.append(rows[previous:index].tobytes())
+    joined = _joined_rows(rows, index, matches[index])
+    pieces.append(joined)
+    count += joined.count(b"\n")
+    previous = index + 1
+  pieces.append(rows[previous:].tobytes())
+  return b"".join(pieces), count
+
+
+def join_contig(fasta_path, name, sources, output_path,
+                bases_per_batch=_DEFAULT_BASES_PER_BATCH, compress_level=1):
+  """Joins the SNPs of one contig with the annotation sources.
+
+  Args:
+    fasta_path: Path to an indexed, uncompressed FASTA file, or a .2bit file.
+    name: Name of the contig in the FASTA file.
+    sources: List of (source_name, path, info_types).
+    output_path: Path of the gzip compressed NDJSON output.
+    bases_per_batch: Number of reference bases joined at a time.
+    compress_level: gzip compression level.
+
+  Returns:
+    The number of rows written.
+  """
+  # The sources usually name contigs without the "chr" prefix.
+  contig_names = [name]
+  if name.startswith("chr") and name[3:]:
+    contig_names.insert(0, name[3:])
+  cursors = [SourceCursor(iter_source_rows(path, contig_names,
+                                           SOURCES[source_name], info_types))
+             for source_name, path, info_types in sources]
+  total = 0
+  with fasta_to_kv.open_index(fasta_path) as index, gzip.open(
+      output_path, "wb", compresslevel=compress_level) as outfile:
+    length = index.entries[name].length
+    for _, offset, sequence, _ in index.iter_region_blocks(
+        name, 0, length, width=bases_per_batch, chunk_size=bases_per_batch):
+      bases = np.frombuffer(sequence, dtype=np.uint8)
+      starts = np.arange(offset, offset + len(bases), dtype=np.int64)
+      batch = generate_all_possible_snps.SequenceBatch(name, starts, bases)
+      data, count = join_batch(batch, cursors)
+      outfile.write(data)
+      total += count
+  logging.info("Wrote %d rows for %s to %s", total, name, output_path)
+  return total
+
+
+def _join_contig_task(args):
+  return join_contig(*args)
+
+
+def output_schema(sources):
+  """Returns the BigQuery schema of the joined table.
+
+  Args:
+    sources: List of (source_name, path, info_types).
+  """
+  schema = list(_SNP_SCHEMA)
+  for source_name, _, info_types in sources:
+    schema.extend(SOURCES[source_name].schema(info_types))
+  return schema
+
+
+def join_parallel(fasta_path, contigs, sources, output_prefix, processes,
+                  bases_per_batch=_DEFAULT_BASES_PER_BATCH, compress_level=1):
+  """Joins contigs in a pool of processes, largest first.
+
+  Args:
+    fasta_path: Path to an indexed, uncompressed FASTA file, or a .2bit file.
+    contigs: Names of the contigs to join.
+    sources: List of (source_name, path, info_types).
+    output_prefix: Path prefix of the output files.
+    processes: Number of worker processes.
+    bases_per_batch: Number of reference bases joined at a time.
+    compress_level: gzip compression level.
+
+  Returns:
+    A list of (output_path, row_count) in the order of contigs.
+  """
+  with fasta_to_kv.open_index(fasta_path) as index:
+    for name in contigs:
+      if name not in index.entries:
+        raise KeyError("Sequence %s not found in the FASTA index" % name)
+    lengths = [index.entries[name].length for name in contigs]
+
+  paths = ["%s-%05d.json.gz" % (output_prefix, i) for i in range(len(contigs))]
+  pool = multiprocessing.Pool(processes)
+  try:
+    results = [None] * len(contigs)
+    for i in sorted(range(len(contigs)), key=lambda i: -lengths[i]):
+      results[i] = pool.apply_async(
+          _join_contig_task,
+          ((fasta_path, contigs[i], sources, paths[i], bases_per_batch,
+            compress_level),))
+    pool.close()
+    return [(path, result.get()) for path, result in zip(paths, results)]
+  finally:
+    pool.terminate()
+
+
+def run(argv=None):
+  """Main entry point."""
+  parser = argparse.ArgumentParser(
+      description="JOIN all possible SNPs with annotation sources locally.")
+  parser.add_argument(
+      "--fasta",
+      required=True,
+      help="Uncompressed FASTA file of the reference genome, which is indexed "
+      "as FASTA.fai if needed, or a .2bit file written by fasta_to_kv.py.")
+  parser.add_argument(
+      "--source",
+      action="append",
+      default=[],
+      help="An annotation source given as NAME=PATH, where NAME is one of %s "
+      "and PATH is a position sorted, plain or compressed VCF file, ideally "
+      "indexed with tabix.  May be repeated; columns are output in the order "
+      "of the sources." % ", ".join(SOURCES))
+  parser.add_argument(
+      "--output_prefix",
+      required=True,
+      help="Path prefix for the output, which is one file per contig "
+      "numbered PREFIX-00000.json.gz, etc. and the schema PREFIX-schema.json.")
+  parser.add_argument(
+      "--contig",
+      action="append",
+      default=[],
+      help="Only join this contig.  May be repeated.  Defaults to all "
+      "contigs of the FASTA file.")
+  parser.add_argument(
+      "--processes",
+      type=int,
+      default=1,
+      help="Number of contigs to join in parallel.")
+  parser.add_argument(
+      "--bases_per_batch",
+      type=int,
+      default=_DEFAULT_BASES_PER_BATCH,
+      help="Number of reference bases to join at a time.  Memory use is "
+      "proportional to this value.")
+  parser.add_argument(
+      "--compress_level",
+      type=int,
+      default=1,
+      help="Compression level for gzip.")
+  args = parser.parse_args(argv)
+
+  sources = []
+  for source in args.source:
+    source_name, _, path = source.partition("=")
+    if source_name not in SOURCES or not path:
+      parser.error("Invalid --source %s; expected NAME=PATH with NAME one of "
+                   "%s." % (source, ", ".join(SOURCES)))
+    sources.append((source_name, path, read_info_types(path)))
+  if not sources:
+    parser.error("At least one --source is required.")
+
+  output_dir = os.path.dirname(args.output_prefix)
+  if output_dir and not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+
+  with fasta_to_kv.open_index(args.fasta) as index:
+    contigs = args.contig or list(index.entries)
+
+  with open(args.output_prefix + "-schema.json", "w") as outfile:
+    json.dump(output_schema(sources), outfile, indent=2)
+
+  results = join_parallel(args.fasta, contigs, sources, args.output_prefix,
+                          args.processes, args.bases_per_batch,
+                          args.compress_level)
+  logging.info("Wrote %d rows to %d files.",
+               sum(count for _, count in results), len(results))
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  run()
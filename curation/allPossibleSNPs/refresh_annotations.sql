@@ -0,0 +1,135 @@
+{%- if DIALECT == 'bigquery' -%}
+#standardSQL
+{% endif -%}
+--
+-- Rewrite the {{ SOURCE }} columns of the rows of an annotated all possible
+-- SNPs table whose {{ SOURCE }} annotations differ between two versions of
+-- the source.  The rows of other keys, and the columns of other sources, are
+-- left as they are.
+--
+-- The new version must have at most one row per key.
+--
+{%- if DIALECT == 'bigquery' %}
+MERGE
+  `{{ ANNOTATED_TABLE }}` annotated
+USING (
+{%- endif %}
+WITH
+  old_source AS (
+  {%- if DIALECT == 'bigquery' %}
+  WITH
+{{ OLD_SOURCE_QUERY }}
+  SELECT
+    *
+  FROM
+    {{ SOURCE }}),
+  {%- else %}
+  SELECT
+    *
+  FROM
+    `{{ OLD_TABLE }}`),
+  {%- endif %}
+  new_source AS (
+  {%- if DIALECT == 'bigquery' %}
+  WITH
+{{ NEW_SOURCE_QUERY }}
+  SELECT
+    *
+  FROM
+    {{ SOURCE }}),
+  {%- else %}
+  SELECT
+    *
+  FROM
+    `{{ NEW_TABLE }}`),
+  {%- endif %}
+  --
+  -- Reduce the annotations of each row to a single comparable value.
+  --
+  old_rows AS (
+  SELECT
+    {{ KEY_COLUMNS | join(', ') }},
+    {{ ROW_DIGEST }} AS digest
+  FROM
+    old_source),
+  new_rows AS (
+  SELECT
+    {{ KEY_COLUMNS | join(', ') }},
+    {{ ROW_DIGEST }} AS digest
+  FROM
+    new_source),
+  --
+  -- The keys with a row added, removed or changed.
+  --
+  added_rows AS (
+  SELECT
+    *
+  FROM
+    new_rows
+  EXCEPT{{ SET_QUANTIFIER }}
+  SELECT
+    *
+  FROM
+    old_rows),
+  removed_rows AS (
+  SELECT
+    *
+  FROM
+    old_rows
+  EXCEPT{{ SET_QUANTIFIER }}
+  SELECT
+    *
+  FROM
+    new_rows),
+  changed_keys AS (
+  SELECT
+    {{ KEY_COLUMNS | join(', ') }}
+  FROM
+    added_rows
+  UNION{{ SET_QUANTIFIER }}
+  SELECT
+    {{ KEY_COLUMNS | join(', ') }}
+  FROM
+    removed_rows),
+  --
+  -- The new annotations of the changed keys, NULL where they were removed.
+  --
+  refreshed AS (
+  SELECT
+    {{ KEY_COLUMNS | join(', ') }},
+    {%- for column in VALUE_COLUMNS %}
+    new_source.{{ column }}{{ ',' if not loop.last }}
+    {%- endfor %}
+  FROM
+    changed_keys
+  LEFT OUTER JOIN
+    new_source
+  USING({{ KEY_COLUMNS | join(', ') }}))
+{%- if DIALECT == 'bigquery' %}
+SELECT
+  *
+FROM
+  refreshed) refreshed
+ON
+  {%- for column in KEY_COLUMNS %}
+  {{ 'AND ' if not loop.first }}annotated.{{ column }} = refreshed.{{ column }}
+  {%- endfor %}
+WHEN MATCHED THEN
+  UPDATE SET
+  {%- for column in VALUE_COLUMNS %}
+    {{ column }} = refreshed.{{ column }}{{ ',' if not loop.last }}
+  {%- endfor %}
+{%- else %}
+UPDATE
+  `{{ ANNOTATED_TABLE }}`
+SET
+  {%- for column in VALUE_COLUMNS %}
+  {{ column }} = refreshed.{{ column }}{{ ',' if not loop.last }}
+  {%- endfor %}
+FROM
+  refreshed
+WHERE
+  {%- for column in KEY_COLUMNS %}
+  {{ 'AND ' if not loop.first }}`{{ ANNOTATED_TABLE }}`.{{ column }} = refreshed.{{ column }}
+  {%- endfor %}
+{%- endif %}
@@ -19,17 +19,30 @@
 Using a basic pattern for JOINs with variant annotation databases, assemble
 templated SQL into a full query that can but run to create an annotated
 "all possible SNPs" table.
+
+A single query over the whole genome can exceed BigQuery's slot and shuffle
+limits, and fails as a whole.  With --output_dir, one query is instead written
+per contig, or per window of --window_size bases, along with a windows.tsv
+listing them.  The region of each window is pushed into the sequence and
+every annotation source CTE, so each query reads and joins only its own part
+of the genome.  Run them with run_partitioned_queries.py, which appends the
+results to a table clustered on reference_name and start, and retries failed
+windows on their own.
 """
 
 from __future__ import absolute_import
 
 import argparse
+import collections
 import logging
+import os
 import sys
 
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
 
+import fasta_to_kv
+
 SEQUENCE_TABLE_KEY = "SEQUENCE_TABLE"
 
 B37_QUERY_REPLACEMENTS = {
@@ -74,15 +87,325 @@ B38_ANNOTATION_SOURCES = ["dbSNP",
                           "ESP_AA",
                           "ESP_EA"]
 
+# Lengths of the contigs of the primary assemblies, used to plan partitioned
+# queries when no --fai is given.
+B37_CONTIG_LENGTHS = [
+    ("1", 249250621), ("2", 243199373), ("3", 198022430), ("4", 191154276),
+    ("5", 180915260), ("6", 171115067), ("7", 159138663), ("8", 146364022),
+    ("9", 141213431), ("10", 135534747), ("11", 135006516),
+    ("12", 133851895), ("13", 115169878), ("14", 107349540),
+    ("15", 102531392), ("16", 90354753), ("17", 81195210), ("18", 78077248),
+    ("19", 59128983), ("20", 63025520), ("21", 48129895), ("22", 51304566),
+    ("X", 155270560), ("Y", 59373566), ("MT", 16569)]
+B38_CONTIG_LENGTHS = [
+    ("chr1", 248956422), ("chr2", 242193529), ("chr3", 198295559),
+    ("chr4", 190214555), ("chr5", 181538259), ("chr6", 170805979),
+    ("chr7", 159345973), ("chr8", 145138636), ("chr9", 138394717),
+    ("chr10", 133797422), ("chr11", 135086622), ("chr12", 133275309),
+    ("chr13", 114364328), ("chr14", 107043718), ("chr15", 101991189),
+    ("chr16", 90338345), ("chr17", 83257441), ("chr18", 80373285),
+    ("chr19", 58617616), ("chr20", 64444167), ("chr21", 46709983),
+    ("chr22", 50818468), ("chrX", 156040895), ("chrY", 57227415),
+    ("chrM", 16569)]
+
+# The annotation columns of each source, from which --columns selects.  The
+# JOIN key (reference_name, start, end, reference_bases and alternate_bases)
+# is always selected.
+SOURCE_COLUMNS = {
+    "dbSNP": ["rs_names", "RS", "dbSNP_rsid"],
+    "clinvar": ["clinvar_rsid", "CLNDBN", "CLNACC", "CLNDSDB", "CLNDSDBID",
+                "CLNREVSTAT", "CLNSIG"],
+    "thousandGenomes": ["AFR_AF_1000G", "AMR_AF_1000G", "EAS_AF_1000G",
+                        "EUR_AF_1000G", "SAS_AF_1000G",
+                        "thousandGenomes_rsid"],
+    "ESP_AA": ["ESP_AA_AF", "ESP_AA_rsid"],
+    "ESP_EA": ["ESP_EA_AF", "ESP_EA_rsid"],
+}
+
+# The template replacement of the table of each annotation source.
+SOURCE_TABLE_KEYS = {
+    "dbSNP": "DBSNP_TABLE",
+    "clinvar": "CLINVAR_TABLE",
+    "thousandGenomes": "THOUSAND_GENOMES_TABLE",
+    "ESP_AA": "ESP_AA_TABLE",
+    "ESP_EA": "ESP_EA_TABLE",
+}
+
+# The columns the annotation sources are joined on.
+KEY_COLUMNS = ["reference_name", "start", "`end`", "reference_bases",
+               "alternate_bases"]
+
+# The columns of the windows.tsv written with --output_dir.
+WINDOW_COLUMNS = ("WINDOW", "REFERENCE_NAME", "START", "END", "QUERY")
+
+# A region of a contig with 0-based, half-open coordinates.
+Window = collections.namedtuple("Window",
+                                ["name", "reference_name", "start", "end"])
+
+
+def contig_aliases(name):
+  """Returns the names a contig may have in the sequence and source tables.
+
+  The sequence table may name contigs with or without a "chr" prefix, and the
+  annotation tables usually name them without it.
+  """
+  bare = name[3:] if name.startswith("chr") else name
+  if bare in ("M", "MT"):
+    return ["M", "MT", "chrM", "chrMT"]
+  return [bare, "chr" + bare]
+
+
+def plan_windows(contigs, window_size=0):
+  """Returns the Windows covering contigs.
+
+  Args:
+    contigs: List of (name, length) of the contigs.
+    window_size: Number of bases per window, or 0 for one window per contig.
+  """
+  windows = []
+  for name, length in contigs:
+    size = window_size if window_size > 0 else length
+    for start in range(0, length, size):
+      window_name = name
+      if size < length:
+        window_name = "%s_%09d" % (name, start)
+      windows.append(Window(window_name, name, start, min(length, start + size)))
+  return windows
+
+
+def region_replacements(window):
+  """Returns the template replacements restricting a query to a region.
+
+  Args:
+    window: The Window of the region.  Its end may be None for the rest of
+        the contig.
+  """
+  names = ", ".join("'%s'" % alias
+                    for alias in contig_aliases(window.reference_name))
+  position = "sequence_start + base_pair_offset"
+  # Keep the sequence records overlapping the window...
+  sequence_filter = ["chr IN (%s)" % names]
+  # ... then only their bases inside it.
+  base_filter = ["%s >= %d" % (position, window.start)]
+  source_filter = ["reference_name IN (%s)" % names,
+                   "start >= %d" % window.start]
+  if window.start:
+    sequence_filter.append("sequence_start + LENGTH(sequence) > %d" %
+                           window.start)
+  if window.end is not None:
+    sequence_filter.append("sequence_start < %d" % window.end)
+    base_filter.append("%s < %d" % (position, window.end))
+    source_filter.append("start < %d" % window.end)
+  return {
+      "SEQUENCE_FILTER": "WHERE " + "\n    AND ".join(sequence_filter),
+      "BASE_FILTER": "\n    AND ".join(base_filter),
+      "REGION_PREDICATES": source_filter,
+  }
+
+
+def source_replacements(snp_only, region_predicates=()):
+  """Returns the template replacements filtering the annotation sources.
+
+  Args:
+    snp_only: Whether to drop the rows and alleles of the sources that are
+        not single-base, which cannot match a SNP.  The reference allele is
+        tested before the alternate alleles are unnested.
+    region_predicates: Predicates on the rows of the sources, from
+        region_replacements.
+  """
+  predicates = ["LENGTH(reference_bases) = 1"] if snp_only else []
+  predicates.extend(region_predicates)
+  return {
+      "SOURCE_FILTER": "\n      AND ".join(predicates),
+      "ALLELE_FILTER": "LENGTH(alternate_bases) = 1" if snp_only else "",
+  }
+
+
+def query_replacements(replacements, window=None, snp_only=True):
+  """Returns replacements with those of a region and the source filters."""
+  result = replacements.copy()
+  region_predicates = []
+  if window is not None:
+    result.update(region_replacements(window))
+    region_predicates = result.pop("REGION_PREDICATES")
+  result.update(source_replacements(snp_only, region_predicates))
+  return result
+
+
+def parse_columns(values, sources):
+  """Parses the --columns flags.
+
+  Args:
+    values: List of SOURCE=COLUMN,COLUMN,... strings.
+    sources: The annotation sources of the query.
+
+  Returns:
+    A dict from each source to the list of its columns to select.  Sources
+    without a flag select all of SOURCE_COLUMNS.
+
+  Raises:
+    ValueError: If a source or column is unknown.
+  """
+  columns = dict((source, list(SOURCE_COLUMNS[source])) for source in sources)
+  for value in values:
+    source, _, names = value.partition("=")
+    if source not in columns:
+      raise ValueError("Unknown annotation source %r" % source)
+    selected = [name for name in names.split(",") if name]
+    unknown = [name for name in selected if name not in SOURCE_COLUMNS[source]]
+    if unknown:
+      raise ValueError("Unknown columns of %s: %s (choose from %s)" % (
+          source, ", ".join(unknown), ", ".join(SOURCE_COLUMNS[source])))
+    columns[source] = selected
+  return columns
+
+
+def render_template(filename, replacements, sources, columns=None):
+  if columns is None:
+    columns = SOURCE_COLUMNS
+  template = Environment(loader=FileSystemLoader("./")).from_string(
+      open(filename, "r").read())
+  return template.render(replacements, annot_sources=sources, columns=columns)
+
+
+def write_partitioned_queries(output_dir, windows, replacements, sources,
+                              columns=None, snp_only=True):
+  """Writes one JOIN query per window, and windows.tsv listing them.
+
+  Returns:
+    The path of windows.tsv.
+  """
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+  plan_path = os.path.join(output_dir, "windows.tsv")
+  with open(plan_path, "w") as plan:
+    plan.write("\t".join(WINDOW_COLUMNS) + "\n")
+    for window in windows:
+      filename = window.name + ".sql"
+      with open(os.path.join(output_dir, filename), "w") as outfile:
+        outfile.write(render_template(
+            "join_annotations.sql",
+            query_replacements(replacements, window, snp_only), sources,
+            columns))
+      plan.write("\t".join([window.name, window.reference_name,
+                             str(window.start), str(window.end),
+                             filename]) + "\n")
+  return plan_path
+
+
+def dry_run_bytes(project=None):
+  """Returns a function from a query to the bytes a BigQuery dry run bills.
+
+  Requires the google-cloud-bigquery package.
+  """
+  from google.cloud import bigquery  # pylint: disable=g-import-not-at-top
+  client = bigquery.Client(project=project)
+  config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+  return lambda query: client.query(
+      query, job_config=config).total_bytes_processed
+
+
+def format_dry_run_report(queries, estimate_bytes):
+  """Returns a report of the bytes processed by queries before and after.
+
+  Args:
+    queries: List of (name, query without pushdown, query with pushdown).
+    estimate_bytes: Function from a query to the bytes it would process, such
+        as dry_run_bytes().
+  """
+  lines = ["%-24s %16s %16s %8s" % ("query", "before (bytes)", "after (bytes)",
+                                    "saved")]
+  total_before = total_after = 0
+  for name, before_query, after_query in queries:
+    before = estimate_bytes(before_query)
+    after = estimate_bytes(after_query)
+    total_before += before
+    total_after += after
+    lines.append("%-24s %16d %16d %7.1f%%" % (
+        name, before, after, 100.0 * (before - after) / max(1, before)))
+  if len(queries) > 1:
+    lines.append("%-24s %16d %16d %7.1f%%" % (
+        "total", total_before, total_after,
+        100.0 * (total_before - total_after) / max(1, total_before)))
+  return "\n".join(lines)
+
+
+def render_refresh_query(replacements, source, columns, old_table, new_table,
+                         annotated_table, window=None, dialect="bigquery"):
+  """Renders the query refreshing one source's columns of an annotated table.
+
+  The query compares the old and new versions of the source, as prepared for
+  the JOIN by the source's template, and rewrites the source's columns of the
+  rows of the annotated table whose keys have rows added, removed or changed.
+
+  Args:
+    replacements: The template replacements of the build.
+    source: Name of the annotation source, such as "clinvar".
+    columns: The dict of the columns selected from each source, from
+        parse_columns.  Only the selected columns of the source are
+        refreshed.
+    old_table: The table of the version of the source in the annotated table.
+    new_table: The table of the new version of the source.
+    annotated_table: The annotated table to update.
+    window: The Window of the only region to refresh, or None.
+    dialect: "bigquery" for a MERGE of the source tables as prepared by the
+        source's template, or "sqlite" for an UPDATE of already prepared
+        tables, with the columns of the source's CTE, to test the query
+        locally.
+
+  Returns:
+    The query.
+  """
+  query = query_replacements(replacements, window)
+  source_queries = {}
+  for version, table in (("OLD", old_table), ("NEW", new_table)):
+    version_replacements = query.copy()
+    version_replacements[SOURCE_TABLE_KEYS[source]] = table
+    source_queries[version + "_SOURCE_QUERY"] = render_template(
+        source + ".sql", version_replacements, [source], columns)
+  value_columns = columns[source]
+  if not value_columns:
+    raise ValueError("No columns of %s are selected" % source)
+  if dialect == "bigquery":
+    row_digest = "TO_JSON_STRING(STRUCT(%s))" % ", ".join(value_columns)
+    set_quantifier = " DISTINCT"
+  else:
+    row_digest = " || ',' || ".join("quote(%s)" % column
+                                    for column in value_columns)
+    set_quantifier = ""
+  query.update(source_queries)
+  query.update({
+      "DIALECT": dialect,
+      "SOURCE": source,
+      "OLD_TABLE": old_table,
+      "NEW_TABLE": new_table,
+      "ANNOTATED_TABLE": annotated_table,
+      "KEY_COLUMNS": KEY_COLUMNS,
+      "VALUE_COLUMNS": value_columns,
+      "ROW_DIGEST": row_digest,
+      "SET_QUANTIFIER": set_quantifier,
+  })
+  return render_template("refresh_annotations.sql", query, [source], columns)
+
+
+def print_dry_run_report(queries, project=None):
+  """Prints format_dry_run_report of queries, estimated by BigQuery."""
+  report = format_dry_run_report(queries, dry_run_bytes(project))
+  sys.stdout.write("""
+Bytes processed without and with the column selection and SNP-only filters:
+
+%s
+""" % report)
+
 
 def run(argv=None):
   """Main entry point."""
   parser = argparse.ArgumentParser()
   parser.add_argument(
       "--sequence_table",
-      required=True,
       help="Fully qualified BigQuery table name for the reference "
-      "genome sequences to be converted to all-possible SNPs.")
+      "genome sequences to be converted to all-possible SNPs.  Required "
+      "unless --refresh_source is given.")
   parser.add_argument(
       "--b37",
       dest="is_b37",
@@ -106,7 +429,82 @@ def run(argv=None):
       dest="debug",
       action="store_true",
       help="Generate SQL that will yield a small table for testing purposes.")
+  parser.add_argument(
+      "--output_dir",
+      help="Write one query per contig or window to this directory, with a "
+      "windows.tsv listing them, instead of a single query to --output.")
+  parser.add_argument(
+      "--window_size",
+      type=int,
+      default=0,
+      help="With --output_dir, the number of bases per window.  0 writes one "
+      "query per contig.")
+  parser.add_argument(
+      "--fai",
+      help="With --output_dir, a samtools .fai index of the reference whose "
+      "contigs to cover.  Defaults to the primary assembly of the build.")
+  parser.add_argument(
+      "--contigs",
+      help="With --output_dir, comma-separated names of the only contigs to "
+      "cover.")
+  parser.add_argument(
+      "--region",
+      help="Annotate only this region, as a samtools-style region such as "
+      "chr17:41196312-41277499.  The region is pushed into every annotation "
+      "source.")
+  parser.add_argument(
+      "--columns",
+      action="append",
+      default=[],
+      help="The annotation columns to select from a source, as "
+      "SOURCE=COLUMN,COLUMN,...  May be repeated.  Sources without this flag "
+      "select all of their columns.")
+  parser.add_argument(
+      "--dry_run_report",
+      action="store_true",
+      help="Print the bytes BigQuery would process for each query, with and "
+      "without the column selection and the SNP-only filters of the sources.  "
+      "Requires the google-cloud-bigquery package.")
+  parser.add_argument(
+      "--project", help="With --dry_run_report, the project of the dry runs.")
+  parser.add_argument(
+      "--refresh_source",
+      choices=sorted(SOURCE_TABLE_KEYS),
+      help="Instead of the JOIN, write to --output a query that updates the "
+      "columns of this source in --annotated_table, on just the rows whose "
+      "annotations differ between --old_table and --new_table.")
+  parser.add_argument(
+      "--annotated_table",
+      help="With --refresh_source, the table the JOIN was materialized to.")
+  parser.add_argument(
+      "--old_table",
+      help="With --refresh_source, the version of the source in "
+      "--annotated_table.")
+  parser.add_argument(
+      "--new_table",
+      help="With --refresh_source, the new version of the source.  Defaults "
+      "to the source's table for the build.")
+  parser.add_argument(
+      "--dialect",
+      choices=("bigquery", "sqlite"),
+      default="bigquery",
+      help="With --refresh_source, write a BigQuery MERGE, or an SQLite "
+      "UPDATE of tables already shaped like the source's CTE to test it "
+      "locally.")
   args = parser.parse_args(argv)
+  if args.refresh_source:
+    if not (args.annotated_table and args.old_table):
+      parser.error("--refresh_source requires --annotated_table and "
+                   "--old_table.")
+    if args.output_dir or args.debug:
+      parser.error("--refresh_source cannot be used with --output_dir or "
+                   "--debug.")
+  elif not args.sequence_table:
+    parser.error("--sequence_table is required.")
+  if args.output_dir and args.debug:
+    parser.error("--debug cannot be used with --output_dir.")
+  if args.region and (args.output_dir or args.debug):
+    parser.error("--region cannot be used with --output_dir or --debug.")
 
   sources = B37_ANNOTATION_SOURCES if (
       args.is_b37) else B38_ANNOTATION_SOURCES
@@ -118,15 +516,90 @@ def run(argv=None):
   if not args.debug:
     replacements["SEQUENCE_FILTER"] = ""
 
-  join_template = Environment(loader=FileSystemLoader("./")).from_string(
-      open("join_annotations.sql", "r").read())
-  join_query = join_template.render(replacements, annot_sources=sources)
+  try:
+    columns = parse_columns(args.columns, sources)
+  except ValueError as e:
+    parser.error(str(e))
+
+  window = None
+  if args.region:
+    try:
+      name, start, end = fasta_to_kv.parse_region(args.region)
+    except ValueError as e:
+      parser.error(str(e))
+    window = Window(name, name, start, end)
+
+  if args.refresh_source:
+    refresh_query = render_refresh_query(
+        replacements, args.refresh_source, columns, args.old_table,
+        args.new_table or replacements[SOURCE_TABLE_KEYS[args.refresh_source]],
+        args.annotated_table, window, args.dialect)
+    with open(args.output, "w") as outfile:
+      outfile.write(refresh_query)
+    sys.stdout.write("""
+Query refreshing the %s columns of %s written to output file %s.
+""" % (args.refresh_source, args.annotated_table, args.output))
+    return
+
+  # The check query compares the rsids of the sources with dbSNP's.
+  check_sources = [source for source in sources
+                   if source + "_rsid" in columns[source]]
+  if "dbSNP" in check_sources:
+    check_query = render_template("check_joined_annotations.sql", replacements,
+                                  check_sources, columns)
+  else:
+    check_query = ("(None: the check needs the dbSNP_rsid column, which is "
+                   "not selected.)")
+  if args.output_dir:
+    if args.fai:
+      contigs = [(entry.name, entry.length)
+                 for entry in fasta_to_kv.read_fai(args.fai)]
+    else:
+      contigs = B37_CONTIG_LENGTHS if args.is_b37 else B38_CONTIG_LENGTHS
+    if args.contigs:
+      wanted = args.contigs.split(",")
+      contigs = [(name, length) for name, length in contigs if name in wanted]
+      if len(contigs) != len(wanted):
+        parser.error("--contigs names contigs that are not in the reference.")
+    windows = plan_windows(contigs, args.window_size)
+    plan_path = write_partitioned_queries(args.output_dir, windows,
+                                          replacements, sources, columns)
+    if args.dry_run_report:
+      print_dry_run_report([(
+          window.name,
+          render_template("join_annotations.sql",
+                          query_replacements(replacements, window, False),
+                          sources),
+          render_template("join_annotations.sql",
+                          query_replacements(replacements, window), sources,
+                          columns)) for window in windows], args.project)
+    sys.stdout.write("""
+%d JOIN queries written to directory %s, and listed in %s.  Run them with
+run_partitioned_queries.py, for example:
+
+python run_partitioned_queries.py \\
+  --windows %s \\
+  --destination_table YOUR_PROJECT.YOUR_DATASET.YOUR_TABLE
+
+Be sure to test the result of the JOIN, for example:
+
+%s
+""" % (len(windows), args.output_dir, plan_path, plan_path, check_query))
+    return
+
+  join_query = render_template("join_annotations.sql",
+                               query_replacements(replacements, window),
+                               sources, columns)
   with open(args.output, "w") as outfile:
     outfile.write(join_query)
+  if args.dry_run_report:
+    print_dry_run_report([(
+        os.path.basename(args.output),
+        render_template("join_annotations.sql",
+                        query_replacements(replacements, window, False),
+                        sources),
+        join_query)], args.project)
 
-  check_template = Environment(loader=FileSystemLoader("./")).from_string(
-      open("check_joined_annotations.sql", "r").read())
-  check_query = check_template.render(replacements, annot_sources=sources)
   sys.stdout.write("""
 Resulting JOIN query written to output file %s.  Run that query using the
 BigQuery web UI or the bq command line tool.
@@ -0,0 +1,108 @@
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the refresh query of render_templated_sql.py.
+
+The --dialect sqlite query is run against small fixture tables in an
+in-memory SQLite database.  UPDATE ... FROM requires SQLite 3.33 or later.
+
+Run with:
+
+python -m unittest discover -s curation/allPossibleSNPs -p "*_test.py"
+"""
+
+from __future__ import absolute_import
+
+import os
+import sqlite3
+import unittest
+
+import render_templated_sql
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# An annotated table with the columns of clinvar and of another source, and
+# two versions of clinvar, with the columns of its CTE.  Relative to the old
+# version, the new one changes CLNSIG at 100, removes 200, adds 300 and leaves
+# 400 alone.  CLNACC is not selected, so it must never be rewritten, and the
+# annotated row at 400 has a stale clinvar_rsid that must be left as it is,
+# since its source rows did not change.
+_FIXTURE = """
+CREATE TABLE annotated (
+  reference_name TEXT, start INTEGER, `end` INTEGER, reference_bases TEXT,
+  alternate_bases TEXT, clinvar_rsid TEXT, CLNSIG TEXT, CLNACC TEXT,
+  dbSNP_rsid TEXT);
+CREATE TABLE clinvar_old (
+  reference_name TEXT, start INTEGER, `end` INTEGER, reference_bases TEXT,
+  alternate_bases TEXT, clinvar_rsid TEXT, CLNSIG TEXT, CLNACC TEXT);
+CREATE TABLE clinvar_new AS SELECT * FROM clinvar_old;
+
+INSERT INTO annotated VALUES
+  ('1', 100, 101, 'A', 'G', 'rs1', 'benign', 'acc1', 'rs1'),
+  ('1', 100, 101, 'A', 'T', NULL, NULL, NULL, 'rs1t'),
+  ('1', 200, 201, 'C', 'T', 'rs2', 'pathogenic', 'acc2', 'rs2'),
+  ('1', 300, 301, 'G', 'A', NULL, NULL, NULL, 'rs3'),
+  ('1', 400, 401, 'T', 'C', 'stale', 'benign', 'acc4', 'rs4'),
+  ('2', 100, 101, 'A', 'G', NULL, NULL, NULL, 'rs5');
+INSERT INTO clinvar_old VALUES
+  ('1', 100, 101, 'A', 'G', 'rs1', 'benign', 'acc1'),
+  ('1', 200, 201, 'C', 'T', 'rs2', 'pathogenic', 'acc2'),
+  ('1', 400, 401, 'T', 'C', 'rs4', 'benign', 'acc4');
+INSERT INTO clinvar_new VALUES
+  ('1', 100, 101, 'A', 'G', 'rs1', 'likely benign', 'new acc1'),
+  ('1', 300, 301, 'G', 'A', 'rs3', 'uncertain', 'acc3'),
+  ('1', 400, 401, 'T', 'C', 'rs4', 'benign', 'new acc4');
+"""
+
+_EXPECTED = [
+    ("1", 100, "G", "rs1", "likely benign", "acc1", "rs1"),
+    ("1", 100, "T", None, None, None, "rs1t"),
+    ("1", 200, "T", None, None, "acc2", "rs2"),
+    ("1", 300, "A", "rs3", "uncertain", None, "rs3"),
+    ("1", 400, "C", "stale", "benign", "acc4", "rs4"),
+    ("2", 100, "G", None, None, None, "rs5"),
+]
+
+
+class RefreshQueryTest(unittest.TestCase):
+
+  def setUp(self):
+    # The templates are read from the working directory.
+    self.cwd = os.getcwd()
+    os.chdir(_DIRECTORY)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+
+  def test_sqlite_refresh_rewrites_only_changed_rows(self):
+    columns = render_templated_sql.parse_columns(
+        ["clinvar=clinvar_rsid,CLNSIG"],
+        render_templated_sql.B38_ANNOTATION_SOURCES)
+    query = render_templated_sql.render_refresh_query(
+        render_templated_sql.B38_QUERY_REPLACEMENTS, "clinvar", columns,
+        "clinvar_old", "clinvar_new", "annotated", dialect="sqlite")
+
+    connection = sqlite3.connect(":memory:")
+    try:
+      connection.executescript(_FIXTURE)
+      connection.execute(query)
+      self.assertEqual(_EXPECTED, connection.execute(
+          "SELECT reference_name, start, alternate_bases, clinvar_rsid, "
+          "CLNSIG, CLNACC, dbSNP_rsid FROM annotated "
+          "ORDER BY reference_name, start, alternate_bases").fetchall())
+    finally:
+      connection.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Run the partitioned queries written by render_templated_sql.py.
+
+Each window's query is run with its results appended to --destination_table,
+which is created on the first append, clustered on reference_name and start.
+Up to --max_concurrent queries run at once.  Progress is recorded in a local
+state file before and after each window, and windows that already completed
+with the same query are skipped when the command is run again, so after a
+failure only the failed windows are run again.  --window runs only the given
+windows.
+
+A failed query appends nothing, so a window is never half written.  Before a
+window that was started before is run again (because it failed, its query
+changed, or this command was killed while it ran), its rows are deleted from
+the destination table, so running a window again never duplicates its rows.
+
+Queries run on BigQuery with the google-cloud-bigquery package.  With
+--client local, they are instead written to --local_dir, which exercises the
+planning, concurrency and retries without BigQuery; --fail_window makes given
+windows fail.
+
+Example usage:
+
+python render_templated_sql.py \
+    --sequence_table ${DATASET}.VerilyGRCh38_sequences \
+    --b38 \
+    --output_dir windows
+
+python run_partitioned_queries.py \
+    --windows windows/windows.tsv \
+    --destination_table ${PROJECT_ID}.${DATASET}.VerilyGRCh38_annotated_snps \
+    --max_concurrent 8
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import collections
+import csv
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import render_templated_sql
+
+# The columns the destination table is clustered on.
+CLUSTERING_FIELDS = ["reference_name", "start"]
+
+# One row of windows.tsv, with the text of its query.
+WindowQuery = collections.namedtuple(
+    "WindowQuery", ["name", "reference_name", "start", "end", "query"])
+
+
+def read_windows(path):
+  """Reads the windows.tsv written by render_templated_sql.py.
+
+  Returns:
+    A list of WindowQuery.
+
+  Raises:
+    ValueError: If a column is missing.
+  """
+  directory = os.path.dirname(os.path.abspath(path))
+  windows = []
+  with open(path, "r") as f:
+    reader = csv.DictReader(f, delimiter="\t")
+    missing = [c for c in render_templated_sql.WINDOW_COLUMNS
+               if c not in (reader.fieldnames or [])]
+    if missing:
+      raise ValueError("%s is missing columns %s" % (path, ", ".join(missing)))
+    for record in reader:
+      with open(os.path.join(directory, record["QUERY"]), "r") as query:
+        windows.append(WindowQuery(record["WINDOW"], record["REFERENCE_NAME"],
+                                   int(record["START"]), int(record["END"]),
+                                   query.read()))
+  return windows
+
+
+def window_predicate(window):
+  """Returns the condition selecting the rows of a window in the results."""
+  names = ", ".join("'%s'" % alias for alias in
+                    render_templated_sql.contig_aliases(window.reference_name))
+  return "reference_name IN (%s) AND start >= %d AND start < %d" % (
+      names, window.start, window.end)
+
+
+def query_digest(query):
+  return hashlib.sha1(query.encode("utf-8")).hexdigest()
+
+
+class QueryState(object):
+  """Resumable record of the windows whose queries have run.
+
+  The state is a JSON dict from window name to a dict holding the "status"
+  ("started", "done" or "failed") of its latest attempt, the "digest" of its query, the
+  "destination" table, the "job_id", the "seconds" it took and any "error".
+  It is rewritten atomically after each window.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self.windows = {}
+    if os.path.exists(path):
+      with open(path, "r") as f:
+        self.windows = json.load(f)
+
+  def was_started(self, window):
+    """Returns True if the window was run before, whatever the outcome."""
+    return window.name in self.windows
+
+  def is_done(self, window, destination):
+    """Returns True if the same query of the window completed."""
+    entry = self.windows.get(window.name)
+    return (entry is not None and entry["status"] == "done" and
+            entry["digest"] == query_digest(window.query) and
+            entry["destination"] == destination)
+
+  def record(self, window, destination, status, job_id=None, seconds=None,
+             error=None):
+    with self._lock:
+      self.windows[window.name] = {
+          "status": status,
+          "digest": query_digest(window.query),
+          "destination": destination,
+          "job_id": job_id,
+          "seconds": seconds,
+          "error": error,
+          "finished": time.time(),
+      }
+      directory = os.path.dirname(os.path.abspath(self.path))
+      fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+      with os.fdopen(fd, "w") as f:
+        json.dump(self.windows, f, indent=2, sort_keys=True)
+      os.rename(temp_path, self.path)
+
+
+class BigQueryClient(object):
+  """Runs queries on BigQuery, appending their results to a table."""
+
+  def __init__(self, project=None):
+    # Imported here so that the local client works without the package.
+    from google.cloud import bigquery  # pylint: disable=g-import-not-at-top
+    from google.cloud import exceptions  # pylint: disable=g-import-not-at-top
+    self._bigquery = bigquery
+    self._not_found = exceptions.NotFound
+    self._client = bigquery.Client(project=project)
+
+  def delete_window(self, window, destination_table):
+    """Deletes the rows of a window from the table, if it exists.
+
+    Args:
+      window: The WindowQuery whose rows to delete.
+      destination_table: "project.dataset.table" holding the results.
+    """
+    try:
+      self._client.get_table(destination_table)
+    except self._not_found:
+      return
+    config = self._bigquery.QueryJobConfig()
+    config.use_legacy_sql = False
+    self._client.query(
+        "DELETE FROM `%s` WHERE %s" % (destination_table,
+                                       window_predicate(window)),
+        job_config=config).result()
+
+  def run_query(self, name, query, destination_table, clustering_fields):
+    """Runs a query and waits for it to finish.
+
+    Args:
+      name: Name of the window, used in the job labels.
+      query: Standard SQL query.
+      destination_table: "project.dataset.table" to append the results to.
+      clustering_fields: Columns the table is clustered on if it is created.
+
+    Returns:
+      The id of the job.
+
+    Raises:
+      Exception: If the query failed.
+    """
+    config = self._bigquery.QueryJobConfig()
+    config.destination = destination_table
+    config.write_disposition = "WRITE_APPEND"
+    config.create_disposition = "CREATE_IF_NEEDED"
+    config.clustering_fields = clustering_fields
+    config.use_legacy_sql = False
+    config.labels = {"window": name.lower().replace(".", "_")[:63]}
+    job = self._client.query(query, job_config=config)
+    job.result()
+    return job.job_id
+
+
+class LocalClient(object):
+  """Stand-in for BigQueryClient that writes queries to a local directory.
+
+  Each query is written to DIRECTORY/TABLE/NAME.sql, where TABLE is the
+  destination table, as if its results had been appended to the table, and
+  deleting the rows of a window removes its file.
+  Windows in fail_windows fail instead, once each unless always_fail is set,
+  to exercise the retries.
+  """
+
+  def __init__(self, directory, fail_windows=(), always_fail=False):
+    self.directory = directory
+    self.fail_windows = set(fail_windows)
+    self.always_fail = always_fail
+    self._lock = threading.Lock()
+
+  def delete_window(self, window, destination_table):
+    path = os.path.join(self.directory, destination_table, window.name + ".sql")
+    if os.path.exists(path):
+      os.remove(path)
+
+  def run_query(self, name, query, destination_table, clustering_fields):
+    with self._lock:
+      if name in self.fail_windows:
+        if not self.always_fail:
+          self.fail_windows.remove(name)
+        raise RuntimeError("Simulated failure of window %s" % name)
+    table_dir = os.path.join(self.directory, destination_table)
+    with self._lock:
+      if not os.path.isdir(table_dir):
+        os.makedirs(table_dir)
+    with open(os.path.join(table_dir, name + ".sql"), "w") as f:
+      f.write("-- Clustered on %s\n" % ", ".join(clustering_fields))
+      f.write(query)
+    return "local-" + name
+
+
+# The timeline of one window of a run: seconds from the start of the run
+# until the window's query started and until it finished.
+WindowTiming = collections.namedtuple("WindowTiming",
+                                      ["name", "started", "finished"])
+
+
+class PartitionedQueryRunner(object):
+  """Runs the queries of windows with bounded concurrency."""
+
+  def __init__(self, client, state, destination_table, max_concurrent=4,
+               clustering_fields=None):
+    """Create PartitionedQueryRunner class.
+
+    Args:
+      client: A BigQueryClient, LocalClient or other object with their
+          delete_window and run_query methods.
+      state: A QueryState.
+      destination_table: "project.dataset.table" to append the results to.
+      max_concurrent: Maximum number of queries running at once.
+      clustering_fields: Columns the table is clustered on if it is created.
+          Defaults to CLUSTERING_FIELDS.
+    """
+    self.client = client
+    self.state = state
+    self.destination_table = destination_table
+    self.max_concurrent = max_concurrent
+    self.clustering_fields = clustering_fields or CLUSTERING_FIELDS
+    self._start_time = None
+
+  def _run_window(self, window):
+    started = time.time() - self._start_time
+    logging.info("Starting window %s", window.name)
+    rerun = self.state.was_started(window)
+    self.state.record(window, self.destination_table, "started")
+    try:
+      if rerun:
+        # Remove any rows an earlier run of the window appended.
+        self.client.delete_window(window, self.destination_table)
+      job_id = self.client.run_query(window.name, window.query,
+                                     self.destination_table,
+                                     self.clustering_fields)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Window %s failed", window.name)
+      self.state.record(window, self.destination_table, "failed",
+                        error=str(e))
+      return window, None
+    finished = time.time() - self._start_time
+    self.state.record(window, self.destination_table, "done", job_id=job_id,
+                      seconds=finished - started)
+    logging.info("Finished window %s in %.0f seconds", window.name,
+                 finished - started)
+    return window, WindowTiming(window.name, started, finished)
+
+  def run(self, windows):
+    """Runs the queries of the windows that are not already done.
+
+    Args:
+      windows: List of WindowQuery.
+
+    Returns:
+      A tuple of (list of WindowTiming of the windows run, list of the
+      WindowQuery that failed, number of windows skipped).
+    """
+    todo = [window for window in windows
+            if not self.state.is_done(window, self.destination_table)]
+    skipped = len(windows) - len(todo)
+    if skipped:
+      logging.info("Skipping %d windows already done", skipped)
+
+    self._start_time = time.time()
+    timings = []
+    failed = []
+    pool = ThreadPool(max(1, min(self.max_concurrent, len(todo) or 1)))
+    try:
+      for window, timing in pool.imap_unordered(self._run_window, todo):
+        if timing is None:
+          failed.append(window)
+        else:
+          timings.append(timing)
+        logging.info("%d of %d windows finished (%d failed)",
+                     len(timings) + len(failed), len(todo), len(failed))
+    finally:
+      pool.terminate()
+    return timings, failed, skipped
+
+
+def format_report(timings, failed, skipped, wall_seconds):
+  """Returns a summary of a run."""
+  lines = ["Ran %d windows in %.0f seconds (%d skipped, %d failed)." %
+           (len(timings), wall_seconds, skipped, len(failed))]
+  if timings:
+    longest = max(timings, key=lambda t: t.finished - t.started)
+    lines.append("Longest window: %s took %.0f seconds." %
+                 (longest.name, longest.finished - longest.started))
+  for window in failed:
+    lines.append("FAILED: %s" % window.name)
+  if failed:
+    lines.append("Run the same command again to retry the failed windows.")
+  return "\n".join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      "--windows",
+      required=True,
+      help="The windows.tsv written by render_templated_sql.py "
+      "--output_dir.")
+  parser.add_argument(
+      "--destination_table",
+      required=True,
+      help="Table, as project.dataset.table, to which to append the results.")
+  parser.add_argument(
+      "--window",
+      action="append",
+      help="Name of a window to run.  May be repeated.  Defaults to all of "
+      "them.")
+  parser.add_argument(
+      "--max_concurrent",
+      type=int,
+      default=4,
+      help="Maximum number of queries running at once.")
+  parser.add_argument(
+      "--state_file",
+      help="Local file recording the windows that have run.  Defaults to "
+      "the windows path with a .state.json suffix.")
+  parser.add_argument(
+      "--project", help="Project to run the queries in, if not the default.")
+  parser.add_argument(
+      "--client",
+      choices=("bigquery", "local"),
+      default="bigquery",
+      help="Run the queries on BigQuery, or write them to --local_dir.")
+  parser.add_argument(
+      "--local_dir",
+      default="local_queries",
+      help="With --client local, the directory to write the queries to.")
+  parser.add_argument(
+      "--fail_window",
+      action="append",
+      default=[],
+      help="With --client local, a window whose query fails.  May be "
+      "repeated.")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+
+  windows = read_windows(args.windows)
+  if args.window:
+    unknown = set(args.window) - set(window.name for window in windows)
+    if unknown:
+      parser.error("Unknown windows: %s" % ", ".join(sorted(unknown)))
+    windows = [window for window in windows if window.name in args.window]
+
+  if args.client == "local":
+    client = LocalClient(args.local_dir, args.fail_window, always_fail=True)
+  else:
+    client = BigQueryClient(args.project)
+  state = QueryState(args.state_file or args.windows + ".state.json")
+  runner = PartitionedQueryRunner(client, state, args.destination_table,
+                                  max_concurrent=args.max_concurrent)
+  start_time = time.time()
+  timings, failed, skipped = runner.run(windows)
+  print(format_report(timings, failed, skipped, time.time() - start_time))
+  if failed:
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,141 @@
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for run_partitioned_queries.py, with its LocalClient.
+
+Run with:
+
+python -m unittest discover -s curation/allPossibleSNPs -p "*_test.py"
+"""
+
+from __future__ import absolute_import
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import run_partitioned_queries
+
+_DESTINATION = "project.dataset.annotated_snps"
+
+
+class _RecordingClient(run_partitioned_queries.LocalClient):
+  """LocalClient that records the deletes and queries of each window."""
+
+  def __init__(self, directory, fail_windows=()):
+    run_partitioned_queries.LocalClient.__init__(self, directory, fail_windows)
+    self.calls = []
+    self._calls_lock = threading.Lock()
+
+  def _record(self, call, name):
+    with self._calls_lock:
+      self.calls.append((call, name))
+
+  def delete_window(self, window, destination_table):
+    self._record("delete", window.name)
+    run_partitioned_queries.LocalClient.delete_window(self, window,
+                                                      destination_table)
+
+  def run_query(self, name, query, destination_table, clustering_fields):
+    self._record("run", name)
+    return run_partitioned_queries.LocalClient.run_query(
+        self, name, query, destination_table, clustering_fields)
+
+
+def _window(name, start, query):
+  return run_partitioned_queries.WindowQuery(name, "chr1", start, start + 100,
+                                            query)
+
+
+class PartitionedQueryRunnerTest(unittest.TestCase):
+
+  def setUp(self):
+    # The runner logs the traceback of each failed window.
+    logging.disable(logging.ERROR)
+    self.directory = tempfile.mkdtemp()
+    self.state_path = os.path.join(self.directory, "windows.tsv.state.json")
+    self.windows = [_window("chr1_000", 0, "SELECT 0"),
+                    _window("chr1_100", 100, "SELECT 100"),
+                    _window("chr1_200", 200, "SELECT 200")]
+
+  def tearDown(self):
+    logging.disable(logging.NOTSET)
+    shutil.rmtree(self.directory)
+
+  def _run(self, client, windows=None):
+    runner = run_partitioned_queries.PartitionedQueryRunner(
+        client, run_partitioned_queries.QueryState(self.state_path),
+        _DESTINATION, max_concurrent=2)
+    return runner.run(windows or self.windows)
+
+  def _written(self):
+    table_dir = os.path.join(self.directory, "out", _DESTINATION)
+    written = {}
+    for name in sorted(os.listdir(table_dir)):
+      with open(os.path.join(table_dir, name), "r") as f:
+        written[name[:-len(".sql")]] = f.read().splitlines()[-1]
+    return written
+
+  def test_failed_window_is_retried_alone_after_deleting_its_rows(self):
+    client = _RecordingClient(os.path.join(self.directory, "out"),
+                              fail_windows=["chr1_100"])
+    timings, failed, skipped = self._run(client)
+    self.assertEqual([window.name for window in failed], ["chr1_100"])
+    self.assertEqual((len(timings), skipped), (2, 0))
+    # Windows run for the first time are not deleted.
+    self.assertEqual(sorted(client.calls), [("run", "chr1_000"),
+                                            ("run", "chr1_100"),
+                                            ("run", "chr1_200")])
+    self.assertEqual(sorted(self._written()), ["chr1_000", "chr1_200"])
+
+    client.calls = []
+    timings, failed, skipped = self._run(client)
+    self.assertEqual((len(timings), failed, skipped), (1, [], 2))
+    self.assertEqual(client.calls, [("delete", "chr1_100"),
+                                    ("run", "chr1_100")])
+    self.assertEqual(self._written(), {"chr1_000": "SELECT 0",
+                                       "chr1_100": "SELECT 100",
+                                       "chr1_200": "SELECT 200"})
+
+  def test_changed_window_is_deleted_before_it_is_appended_again(self):
+    client = _RecordingClient(os.path.join(self.directory, "out"))
+    self._run(client)
+    client.calls = []
+    self.windows[2] = _window("chr1_200", 200, "SELECT 'changed'")
+    timings, failed, skipped = self._run(client)
+    self.assertEqual((len(timings), failed, skipped), (1, [], 2))
+    self.assertEqual(client.calls, [("delete", "chr1_200"),
+                                    ("run", "chr1_200")])
+    self.assertEqual(self._written()["chr1_200"], "SELECT 'changed'")
+
+  def test_window_interrupted_after_starting_is_deleted(self):
+    # As if the command was killed after the query of a window completed but
+    # before the window was recorded as done.
+    state = run_partitioned_queries.QueryState(self.state_path)
+    state.record(self.windows[0], _DESTINATION, "started")
+    client = _RecordingClient(os.path.join(self.directory, "out"))
+    self._run(client, self.windows[:1])
+    self.assertEqual(client.calls, [("delete", "chr1_000"),
+                                    ("run", "chr1_000")])
+
+  def test_window_predicate(self):
+    self.assertEqual(
+        run_partitioned_queries.window_predicate(self.windows[1]),
+        "reference_name IN ('1', 'chr1') AND start >= 100 AND start < 200")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -8,13 +8,39 @@
     `end`,
     reference_bases,
     alternate_bases,
+    {%- if 'AFR_AF_1000G' in columns.thousandGenomes %}
     AFR_AF[OFFSET(alt_offset)] AS AFR_AF_1000G,
+    {%- endif %}
+    {%- if 'AMR_AF_1000G' in columns.thousandGenomes %}
     AMR_AF[OFFSET(alt_offset)] AS AMR_AF_1000G,
+    {%- endif %}
+    {%- if 'EAS_AF_1000G' in columns.thousandGenomes %}
     EAS_AF[OFFSET(alt_offset)] AS EAS_AF_1000G,
+    {%- endif %}
+    {%- if 'EUR_AF_1000G' in columns.thousandGenomes %}
     EUR_AF[OFFSET(alt_offset)] AS EUR_AF_1000G,
+    {%- endif %}
+    {%- if 'SAS_AF_1000G' in columns.thousandGenomes %}
     SAS_AF[OFFSET(alt_offset)] AS SAS_AF_1000G,
+    {%- endif %}
+    {%- if 'thousandGenomes_rsid' in columns.thousandGenomes %}
     -- Used to check for correctness of the JOIN.
     names[OFFSET(0)] AS thousandGenomes_rsid
+    {%- endif %}
   FROM
+    {%- if SOURCE_FILTER %}
+    (
+    SELECT
+      *
+    FROM
+      `{{ THOUSAND_GENOMES_TABLE }}`
+    WHERE
+      {{ SOURCE_FILTER }}) v,
+    {%- else %}
     `{{ THOUSAND_GENOMES_TABLE }}` v,
-    v.alternate_bases alternate_bases WITH OFFSET alt_offset )
+    {%- endif %}
+    v.alternate_bases alternate_bases WITH OFFSET alt_offset
+  {%- if ALLELE_FILTER %}
+  WHERE
+    {{ ALLELE_FILTER }}
+  {%- endif %} )
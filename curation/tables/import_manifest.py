@@ -0,0 +1,285 @@
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Import every VCF listed in a manifest to BigQuery variants tables.
+
+Each row of the manifest (see vcf_manifest.tsv) is imported with
+VcfUploader.upload_variants, with up to --max-concurrent rows in progress at
+once, so the import, export and schema update phases of different rows
+overlap.  Progress is recorded in a local state file after each row, and rows
+that already completed are skipped when the command is run again.
+
+At the end, the wall-clock time and the critical path (the row that finished
+last, and how long it waited and spent in each phase) are reported.
+
+Example usage:
+
+python import_manifest.py \
+    --manifest vcf_manifest.tsv \
+    --max-concurrent 4 \
+    --expand-wildcards
+"""
+
+import argparse
+import collections
+import csv
+import json
+import logging
+import os
+import shlex
+import tempfile
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import vcf_to_bigquery_utils
+
+# The columns of the manifest, which are also the environment variables of the
+# dsub tasks file consumed by launch_import_vcf_to_bigquery.sh.
+_MANIFEST_COLUMNS = ("PROJECT", "DATASET", "VARIANTSET", "TABLE", "SOURCE_VCFS")
+
+ManifestRow = collections.namedtuple(
+    "ManifestRow", ["project", "dataset", "variantset", "table", "source_vcfs"])
+
+
+def read_manifest(path):
+  """Reads the rows of a tab-separated VCF manifest.
+
+  Args:
+    path: Path to a manifest with a header line naming at least the columns
+        PROJECT, DATASET, VARIANTSET, TABLE and SOURCE_VCFS.  SOURCE_VCFS holds
+        one or more whitespace-separated, optionally quoted paths.
+
+  Returns:
+    A list of ManifestRow.
+
+  Raises:
+    ValueError: If a column is missing or a table is listed twice.
+  """
+  rows = []
+  with open(path, "r") as f:
+    reader = csv.DictReader(f, delimiter="\t")
+    fieldnames = reader.fieldnames or []
+    missing = [c for c in _MANIFEST_COLUMNS if c not in fieldnames]
+    if missing:
+      raise ValueError("Manifest %s is missing columns %s" %
+                       (path, ", ".join(missing)))
+    for record in reader:
+      if not record["TABLE"]:
+        continue
+      rows.append(ManifestRow(record["PROJECT"], record["DATASET"],
+                              record["VARIANTSET"], record["TABLE"],
+                              shlex.split(record["SOURCE_VCFS"])))
+
+  tables = collections.Counter(row.table for row in rows)
+  duplicates = [table for table, count in tables.items() if count > 1]
+  if duplicates:
+    raise ValueError("Tables listed more than once: %s" %
+                     ", ".join(sorted(duplicates)))
+  return rows
+
+
+class ImportState(object):
+  """Resumable record of the rows that have been imported.
+
+  The state is a JSON dict from destination table to a dict holding the
+  "status" ("done" or "failed") of its latest attempt, the "source_vcfs", the
+  "seconds" spent in each phase and any "error".  It is rewritten atomically
+  after each row, so an interrupted run loses at most the rows in progress.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self.rows = {}
+    if os.path.exists(path):
+      with open(path, "r") as f:
+        self.rows = json.load(f)
+
+  def is_done(self, row):
+    """Returns True if the row was imported from the same source VCFs."""
+    entry = self.rows.get(row.table)
+    return (entry is not None and entry["status"] == "done" and
+            entry["source_vcfs"] == row.source_vcfs)
+
+  def record(self, row, status, seconds=None, error=None):
+    with self._lock:
+      self.rows[row.table] = {
+          "status": status,
+          "source_vcfs": row.source_vcfs,
+          "seconds": seconds or {},
+          "error": error,
+          "finished": time.time(),
+      }
+      directory = os.path.dirname(os.path.abspath(self.path))
+      fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+      with os.fdopen(fd, "w") as f:
+        json.dump(self.rows, f, indent=2, sort_keys=True)
+      os.rename(temp_path, self.path)
+
+
+# The timeline of one row of a run: seconds from the start of the run until
+# the row started, seconds until it finished, and the seconds of each phase.
+RowTiming = collections.namedtuple("RowTiming",
+                                   ["table", "started", "finished", "phases"])
+
+
+class ManifestImporter(object):
+  """Imports the rows of a manifest with bounded concurrency."""
+
+  def __init__(self, state, max_concurrent=4, expand_wildcards=False,
+               uploader_factory=vcf_to_bigquery_utils.VcfUploader):
+    """Create ManifestImporter class.
+
+    Args:
+      state: An ImportState.
+      max_concurrent: Maximum number of rows in progress at once.
+      expand_wildcards: Expand wildcards in VCF paths and use parallel imports.
+      uploader_factory: Function from a project id to a VcfUploader.  One
+          uploader is shared by all rows of a project, so datasets and variant
+          sets are listed once.
+    """
+    self.state = state
+    self.max_concurrent = max_concurrent
+    self.expand_wildcards = expand_wildcards
+    self._uploader_factory = uploader_factory
+    self._uploaders = {}
+    self._uploaders_lock = threading.Lock()
+    self._start_time = None
+
+  def _uploader(self, project):
+    with self._uploaders_lock:
+      if project not in self._uploaders:
+        self._uploaders[project] = self._uploader_factory(project)
+      return self._uploaders[project]
+
+  def _import_row(self, row):
+    started = time.time() - self._start_time
+    logging.info("Starting import to %s", row.table)
+    try:
+      phases = self._uploader(row.project).upload_variants(
+          dataset=row.dataset,
+          variantset=row.variantset,
+          source_vcfs=row.source_vcfs,
+          destination_table=row.table,
+          expand_wildcards=self.expand_wildcards,
+          description=" ".join(row.source_vcfs))
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Import to %s failed", row.table)
+      self.state.record(row, "failed", error=str(e))
+      return row, None
+    finished = time.time() - self._start_time
+    self.state.record(row, "done", seconds=phases)
+    logging.info("Finished import to %s in %.0f seconds", row.table,
+                 finished - started)
+    return row, RowTiming(row.table, started, finished, phases)
+
+  def run(self, rows):
+    """Imports the rows that are not already done.
+
+    Args:
+      rows: List of ManifestRow.
+
+    Returns:
+      A tuple of (list of RowTiming for the rows imported, list of the
+      ManifestRow that failed, number of rows skipped).
+    """
+    todo = [row for row in rows if not self.state.is_done(row)]
+    skipped = len(rows) - len(todo)
+    if skipped:
+      logging.info("Skipping %d rows already imported", skipped)
+
+    self._start_time = time.time()
+    timings = []
+    failed = []
+    pool = ThreadPool(max(1, min(self.max_concurrent, len(todo) or 1)))
+    try:
+      for row, timing in pool.imap_unordered(self._import_row, todo):
+        if timing is None:
+          failed.append(row)
+        else:
+          timings.append(timing)
+        logging.info("%d of %d rows finished (%d failed)",
+                     len(timings) + len(failed), len(todo), len(failed))
+    finally:
+      pool.terminate()
+    return timings, failed, skipped
+
+
+def format_report(timings, failed, skipped, wall_seconds):
+  """Returns a summary of a run, including its critical path."""
+  lines = ["Imported %d rows in %.0f seconds (%d skipped, %d failed)." %
+           (len(timings), wall_seconds, skipped, len(failed))]
+  if timings:
+    last = max(timings, key=lambda t: t.finished)
+    lines.append("Critical path: %s finished at %.0f seconds after waiting "
+                 "%.0f seconds to start:" %
+                 (last.table, last.finished, last.started))
+    for phase, seconds in last.phases.items():
+      lines.append("  %-8s %6.0f seconds" % (phase, seconds))
+    longest = max(timings, key=lambda t: t.finished - t.started)
+    lines.append("Longest row: %s took %.0f seconds, the least wall-clock "
+                 "time with unlimited concurrency." %
+                 (longest.table, longest.finished - longest.started))
+  for row in failed:
+    lines.append("FAILED: %s" % row.table)
+  return "\n".join(lines)
+
+
+def _parse_arguments():
+  """Parses command line arguments.
+
+  Returns:
+    A Namespace of parsed arguments.
+  """
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      "--manifest",
+      default="vcf_manifest.tsv",
+      help="Tab-separated manifest of VCF files and destination tables.")
+  parser.add_argument(
+      "--state-file",
+      help="Local file recording the rows that have been imported.  Defaults "
+      "to the manifest path with a .state.json suffix.")
+  parser.add_argument(
+      "--max-concurrent",
+      type=int,
+      default=4,
+      help="Maximum number of rows to import at once.")
+  parser.add_argument(
+      "--expand-wildcards",
+      action="store_true",
+      help="Expand wildcards in VCF paths and use parallel imports.")
+  return parser.parse_args()
+
+
+def main():
+  args = _parse_arguments()
+  logging.basicConfig(level=logging.INFO)
+
+  rows = read_manifest(args.manifest)
+  state = ImportState(args.state_file or args.manifest + ".state.json")
+  importer = ManifestImporter(state,
+                              max_concurrent=args.max_concurrent,
+                              expand_wildcards=args.expand_wildcards)
+  start_time = time.time()
+  timings, failed, skipped = importer.run(rows)
+  print(format_report(timings, failed, skipped, time.time() - start_time))
+  if failed:
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,165 @@
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Library to wait for many Google Genomics operations at once.
+
+Rather than waiting for each operation in turn, all outstanding operations are
+polled from a single scheduling loop.  Each operation has its own polling
+interval, which starts short and grows while the operation is running, so
+short operations are noticed quickly and long ones are not polled needlessly.
+The first failed operation is reported as soon as it is seen.
+
+The discovery-based API client is not thread safe, so polls are issued from
+the calling thread one at a time; a poll takes far less time than the
+intervals between them.
+"""
+
+import heapq
+import logging
+import time
+
+
+class OperationError(RuntimeError):
+  """Raised when a Genomics operation fails.
+
+  Attributes:
+    operation_id: The name of the failed operation.
+    response: The final operations().get() response for the operation, or
+        None if it could not be polled.
+  """
+
+  def __init__(self, message, operation_id, response=None):
+    super(OperationError, self).__init__(message)
+    self.operation_id = operation_id
+    self.response = response
+
+
+def operation_succeeded(response):
+  """Returns True if a finished operation succeeded.
+
+  If the operation succeeded, there will be a "response" field and not an
+  "error" field, see:
+  https://cloud.google.com/genomics/reference/rest/Shared.Types/ListOperationsResponse#Operation
+  """
+  return "response" in response and "error" not in response
+
+
+class OperationTracker(object):
+  """Polls a set of Genomics operations until they all finish.
+
+  The service may be any object with the interface of the Genomics v1
+  discovery client's operations().get(name=...).execute(), which makes the
+  tracker easy to test against a fake that simulates operation timelines.
+  """
+
+  def __init__(self,
+               service,
+               initial_wait_seconds=5,
+               max_wait_seconds=60,
+               backoff_factor=1.5,
+               max_poll_errors=10,
+               progress_callback=None,
+               clock=time.time,
+               sleep=time.sleep):
+    """Create OperationTracker class.
+
+    Args:
+      service: Genomics v1 API client, or a fake with the same interface.
+      initial_wait_seconds: Seconds to wait before the first poll of each
+          operation.
+      max_wait_seconds: Largest number of seconds between polls.
+      backoff_factor: Factor by which the wait grows after each poll that
+          finds the operation still running.
+      max_poll_errors: Give up after this many consecutive failed polls of an
+          operation.  Transient errors, such as a 404 for a new operation that
+          is not yet visible, are retried with the same backoff.
+      progress_callback: Optional function called with (operation_id,
+          response, num_done, num_total) when an operation finishes.
+      clock: Function returning the current time in seconds.
+      sleep: Function sleeping for a number of seconds.
+    """
+    self.service = service
+    self.initial_wait_seconds = initial_wait_seconds
+    self.max_wait_seconds = max_wait_seconds
+    self.backoff_factor = backoff_factor
+    self.max_poll_errors = max_poll_errors
+    self.progress_callback = progress_callback
+    self._clock = clock
+    self._sleep = sleep
+
+  def _poll(self, operation_id):
+    return self.service.operations().get(name=operation_id).execute()
+
+  def wait(self, operation_ids):
+    """Blocks until all operations finish successfully, or one fails.
+
+    Args:
+      operation_ids: The names (id strings) of the operations.
+
+    Returns:
+      A dict from operation id to its final response.
+
+    Raises:
+      OperationError: As soon as any operation is found to have failed, or
+          cannot be polled after max_poll_errors attempts.  Operations still
+          running are left running.
+    """
+    operation_ids = list(operation_ids)
+    start_time = self._clock()
+    # Heap of (next poll time, sequence number, operation id, wait, errors).
+    # The sequence number keeps the order of operations with equal times.
+    pending = [(start_time + self.initial_wait_seconds, i, operation_id,
+                self.initial_wait_seconds, 0)
+               for i, operation_id in enumerate(operation_ids)]
+    heapq.heapify(pending)
+    results = {}
+
+    while pending:
+      due, sequence, operation_id, wait, errors = heapq.heappop(pending)
+      delay = due - self._clock()
+      if delay > 0:
+        self._sleep(delay)
+
+      wait = min(self.max_wait_seconds, wait * self.backoff_factor)
+      try:
+        response = self._poll(operation_id)
+      except Exception as e:  # pylint: disable=broad-except
+        errors += 1
+        if errors >= self.max_poll_errors:
+          raise OperationError("Failed to poll operation %s: %s" %
+                               (operation_id, e), operation_id)
+        logging.warning("Error polling operation %s (attempt %d): %s",
+                        operation_id, errors, e)
+        heapq.heappush(pending, (self._clock() + wait, sequence,
+                                 operation_id, wait, errors))
+        continue
+
+      if not response.get("done"):
+        heapq.heappush(pending, (self._clock() + wait, sequence, operation_id,
+                                 wait, 0))
+        continue
+
+      if not operation_succeeded(response):
+        raise OperationError("Operation %s failed: %s" %
+                             (operation_id, response.get("error")),
+                             operation_id, response)
+
+      results[operation_id] = response
+      logging.info("Operation %s finished after %.0f seconds (%d of %d done)",
+                   operation_id, self._clock() - start_time, len(results),
+                   len(operation_ids))
+      if self.progress_callback:
+        self.progress_callback(operation_id, response, len(results),
+                               len(operation_ids))
+
+    return results
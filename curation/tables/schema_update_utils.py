@@ -14,10 +14,15 @@
 """Library to update a variants table schema with field descriptions.
 """
 
+import collections
 import glob
-import gzip
+import hashlib
+import json
 import logging
+import os
 import re
+import tempfile
+import zlib
 
 from gcloud import bigquery
 
@@ -33,6 +38,19 @@ except ImportError:
 _MAX_LENGTH = 1024
 _TRUNCATION_WARNING = 'Truncating %s to comply with BigQuery length limits'
 
+_FILTER_PATTERN = re.compile(r'<ID=([^,]+),Description="(.*)">')
+_FORMAT_OR_INFO_PATTERN = re.compile(
+    r'<ID=([^,]+),Number=([^,]+),Type=([^,]+),Description="(.*)">')
+
+# Default local directory for cached VCF header descriptions.
+DEFAULT_HEADER_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'variant_annotation', 'vcf_headers')
+
+# Number of (possibly compressed) bytes read at a time from a VCF header.
+_HEADER_READ_SIZE = 64 * 1024
+
+_WILDCARD_CHARS = re.compile(r'[*?[]')
+
 _FIXED_VARIANT_FIELDS = {
     'reference_name':
         'An identifier from the reference genome or an angle-bracketed ID '
@@ -67,6 +85,81 @@ _FIXED_CALL_FIELDS = {
 }
 
 
+class HeaderCache(object):
+  """Local cache of the descriptions parsed from VCF headers.
+
+  Entries are keyed by the path of the VCF along with its size and
+  modification time, so a changed file is parsed again.
+  """
+
+  def __init__(self, cache_dir=DEFAULT_HEADER_CACHE_DIR):
+    self.cache_dir = cache_dir
+
+  def _entry_path(self, key):
+    digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+    return os.path.join(self.cache_dir, digest + '.json')
+
+  def get(self, key):
+    """Returns the cached headers for key, or None if they are not cached."""
+    try:
+      with open(self._entry_path(key)) as f:
+        entry = json.load(f)
+    except (IOError, OSError, ValueError):
+      return None
+    if entry.get('key') != key:
+      return None
+    return entry['headers']
+
+  def put(self, key, headers):
+    """Stores headers for key, replacing any existing entry atomically."""
+    try:
+      if not os.path.isdir(self.cache_dir):
+        os.makedirs(self.cache_dir)
+      fd, temp_path = tempfile.mkstemp(dir=self.cache_dir)
+      with os.fdopen(fd, 'w') as f:
+        json.dump({'key': key, 'headers': headers}, f)
+      os.rename(temp_path, self._entry_path(key))
+    except (IOError, OSError) as e:
+      logging.warning('Failed to cache VCF header descriptions: %s', e)
+
+
+def _iter_header_lines(f, compressed):
+  """Yields the lines of a VCF, reading and decompressing only as needed.
+
+  Input is read in blocks and gzip members (such as BGZF blocks) are
+  decompressed one by one, so a caller that stops at the end of the header
+  reads little more than the header itself.
+
+  Args:
+    f: VCF file opened for binary reading.
+    compressed: Whether the file is gzip-compressed.
+
+  Yields:
+    Decoded lines, without line endings.
+  """
+  decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  carry = b''
+  while True:
+    data = f.read(_HEADER_READ_SIZE)
+    if not data:
+      break
+    if compressed:
+      chunks = []
+      while data:
+        chunks.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+        if decompressor.eof:
+          decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      data = b''.join(chunks)
+
+    lines = (carry + data).split(b'\n')
+    carry = lines.pop()
+    for line in lines:
+      yield line.rstrip(b'\r').decode('utf-8', 'replace')
+  if carry:
+    yield carry.rstrip(b'\r').decode('utf-8', 'replace')
+
+
 class Descriptions(object):
   """Encapsulate field descriptions as parsed from a VCF."""
 
@@ -79,7 +172,7 @@ class Descriptions(object):
   def _parse_filter_header(line_no, line):
     value = line.split('=', 1)[1]
 
-    m = re.match(r'<ID=([^,]+),Description="(.*)">', value)
+    m = _FILTER_PATTERN.match(value)
     if not m:
       raise ValueError('Failed to parse line %d: %s' % (line_no, line))
 
@@ -89,56 +182,87 @@ class Descriptions(object):
   def _parse_format_or_info_header(line_no, line):
     value = line.split('=', 1)[1]
 
-    m = re.match(r'<ID=([^,]+),Number=([^,]+),Type=([^,]+),Description="(.*)">',
-                 value)
+    m = _FORMAT_OR_INFO_PATTERN.match(value)
     if not m:
       raise ValueError('Failed to parse line %d: %s' % (line_no, line))
 
     return {'id': m.group(1), 'description': m.group(4)}
 
-  def add_from_vcf(self, path):
-    """Add descriptions from a VCF.
+  @staticmethod
+  def _resolve_path(path):
+    """Expands wildcards in path and returns (path, cache key)."""
+    # Handle wildcards in the path by expanding and taking the first file.
+    if path.startswith('gs://'):
+      if _WILDCARD_CHARS.search(path):
+        path = gfile.Glob(path)[0]
+      stat = gfile.Stat(path)
+      return path, [path, stat.length, stat.mtime_nsec]
 
-    Args:
-      path: Path to local or remote (in Cloud Storage via a "gs://" path, if
-          TensorFlow is installed) VCF file, optionally gzip-compressed
-          (requires a ".gz" suffix).
-    """
+    if _WILDCARD_CHARS.search(path):
+      path = glob.glob(path)[0]
+    stat = os.stat(path)
+    return path, [os.path.abspath(path), stat.st_size, stat.st_mtime]
+
+  def _read_headers(self, path):
+    """Parses the FILTER, FORMAT and INFO header lines of a VCF."""
     filter_desc = []
     format_fields = {}
     info_fields = {}
 
-    # Handle wildcards in the path by expanding and taking the first file.
     if path.startswith('gs://'):
-      path = gfile.Glob(path)[0]
-      f = gfile.Open(path)
+      f = gfile.Open(path, 'rb')
     else:
-      path = glob.glob(path)[0]
-      f = open(path)
+      f = open(path, 'rb')
+
+    try:
+      line_no = 0
+      for line in _iter_header_lines(f, path.endswith('.gz')):
+        line_no += 1
 
-    # Handle gzipped VCF files.
-    if path.endswith('.gz'):
-      f = gzip.GzipFile(fileobj=f)
+        if line.startswith('##FORMAT='):
+          header = self._parse_format_or_info_header(line_no, line)
+          format_fields[header['id']] = header['description']
 
-    line_no = 0
-    for line in f:
-      line_no += 1
+        elif line.startswith('##INFO='):
+          header = self._parse_format_or_info_header(line_no, line)
+          info_fields[header['id']] = header['description']
 
-      if line.startswith('##FORMAT='):
-        header = self._parse_format_or_info_header(line_no, line)
-        format_fields[header['id']] = header['description']
+        elif line.startswith('##FILTER='):
+          header = self._parse_filter_header(line_no, line)
+          filter_desc.append(header)
 
-      elif line.startswith('##INFO='):
-        header = self._parse_format_or_info_header(line_no, line)
-        info_fields[header['id']] = header['description']
+        # Reached the end of the VCF header
+        if line.startswith('#CHROM') or not line.startswith('#'):
+          break
+    finally:
+      f.close()
 
-      elif line.startswith('##FILTER='):
-        header = self._parse_filter_header(line_no, line)
-        filter_desc.append(header)
+    return {'filter': filter_desc,
+            'format': format_fields,
+            'info': info_fields}
+
+  def add_from_vcf(self, path, cache_dir=DEFAULT_HEADER_CACHE_DIR):
+    """Add descriptions from a VCF.
+
+    Args:
+      path: Path to local or remote (in Cloud Storage via a "gs://" path, if
+          TensorFlow is installed) VCF file, optionally gzip-compressed
+          (requires a ".gz" suffix).
+      cache_dir: Local directory in which parsed headers are cached, keyed by
+          path, size and modification time.  None disables the cache.
+    """
+    path, key = self._resolve_path(path)
+
+    cache = HeaderCache(cache_dir) if cache_dir else None
+    headers = cache.get(key) if cache else None
+    if headers is None:
+      headers = self._read_headers(path)
+      if cache:
+        cache.put(key, headers)
+    else:
+      logging.info('Using cached VCF header descriptions for %s', path)
 
-      # Reached the end of the VCF header
-      if line.startswith('#CHROM'):
-        break
+    filter_desc = headers['filter']
 
     # Update the member fields
     self.filter_description = '\n'.join(
@@ -149,8 +273,8 @@ class Descriptions(object):
       logging.warning(_TRUNCATION_WARNING, 'variant filter thresholds')
       self.filter_description = '\n'.join([item['id'] for item in filter_desc])
 
-    self.format_fields = format_fields
-    self.info_fields = info_fields
+    self.format_fields = headers['format']
+    self.info_fields = headers['info']
 
 
 def tokenize_table_name(full_table_name):
@@ -179,13 +303,129 @@ def tokenize_table_name(full_table_name):
           tokenized_table[-1])
 
 
-def update_table_schema(destination_table, source_vcf, description=None):
+# The outcome of describing one table: the (field path, old description, new
+# description) of each field whose description changed, where the path of a
+# call field is "call.NAME", whether the table description changed and whether
+# the table was patched.
+SchemaUpdate = collections.namedtuple(
+    'SchemaUpdate', ['changes', 'description_changed', 'patched'])
+
+
+def _truncate(name, description):
+  if description is not None and len(description) > _MAX_LENGTH:
+    logging.warning(_TRUNCATION_WARNING, name)
+    return description[:_MAX_LENGTH]
+  return description
+
+
+def _variant_field_description(field, descriptions):
+  """Returns the description a variant field should have."""
+  if field.name.lower() in _FIXED_VARIANT_FIELDS:
+    return _FIXED_VARIANT_FIELDS[field.name.lower()]
+  elif field.name in descriptions.info_fields:
+    return descriptions.info_fields[field.name]
+  elif field.name.lower() == 'filter':
+    return descriptions.filter_description
+  return field.description
+
+
+def _call_field_description(field, descriptions):
+  """Returns the description a call field should have."""
+  if field.name.lower() in _FIXED_CALL_FIELDS:
+    return _FIXED_CALL_FIELDS[field.name.lower()]
+  elif field.name in descriptions.format_fields:
+    return descriptions.format_fields[field.name]
+  elif field.name in descriptions.info_fields:
+    return descriptions.info_fields[field.name]
+  elif field.name.lower() == 'filter':
+    return descriptions.filter_description
+  return field.description
+
+
+def describe_schema(schema, descriptions):
+  """Sets the descriptions of the fields of a variants table schema.
+
+  The (non-fixed) variant field descriptions come from the ##INFO headers.
+  The (non-fixed) call fields descriptions can come from the ##FORMAT headers
+  as well as the ##INFO headers.  Fields without a description in either keep
+  their current one.
+
+  Args:
+    schema: List of the SchemaFields of a variants table, which are updated.
+    descriptions: Descriptions parsed from a VCF.
+
+  Returns:
+    A list of (field path, old description, new description) of the fields
+    whose description changed.
+  """
+  changes = []
+
+  def describe(field, path, description):
+    description = _truncate(field.name, description)
+    # BigQuery returns an empty description as None.
+    if (description or None) != (field.description or None):
+      changes.append((path, field.description, description))
+      field.description = description
+      logging.debug('%s: %s', path, description)
+
+  for field in schema:
+    describe(field, field.name, _variant_field_description(field, descriptions))
+    if field.name == 'call':
+      for call_field in field.fields or []:
+        describe(call_field, 'call.' + call_field.name,
+                 _call_field_description(call_field, descriptions))
+  return changes
+
+
+def describe_table(table, descriptions, description=None, dry_run=False):
+  """Patches a table with the descriptions that differ from its own.
+
+  Args:
+    table: A reloaded BigQuery Table of variants.
+    descriptions: Descriptions parsed from a VCF.
+    description: Optional description for the table.
+    dry_run: Only compute the changes, without patching the table.
+
+  Returns:
+    A SchemaUpdate.  The table is patched once, with only the properties that
+    changed, and not at all if nothing did.
+  """
+  changes = describe_schema(table.schema, descriptions)
+  patch = {}
+  if changes:
+    patch['schema'] = table.schema
+  if description is not None:
+    description = _truncate('table description', description)
+    if (description or None) != (table.description or None):
+      patch['description'] = description
+
+  if not patch:
+    logging.info('Descriptions of table %s are up to date', table.name)
+  elif not dry_run:
+    logging.info('Updating table %s (%d field descriptions%s)', table.name,
+                 len(changes),
+                 ' and the table description' if 'description' in patch
+                 else '')
+    table.patch(**patch)
+  return SchemaUpdate(changes, 'description' in patch,
+                      bool(patch) and not dry_run)
+
+
+def update_table_schema(destination_table, source_vcf, description=None,
+                        header_cache_dir=DEFAULT_HEADER_CACHE_DIR,
+                        client=None):
   """Updates a BigQuery table with the variants schema using a VCF header.
 
   Args:
     destination_table: BigQuery table name, PROJECT_ID.DATASET_NAME.TABLE_NAME.
     source_vcf: Path to local or remote (Cloud Storage) VCF or gzipped VCF file.
     description: Optional description for the BigQuery table.
+    header_cache_dir: Local directory in which parsed VCF headers are cached.
+        None disables the cache.
+    client: BigQuery client, or None to create one for the table's project.
+
+  Returns:
+    A SchemaUpdate.
 
   Raises:
     ValueError: If destination_table cannot be parsed.
@@ -196,70 +436,14 @@ def update_table_schema(destination_table, source_vcf, description=None):
 
   # Load the source VCF
   descriptions = Descriptions()
-  descriptions.add_from_vcf(source_vcf)
+  descriptions.add_from_vcf(source_vcf, cache_dir=header_cache_dir)
 
   # Initialize the BQ client
-  client = bigquery.Client(project=dest_project_id)
+  if client is None:
+    client = bigquery.Client(project=dest_project_id)
 
-  # Load the destination table
-  dest_dataset = client.dataset(dest_dataset_name)
-  dest_dataset.reload()
-
-  dest_table = dest_dataset.table(dest_table_name)
+  # Load the destination table.  The dataset itself need not be reloaded.
+  dest_table = client.dataset(dest_dataset_name).table(dest_table_name)
   dest_table.reload()
 
-  if description is not None:
-    dest_table.patch(description=description[:_MAX_LENGTH])
-    if len(description) > _MAX_LENGTH:
-      logging.warning(_TRUNCATION_WARNING, 'table description')
-
-  # Set the description on the variant fields and the call fields.
-  #
-  # The (non-fixed) variant field descriptions come from the ##INFO headers
-  # The (non-fixed) call fields descriptions can come from the ##FORMAT headers
-  #   as well as the ##INFO headers.
-
-  # Process variant fields
-  call_field = None
-  for field in dest_table.schema:
-    if field.name.lower() in _FIXED_VARIANT_FIELDS:
-      field.description = _FIXED_VARIANT_FIELDS[field.name.lower()]
-      logging.debug('Variant(fixed): %s: %s', field.name, field.description)
-
-    elif field.name in descriptions.info_fields:
-      field.description = descriptions.info_fields[field.name]
-      logging.debug('Variant(INFO) %s: %s', field.name, field.description)
-
-    elif field.name.lower() == 'filter':
-      field.description = descriptions.filter_description
-
-    if field.name == 'call':
-      call_field = field
-
-    if field.description is not None and len(field.description) > _MAX_LENGTH:
-      logging.warning(_TRUNCATION_WARNING, field.name)
-      field.description = field.description[:_MAX_LENGTH]
-
-  # Process call fields
-  for field in call_field.fields:
-    if field.name.lower() in _FIXED_CALL_FIELDS:
-      field.description = _FIXED_CALL_FIELDS[field.name.lower()]
-      logging.debug('Call(fixed): %s: %s', field.name, field.description)
-
-    elif field.name in descriptions.format_fields:
-      field.description = descriptions.format_fields[field.name]
-      logging.debug('Call(FORMAT) %s: %s', field.name, field.description)
-
-    elif field.name in descriptions.info_fields:
-      field.description = descriptions.info_fields[field.name]
-      logging.debug('Call(INFO) %s: %s', field.name, field.description)
-
-    elif field.name.lower() == 'filter':
-      field.description = descriptions.filter_description
-
-    if field.description is not None and len(field.description) > _MAX_LENGTH:
-      logging.warning(_TRUNCATION_WARNING, field.name)
-      field.description = field.description[:_MAX_LENGTH]
-
-  logging.info('Updating table %s', dest_table.path)
-  dest_table.patch(schema=dest_table.schema)
+  return describe_table(dest_table, descriptions, description)
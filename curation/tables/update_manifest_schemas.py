@@ -0,0 +1,224 @@
+# Copyright 2017 Verily Life Sciences Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Update the field descriptions of every table listed in a manifest.
+
+For each row of the manifest (see vcf_manifest.tsv), the descriptions are
+parsed from the header of its first VCF, as update_variants_schema.py does,
+and compared field by field, including the fields of call, with those of the
+table.  Only tables whose schema or description differs are patched, with a
+single request each.  Up to --max-concurrent tables are reloaded and patched
+at once.
+
+At the end, the time spent reading the header, reloading and patching each
+table is reported, along with the number of tables patched, unchanged and
+failed.  --dry-run reports the changes without patching.
+
+Example usage:
+
+python update_manifest_schemas.py \
+    --manifest vcf_manifest.tsv \
+    --max-concurrent 8
+"""
+
+import argparse
+import collections
+import logging
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import import_manifest
+import schema_update_utils
+
+# The outcome of one table: its "status" ("patched", "unchanged", "changed"
+# with --dry-run, or "failed"), the SchemaUpdate, the seconds of each step and
+# any error.
+TableResult = collections.namedtuple(
+    "TableResult", ["table", "status", "update", "seconds", "error"])
+
+
+def _default_client_factory(project):
+  # Imported here so that a fake client can be used without the package.
+  from gcloud import bigquery  # pylint: disable=g-import-not-at-top
+  return bigquery.Client(project=project)
+
+
+class SchemaUpdater(object):
+  """Updates the descriptions of the tables of a manifest concurrently."""
+
+  def __init__(self, max_concurrent=8,
+               header_cache_dir=schema_update_utils.DEFAULT_HEADER_CACHE_DIR,
+               dry_run=False, client_factory=_default_client_factory):
+    """Create SchemaUpdater class.
+
+    Args:
+      max_concurrent: Maximum number of tables updated at once.
+      header_cache_dir: Local directory in which parsed VCF headers are
+          cached.  None disables the cache.
+      dry_run: Only report the changes, without patching the tables.
+      client_factory: Function from a project id to a BigQuery client, or a
+          fake with its dataset(name).table(name) and the table's reload,
+          schema, description, name and patch.
+    """
+    self.max_concurrent = max_concurrent
+    self.header_cache_dir = header_cache_dir
+    self.dry_run = dry_run
+    self._client_factory = client_factory
+    # The HTTP connection of a client is not thread-safe, so each thread has
+    # its own client for each project.
+    self._clients = threading.local()
+
+  def _client(self, project):
+    clients = self._clients.__dict__.setdefault("by_project", {})
+    if project not in clients:
+      clients[project] = self._client_factory(project)
+    return clients[project]
+
+  def _update_row(self, row):
+    seconds = collections.OrderedDict()
+    try:
+      step_start = time.time()
+      project, dataset, table_name = schema_update_utils.tokenize_table_name(
+          row.table)
+      descriptions = schema_update_utils.Descriptions()
+      descriptions.add_from_vcf(row.source_vcfs[0],
+                                cache_dir=self.header_cache_dir)
+      seconds["header"] = time.time() - step_start
+
+      step_start = time.time()
+      table = self._client(project).dataset(dataset).table(table_name)
+      table.reload()
+      seconds["reload"] = time.time() - step_start
+
+      step_start = time.time()
+      # The same table description as import_manifest.py sets.
+      update = schema_update_utils.describe_table(
+          table, descriptions, description=" ".join(row.source_vcfs),
+          dry_run=self.dry_run)
+      seconds["patch"] = time.time() - step_start
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Updating the descriptions of %s failed", row.table)
+      return TableResult(row.table, "failed", None, seconds, str(e))
+
+    if update.patched:
+      status = "patched"
+    elif update.changes or update.description_changed:
+      status = "changed"
+    else:
+      status = "unchanged"
+    return TableResult(row.table, status, update, seconds, None)
+
+  def run(self, rows):
+    """Updates the descriptions of the tables of rows.
+
+    Args:
+      rows: List of import_manifest.ManifestRow.
+
+    Returns:
+      A list of TableResult, in the order of rows.
+    """
+    results = {}
+    pool = ThreadPool(max(1, min(self.max_concurrent, len(rows) or 1)))
+    try:
+      for result in pool.imap_unordered(self._update_row, rows):
+        results[result.table] = result
+        logging.info("%d of %d tables done", len(results), len(rows))
+    finally:
+      pool.terminate()
+    return [results[row.table] for row in rows]
+
+
+def format_report(results, wall_seconds):
+  """Returns the per-table timings and a summary of a run."""
+  counts = collections.Counter(result.status for result in results)
+  lines = []
+  for result in results:
+    steps = "  ".join("%s %5.1fs" % (step, seconds)
+                      for step, seconds in result.seconds.items())
+    if result.update is None:
+      detail = ""
+    else:
+      detail = "%3d fields%s" % (
+          len(result.update.changes),
+          " + table" if result.update.description_changed else "")
+    lines.append("%-9s %-18s %s  %s" % (result.status, detail, steps,
+                                        result.table))
+  lines.append("Checked %d tables in %.0f seconds: %d patched, %d unchanged, "
+               "%d failed%s." %
+               (len(results), wall_seconds, counts["patched"],
+                counts["unchanged"], counts["failed"],
+                ", %d to patch" % counts["changed"] if counts["changed"]
+                else ""))
+  return "\n".join(lines)
+
+
+def _parse_arguments():
+  """Parses command line arguments.
+
+  Returns:
+    A Namespace of parsed arguments.
+  """
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      "--manifest",
+      default="vcf_manifest.tsv",
+      help="Tab-separated manifest of VCF files and destination tables.")
+  parser.add_argument(
+      "--table",
+      action="append",
+      help="Only update this destination table of the manifest.  May be "
+      "repeated.")
+  parser.add_argument(
+      "--max-concurrent",
+      type=int,
+      default=8,
+      help="Maximum number of tables to update at once.")
+  parser.add_argument(
+      "--header-cache-dir",
+      default=schema_update_utils.DEFAULT_HEADER_CACHE_DIR,
+      help="Local directory in which to cache parsed VCF headers.  Pass an "
+      "empty string to disable the cache.")
+  parser.add_argument(
+      "--dry-run",
+      action="store_true",
+      help="Report the descriptions that would change without patching.")
+  return parser.parse_args()
+
+
+def main():
+  args = _parse_arguments()
+  logging.basicConfig(level=logging.INFO)
+
+  rows = import_manifest.read_manifest(args.manifest)
+  if args.table:
+    unknown = set(args.table) - set(row.table for row in rows)
+    if unknown:
+      raise SystemExit("Tables not in the manifest: %s" %
+                       ", ".join(sorted(unknown)))
+    rows = [row for row in rows if row.table in args.table]
+
+  updater = SchemaUpdater(max_concurrent=args.max_concurrent,
+                          header_cache_dir=args.header_cache_dir or None,
+                          dry_run=args.dry_run)
+  start_time = time.time()
+  results = updater.run(rows)
+  print(format_report(results, time.time() - start_time))
+  if any(result.status == "failed" for result in results):
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -36,14 +36,21 @@ def _parse_arguments():
       required=True,
       help='Full path to destination table '
            '(PROJECT_ID.DATASET_NAME.TABLE_NAME)')
+  parser.add_argument(
+      '--header-cache-dir',
+      default=schema_update_utils.DEFAULT_HEADER_CACHE_DIR,
+      help='Local directory in which to cache parsed VCF headers.  Pass an '
+           'empty string to disable the cache.')
   return parser.parse_args()
 
 
 def main():
   args = _parse_arguments()
 
-  schema_update_utils.update_table_schema(args.destination_table,
-                                          args.source_vcf)
+  schema_update_utils.update_table_schema(
+      args.destination_table,
+      args.source_vcf,
+      header_cache_dir=args.header_cache_dir or None)
 
 
 if __name__ == '__main__':
@@ -14,7 +14,9 @@
 """Library to upload VCF files to Google Genomics and BigQuery.
 """
 
+import collections
 import logging
+import threading
 import time
 
 from apiclient import discovery
@@ -27,8 +29,78 @@ try:
 except ImportError:
   gfile = None
 
+import operation_tracker
 import schema_update_utils
 
+# Number of seconds for which listed datasets and variant sets are reused.
+DEFAULT_REGISTRY_TTL_SECONDS = 10 * 60
+
+
+class ResourceRegistry(object):
+  """Cache of the resources returned by a paginated list call.
+
+  The full list is fetched, following nextPageToken, the first time it is
+  needed and again once it is older than ttl_seconds, so repeated lookups by
+  name or id cost no API calls.  Resources created through this process are
+  added with add(); invalidate() forces the next lookup to list again.
+  """
+
+  def __init__(self, list_page, items_key, ttl_seconds, clock=time.time):
+    """Create ResourceRegistry class.
+
+    Args:
+      list_page: Function from a page token (None for the first page) to the
+          response of the list call for that page.
+      items_key: The key of the resources in each response.
+      ttl_seconds: Number of seconds for which a listing is reused.
+      clock: Function returning the current time in seconds.
+    """
+    self._list_page = list_page
+    self._items_key = items_key
+    self.ttl_seconds = ttl_seconds
+    self._clock = clock
+    self._items = None
+    self._loaded_at = None
+    # Held while finding or creating, so that concurrent callers looking for
+    # the same name do not both create it.
+    self.lock = threading.RLock()
+
+  def _load(self):
+    items = []
+    page_token = None
+    while True:
+      response = self._list_page(page_token)
+      items.extend(response.get(self._items_key, []))
+      page_token = response.get("nextPageToken")
+      if not page_token:
+        break
+    self._items = items
+    self._loaded_at = self._clock()
+
+  def find(self, name):
+    """Returns the id of the resource with this name or id, or None.
+
+    Raises:
+      LookupError: If multiple resources match the name.
+    """
+    with self.lock:
+      if (self._items is None or
+          self._clock() - self._loaded_at > self.ttl_seconds):
+        self._load()
+      return VcfUploader.find_id_or_name(name, self._items)
+
+  def add(self, resource):
+    """Records a newly created resource."""
+    with self.lock:
+      if self._items is not None:
+        self._items.append(resource)
+
+  def invalidate(self):
+    """Discards the cached listing."""
+    with self.lock:
+      self._items = None
+
+
 class VcfUploader(object):
   """Class for managing a Google Genomics API connection and data transfers.
 
@@ -37,17 +109,59 @@ class VcfUploader(object):
   upload_variants(...), but other intermediate pipeline steps may also be used.
   """
 
-  def __init__(self, project, credentials=None):
+  def __init__(self, project, credentials=None, service=None,
+               registry_ttl_seconds=DEFAULT_REGISTRY_TTL_SECONDS):
     """Create VcfUploader class.
 
     Args:
       project: Cloud project to use for Genomics objects.
       credentials: Credentials object to use, get_application_default() if None.
+      service: Genomics v1 API client to use, or a fake with the same
+          interface.  If None, a client is built from credentials for each
+          thread that uses this object, since the client is not thread safe.
+      registry_ttl_seconds: Number of seconds for which the listing of
+          datasets and variant sets is reused by find_or_create_*().
     """
-    if credentials is None:
+    if service is None and credentials is None:
       credentials = GoogleCredentials.get_application_default()
     self.project = project
-    self.service = discovery.build("genomics", "v1", credentials=credentials)
+    self._credentials = credentials
+    self._service = service
+    self._thread_local = threading.local()
+    self.registry_ttl_seconds = registry_ttl_seconds
+    self._datasets = ResourceRegistry(self._list_datasets_page, "datasets",
+                                      registry_ttl_seconds)
+    # Dict from dataset id to the ResourceRegistry of its variant sets.
+    self._variantsets = {}
+    self._variantsets_lock = threading.Lock()
+
+  @property
+  def service(self):
+    """The Genomics API client for the calling thread."""
+    if self._service is not None:
+      return self._service
+    if not hasattr(self._thread_local, "service"):
+      self._thread_local.service = discovery.build(
+          "genomics", "v1", credentials=self._credentials)
+    return self._thread_local.service
+
+  def _list_datasets_page(self, page_token):
+    request = self.service.datasets().list(projectId=self.project,
+                                           pageToken=page_token)
+    return request.execute()
+
+  def _variantset_registry(self, dataset_id):
+    """Returns the ResourceRegistry of the variant sets in a dataset."""
+    with self._variantsets_lock:
+      if dataset_id not in self._variantsets:
+        def search_page(page_token):
+          body = {"datasetIds": [dataset_id]}
+          if page_token:
+            body["pageToken"] = page_token
+          return self.service.variantsets().search(body=body).execute()
+        self._variantsets[dataset_id] = ResourceRegistry(
+            search_page, "variantSets", self.registry_ttl_seconds)
+      return self._variantsets[dataset_id]
 
   @staticmethod
   def find_id_or_name(name, candidates):
@@ -90,18 +204,17 @@ class VcfUploader(object):
     Returns:
       The id of the existing or newly-created Genomics dataset.
     """
-    request = self.service.datasets().list(projectId=self.project)
-    response = request.execute()
-
-    dataset_id = self.find_id_or_name(dataset_name,
-                                      response["datasets"])
-
-    if dataset_id is None or always_create:
-      request = self.service.datasets().create(
-          body={"name": dataset_name,
-                "projectId": self.project})
-      response = request.execute()
-      dataset_id = response["id"]
+    with self._datasets.lock:
+      dataset_id = None if always_create else self._datasets.find(
+          dataset_name)
+
+      if dataset_id is None:
+        request = self.service.datasets().create(
+            body={"name": dataset_name,
+                  "projectId": self.project})
+        response = request.execute()
+        self._datasets.add(response)
+        dataset_id = response["id"]
 
     return dataset_id
 
@@ -127,21 +240,20 @@ class VcfUploader(object):
     Returns:
       The id of the existing or newly-created Genomics variant set.
     """
-    request = self.service.variantsets().search(
-        body={"datasetIds": dataset_id})
-    response = request.execute()
-
-    variantset_id = self.find_id_or_name(variantset_name,
-                                         response["variantSets"])
-
-    if variantset_id is None or always_create:
-      request = self.service.variantsets().create(
-          body={"name": variantset_name,
-                "datasetId": dataset_id,
-                "description": description,
-          })
-      response = request.execute()
-      variantset_id = response["id"]
+    registry = self._variantset_registry(dataset_id)
+    with registry.lock:
+      variantset_id = None if always_create else registry.find(
+          variantset_name)
+
+      if variantset_id is None:
+        request = self.service.variantsets().create(
+            body={"name": variantset_name,
+                  "datasetId": dataset_id,
+                  "description": description,
+            })
+        response = request.execute()
+        registry.add(response)
+        variantset_id = response["id"]
     return variantset_id
 
   def import_variants(self, source_uris, variantset_id):
@@ -179,11 +291,25 @@ class VcfUploader(object):
     while not request.execute()["done"]:
       time.sleep(wait_seconds)
 
-    # If the operation succeeded, there will be a "response" field and not an
-    # "error" field, see:
-    # https://cloud.google.com/genomics/reference/rest/Shared.Types/ListOperationsResponse#Operation
-    response = request.execute()
-    return "response" in response and "error" not in response
+    return operation_tracker.operation_succeeded(request.execute())
+
+  def wait_for_operations(self, operation_ids, progress_callback=None):
+    """Blocks until all Genomics operations complete, polling them together.
+
+    Args:
+      operation_ids: The names (id strings) of the operations.
+      progress_callback: Optional function called with (operation_id,
+          response, num_done, num_total) as each operation completes.
+
+    Returns:
+      A dict from operation id to its final response.
+
+    Raises:
+      operation_tracker.OperationError: As soon as any operation fails.
+    """
+    tracker = operation_tracker.OperationTracker(
+        self.service, progress_callback=progress_callback)
+    return tracker.wait(operation_ids)
 
   def export_variants(self, variantset_id, destination_table):
     """Exports variants from Google Genomics to BigQuery.
@@ -233,9 +359,15 @@ class VcfUploader(object):
       new_variantset: Always create a new variant set with the requested name.
       description: Optional description for the BigQuery table.
 
+    Returns:
+      An OrderedDict from the name of each phase ("setup", "import", "export"
+      and "schema") to the number of seconds it took.
+
     Raises:
       RuntimeError: If an upload or export request does not succeed.
     """
+    timings = collections.OrderedDict()
+    phase_start = time.time()
 
     dataset_id = self.find_or_create_dataset(dataset,
                                              always_create=new_dataset)
@@ -252,26 +384,40 @@ class VcfUploader(object):
       source_vcfs = sum([gfile.Glob(source_vcf) for source_vcf in source_vcfs],
                         [])
 
+    timings["setup"] = time.time() - phase_start
+    phase_start = time.time()
+
     operation_ids = []
     for source_vcf in source_vcfs:
       operation_ids.append(self.import_variants(source_vcf, variantset_id))
       logging.info("Importing %s (%s)", source_vcf, operation_ids[-1])
 
     # Wait for all imports to complete successfully before exporting variantset.
-    for operation_id in operation_ids:
-      if not self.wait_for_operation(operation_id):
-        raise RuntimeError("Failed to import variants to Genomics (%s)"
-                           % operation_id)
+    try:
+      self.wait_for_operations(operation_ids)
+    except operation_tracker.OperationError as e:
+      raise RuntimeError("Failed to import variants to Genomics (%s)"
+                         % e.operation_id)
+
+    timings["import"] = time.time() - phase_start
+    phase_start = time.time()
 
     operation_id = self.export_variants(variantset_id, destination_table)
     logging.info("Exporting %s (%s)", variantset, operation_id)
 
-    if not self.wait_for_operation(operation_id):
+    try:
+      self.wait_for_operations([operation_id])
+    except operation_tracker.OperationError:
       raise RuntimeError("Failed to export variants to BigQuery (%s)"
                          % operation_id)
 
+    timings["export"] = time.time() - phase_start
+    phase_start = time.time()
+
     # Assume the VCF header is the same for all files and so just use the first.
     logging.info("Updating schema for %s", variantset)
     schema_update_utils.update_table_schema(destination_table,
                                             source_vcfs[0],
                                             description=description)
+    timings["schema"] = time.time() - phase_start
+    return timings